@@ -1,8 +1,11 @@
 #!/usr/bin/env python
 from oniontip import app, db
 from optparse import OptionParser, OptionGroup
+import oniontip.models
+import oniontip.snapshot
 import oniontip.util
 import oniontip.views
+import json
 import os
 import sys
 
@@ -10,6 +13,18 @@ def create_option_parser():
     parser = OptionParser()
     parser.add_option("-d", "--download", action="store_true",
                       help="download details.json from Onionoo service")
+    parser.add_option("-f", "--details-file", metavar="FILE",
+                      help="with --download, read a saved Onionoo details document from FILE")
+    parser.add_option("--descriptors", metavar="FILE",
+                      help="with --download, read server descriptors from a cached archive in FILE")
+    parser.add_option("--compact", action="store_true", default=False,
+                      help="with --download, rewrite details.json in full instead of writing a delta")
+    parser.add_option("-e", "--export-json", metavar="FILE",
+                      help="export the current relay snapshot to FILE as JSON")
+    parser.add_option("-m", "--migrate", action="store_true",
+                      help="add columns introduced since the database was created")
+    parser.add_option("-r", "--payout-report", action="store_true",
+                      help="print the total forwarded to each relay bitcoin address")
     parser.add_option("-c", "--check", action="store_true",
                       help="check bitcoin addresses for unspent outputs")
     parser.add_option("-a", "--check-all", action="store_true", default=False,
@@ -21,9 +36,30 @@ if '__main__' == __name__:
     (options, args) = parser.parse_args()
 
     if options.download:
-        relay_data = oniontip.util.download_details_file()
-        oniontip.util.check_and_update_bitcoin_fields(relay_data)
-        print "Downloaded details.json.  Re-run without --download option."
+        relay_count = oniontip.util.check_and_update_bitcoin_fields(options.details_file, options.descriptors,
+                                                                   options.compact)
+        print "Downloaded details.json with {} relays.  Re-run without --download option.".format(relay_count)
+        exit()
+
+    elif options.export_json:
+        details_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'oniontip/details.json')
+        snapshot = oniontip.snapshot.load_latest_snapshot(details_path)
+        with open(options.export_json, 'w') as export_file:
+            json.dump(snapshot.to_details(), export_file)
+        print "Exported {} relays to {}.".format(len(snapshot), options.export_json)
+        exit()
+
+    elif options.migrate:
+        added = oniontip.models.upgrade_schema()
+        if added:
+            print "Added columns: {}".format(', '.join(added))
+        else:
+            print "The database schema is up to date."
+        exit()
+
+    elif options.payout_report:
+        for address, total, donations in oniontip.models.payout_report():
+            print "{}\t{}\t{}".format(address, total, donations)
         exit()
 
     elif options.check or options.check_all:
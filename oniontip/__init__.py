@@ -1,12 +1,34 @@
 from flask import Flask
 from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.cache import Cache
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+import sqlite3
 
 app = Flask(__name__)
 app.config.from_object('oniontip.config')
 app.config.from_envvar('ONIONTIP_SETTINGS', silent=True)
 
-db = SQLAlchemy(app)
+class PooledSQLAlchemy(SQLAlchemy):
+    """Pool SQLite file connections too, Flask-SQLAlchemy opens one per request"""
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if (info.drivername == 'sqlite' and info.database not in (None, '', ':memory:')
+                and options.get('pool_size') and 'poolclass' not in options):
+            # Pooled connections are handed to other threads, one at a time
+            info.query.setdefault('check_same_thread', 'false')
+            options['poolclass'] = QueuePool
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        for pragma, value in app.config.get('SQLITE_PRAGMAS', {}).iteritems():
+            cursor.execute('PRAGMA {} = {}'.format(pragma, value))
+        cursor.close()
+
+db = PooledSQLAlchemy(app)
 cache = Cache(app, config={'CACHE_TYPE': 'simple'})
 
 if not app.debug:
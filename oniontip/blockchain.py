@@ -0,0 +1,329 @@
+"""
+Blockchain API used to look up and forward payments to OnionTip addresses.
+
+Every backend implements the ChainBackend interface: address history,
+unspent outputs and pushtx. ChainBackend batches history lookups for many
+addresses into as few requests as the backend allows, rate limits them and
+keeps responses for a few seconds. Transactions are pushed with each of the
+backend's push strategies in turn until one succeeds.
+
+The backend is chosen with the BLOCKCHAIN_BACKEND setting: 'blockchain.info'
+queries blockchain.info's multiaddr API over pooled HTTPS connections, 'stub'
+is an in-memory blockchain for testing the forwarding code without touching
+the network.
+"""
+import httplib
+import json
+import Queue
+import socket
+import threading
+import time
+import urllib
+
+import bitcoin # pybitcointools
+
+# Transaction broadcast services, tried in the order given by BLOCKCHAIN_PUSHTX
+PUSH_STRATEGIES = {
+    'blockchain.info': bitcoin.pushtx,
+    'blockr': bitcoin.blockr_pushtx,
+}
+DEFAULT_PUSHTX = ['blockchain.info', 'blockr']
+
+
+class BlockchainError(Exception):
+    pass
+
+
+class RateLimiter(object):
+    """
+    Spaces calls to wait() at least 1/rate seconds apart across all threads.
+    A rate of None doesn't limit anything.
+    """
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0.0
+        self._next = 0.0
+        self._lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            delay = self._next - now
+            self._next = max(now, self._next) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+class TTLCache(object):
+    """
+    Thread-safe mapping whose entries expire ttl seconds after being stored.
+    """
+    def __init__(self, ttl):
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.time():
+                del self._entries[key]
+                return None
+            return entry[1]
+
+    def put(self, key, value):
+        if self.ttl > 0:
+            with self._lock:
+                self._entries[key] = (time.time() + self.ttl, value)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class ConnectionPool(object):
+    """
+    Keeps up to size idle HTTPS connections to one host open so consecutive
+    requests don't each pay for a new TCP and TLS handshake.
+    """
+    def __init__(self, host, size=4, timeout=30):
+        self.host = host
+        self.timeout = timeout
+        self._idle = Queue.LifoQueue(size)
+
+    def request(self, path):
+        """
+        GET path and return the response body. A request on a reused
+        connection which the server has closed is retried once on a new one.
+        """
+        for attempt in range(2):
+            try:
+                connection = self._idle.get_nowait()
+                reused = True
+            except Queue.Empty:
+                connection = httplib.HTTPSConnection(self.host, timeout=self.timeout)
+                reused = False
+            try:
+                connection.request('GET', path)
+                response = connection.getresponse()
+                body = response.read()
+            except (httplib.HTTPException, socket.error):
+                connection.close()
+                if reused and attempt == 0:
+                    continue
+                raise
+            try:
+                self._idle.put_nowait(connection)
+            except Queue.Full:
+                connection.close()
+            if response.status != 200:
+                raise BlockchainError('%s returned HTTP %d: %s' % (self.host, response.status, body[:200]))
+            return body
+
+
+class ChainBackend(object):
+    """
+    Batching, rate limited and cached client for a chain data service.
+    Subclasses implement _fetch_histories(), which returns the history of up
+    to batch_size addresses in pybitcointools' format keyed by address.
+    """
+    batch_size = 1
+
+    def __init__(self, rate=None, cache_ttl=10, push_strategies=()):
+        self.rate_limiter = RateLimiter(rate)
+        self.cache = TTLCache(cache_ttl)
+        self.push_strategies = list(push_strategies)
+        self.requests = 0
+
+    def _fetch_histories(self, addresses):
+        raise NotImplementedError("This isn't implemented by the subclass")
+
+    def history_many(self, addresses):
+        """
+        Return the history of each address, using as few requests as the
+        batch size allows for those which aren't cached.
+        """
+        histories = {}
+        missing = []
+        for address in addresses:
+            history = self.cache.get(address)
+            if history is None:
+                missing.append(address)
+            else:
+                histories[address] = history
+        for start in xrange(0, len(missing), self.batch_size):
+            batch = missing[start:start + self.batch_size]
+            self.rate_limiter.wait()
+            self.requests += 1
+            fetched = self._fetch_histories(batch)
+            for address in batch:
+                histories[address] = fetched.get(address, [])
+                self.cache.put(address, histories[address])
+        return histories
+
+    def history(self, address):
+        return self.history_many([address])[address]
+
+    def unspent_many(self, addresses):
+        return dict((address, [output for output in history if 'spend' not in output])
+                    for address, history in self.history_many(addresses).iteritems())
+
+    def unspent(self, address):
+        return self.unspent_many([address])[address]
+
+    def pushtx(self, tx):
+        """
+        Push a signed transaction with each push strategy in turn, raising
+        the last error if all of them fail.
+        """
+        error = BlockchainError('No pushtx strategy is configured')
+        for strategy in self.push_strategies:
+            try:
+                result = strategy(tx)
+            except Exception, err:
+                error = err
+                continue
+            # Cached histories no longer show the outputs which were spent
+            self.cache.clear()
+            return result
+        raise error
+
+
+def histories_from_txs(txs, addresses):
+    """
+    Build pybitcointools style history lists for each address from
+    blockchain.info transactions, marking the outputs which were spent.
+    """
+    wanted = set(addresses)
+    outs = {}
+    for tx in txs:
+        for out in tx['out']:
+            if out.get('addr') in wanted:
+                outs['%s:%s' % (tx['tx_index'], out['n'])] = {
+                    'address': out['addr'],
+                    'value': out['value'],
+                    'output': '%s:%s' % (tx['hash'], out['n']),
+                    'block_height': tx.get('block_height'),
+                }
+    for tx in txs:
+        for i, tx_input in enumerate(tx['inputs']):
+            prev_out = tx_input.get('prev_out', {})
+            if prev_out.get('addr') in wanted:
+                out = outs.get('%s:%s' % (prev_out['tx_index'], prev_out['n']))
+                if out:
+                    out['spend'] = '%s:%d' % (tx['hash'], i)
+
+    histories = dict((address, []) for address in addresses)
+    for out in outs.itervalues():
+        histories[out['address']].append(out)
+    return histories
+
+
+class BlockchainInfo(ChainBackend):
+    """
+    Address histories from blockchain.info's multiaddr API, which returns
+    the transactions of many addresses per request.
+    """
+    batch_size = 50
+    page_size = 100
+
+    def __init__(self, pool_size=4, push_strategies=None, **kwargs):
+        if push_strategies is None:
+            push_strategies = [PUSH_STRATEGIES[name] for name in DEFAULT_PUSHTX]
+        ChainBackend.__init__(self, push_strategies=push_strategies, **kwargs)
+        self.pool = ConnectionPool('blockchain.info', pool_size)
+
+    def _fetch_histories(self, addresses):
+        txs = []
+        offset = 0
+        while True:
+            if offset:
+                self.rate_limiter.wait()
+            path = '/multiaddr?' + urllib.urlencode({
+                'active': '|'.join(addresses),
+                'n': self.page_size,
+                'offset': offset
+            })
+            try:
+                page = json.loads(self.pool.request(path))['txs']
+            except (ValueError, KeyError):
+                raise BlockchainError('Unable to decode the multiaddr response from blockchain.info')
+            txs.extend(page)
+            if len(page) < self.page_size:
+                return histories_from_txs(txs, addresses)
+            offset += self.page_size
+
+
+class StubBlockchain(ChainBackend):
+    """
+    In-memory blockchain for testing. Outputs are added with add_output() and
+    returned by history() in pybitcointools' format, pushed transactions
+    mark the outputs they spend and are kept in pushed. Each batch lookup
+    sleeps for delay seconds to simulate a network round-trip.
+    """
+    batch_size = 100
+
+    def __init__(self, delay=0.0, **kwargs):
+        kwargs.setdefault('cache_ttl', 0)
+        ChainBackend.__init__(self, push_strategies=[self._push], **kwargs)
+        self.delay = delay
+        self.pushed = []
+        self._outputs = {}
+        self._added = 0
+        self._lock = threading.Lock()
+
+    def add_output(self, address, value, tx_hash=None, index=0):
+        """Add an unspent output paying value to address and return its outpoint"""
+        with self._lock:
+            self._added += 1
+            # Addresses read from the database are unicode, hash a byte string
+            tx_hash = tx_hash or bitcoin.sha256(('%s:%d:%d' % (address, value, self._added)).encode('utf-8'))
+            self._outputs.setdefault(address, []).append({
+                'address': address,
+                'value': value,
+                'output': '%s:%d' % (tx_hash, index),
+                'block_height': None,
+            })
+        return '%s:%d' % (tx_hash, index)
+
+    def _fetch_histories(self, addresses):
+        time.sleep(self.delay)
+        with self._lock:
+            return dict((address, [dict(output) for output in self._outputs.get(address, [])])
+                        for address in addresses)
+
+    def _push(self, tx):
+        tx_hash = bitcoin.txhash(tx)
+        spent = set('%s:%d' % (tx_input['outpoint']['hash'], tx_input['outpoint']['index'])
+                    for tx_input in bitcoin.deserialize(tx)['ins'])
+        with self._lock:
+            for outputs in self._outputs.itervalues():
+                for output in outputs:
+                    if output['output'] in spent:
+                        output['spend'] = '%s:0' % tx_hash
+            self.pushed.append(tx)
+        return 'Transaction Submitted'
+
+
+def create_backend(config):
+    """
+    Create the backend selected by the BLOCKCHAIN_* settings in config.
+    """
+    name = config.get('BLOCKCHAIN_BACKEND', 'blockchain.info')
+    options = {
+        'rate': config.get('BLOCKCHAIN_RATE_LIMIT'),
+        'cache_ttl': config.get('BLOCKCHAIN_CACHE_TTL', 10),
+    }
+    if name == 'blockchain.info':
+        return BlockchainInfo(
+            pool_size=config.get('BLOCKCHAIN_POOL_SIZE', 4),
+            push_strategies=[PUSH_STRATEGIES[strategy]
+                             for strategy in config.get('BLOCKCHAIN_PUSHTX', DEFAULT_PUSHTX)],
+            **options)
+    elif name == 'stub':
+        options['cache_ttl'] = config.get('BLOCKCHAIN_CACHE_TTL', 0)
+        return StubBlockchain(**options)
+    raise ValueError('Unknown blockchain backend %r' % name)
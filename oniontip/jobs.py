@@ -0,0 +1,109 @@
+"""
+Background workers forwarding donations outside of the request cycle.
+
+/forward/<address> queues a ForwardJob and returns straight away. Worker
+threads in each web process claim queued jobs from the database, run the
+forwarding handler and store its result as JSON for /forward/job/<id>.
+Workers are woken as soon as a job is queued in the same process and poll
+the database for jobs queued by other processes.
+"""
+import json
+import threading
+import time
+
+from oniontip import app, db
+from oniontip.models import ForwardJob
+
+
+class ForwardWorkers(object):
+    def __init__(self, handler, workers=2, poll_interval=5, job_timeout=300):
+        self.handler = handler
+        self.workers = workers
+        self.poll_interval = poll_interval
+        self.job_timeout = job_timeout
+        self.processed = 0
+        self.failed = 0
+        self._last_expiry = 0
+        self._queued = threading.Condition()
+        self._finished = threading.Condition()
+        self._threads = []
+        self._lock = threading.Lock()
+
+    def start(self):
+        with self._lock:
+            while len(self._threads) < self.workers:
+                thread = threading.Thread(target=self._run, name='forward-worker-%d' % len(self._threads))
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+
+    def enqueue(self, address):
+        job = ForwardJob.enqueue(address)
+        with self._queued:
+            self._queued.notify()
+        return job
+
+    def wait(self, job_id, timeout):
+        """
+        Return job job_id once it has finished, or as it is after timeout
+        seconds. Jobs finished by workers in other processes are noticed
+        within a second.
+        """
+        deadline = time.time() + timeout
+        while True:
+            # End the transaction so the job is read afresh
+            db.session.rollback()
+            job = ForwardJob.query.get(job_id)
+            remaining = deadline - time.time()
+            if job is None or job.state == ForwardJob.DONE or remaining <= 0:
+                return job
+            with self._finished:
+                self._finished.wait(min(remaining, 1.0))
+
+    def _run(self):
+        while True:
+            try:
+                with app.app_context():
+                    if not self._process_one():
+                        with self._queued:
+                            self._queued.wait(self.poll_interval)
+            except Exception:
+                app.logger.exception('Forward worker failed')
+                time.sleep(self.poll_interval)
+            finally:
+                db.session.remove()
+
+    def _process_one(self):
+        if time.time() - self._last_expiry > 60:
+            self._last_expiry = time.time()
+            ForwardJob.expire_stale(self.job_timeout, json.dumps({
+                'status': 'error',
+                'message': 'Forwarding took too long, please try again.'
+                }))
+        job = ForwardJob.claim()
+        if job is None:
+            return False
+        address = job.address
+        try:
+            result = self.handler(address)
+        except Exception, err:
+            app.logger.exception('Unable to forward the donations to {}'.format(address))
+            self.failed += 1
+            result = {'status': 'error',
+                      'message': 'There was an unknown error when forwarding the donation: {}'.format(err)}
+        # The handler may have left the session in a failed transaction
+        db.session.rollback()
+        job.finish(json.dumps(result))
+        self.processed += 1
+        with self._finished:
+            self._finished.notify_all()
+        return True
+
+    def stats(self):
+        return {
+            'workers': len(self._threads),
+            'queued': ForwardJob.query.filter_by(state=ForwardJob.QUEUED).count(),
+            'running': ForwardJob.query.filter_by(state=ForwardJob.RUNNING).count(),
+            'processed': self.processed,
+            'failed': self.failed
+            }
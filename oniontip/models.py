@@ -1,34 +1,315 @@
 from oniontip import db
 from flask import current_app
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.schema import CreateTable
 import bitcoin
 import datetime
+import hashlib
+import uuid
 
 class ForwardAddress(db.Model):
-    __table_args__ = {'sqlite_autoincrement': True} # Make sure id's aren't reused
+    __table_args__ = (
+        # Serves the recent unspent address checks
+        db.Index('ix_forward_address_spent_created', 'spent', 'created'),
+        # Serves the spent transaction listings, newest id first
+        db.Index('ix_forward_address_spent_id', 'spent', 'id'),
+        {'sqlite_autoincrement': True} # Make sure id's aren't reused
+    )
 
     id = db.Column(db.Integer, primary_key=True)
     private_key = db.Column(db.String(80), unique=True)
     public_key = db.Column(db.String(80), unique=True)
     address = db.Column(db.String(80), unique=True)
-    outputs = db.Column(db.PickleType, nullable=False)
     created = db.Column(db.DateTime)
     spent = db.Column(db.Boolean, default=False)
     spending_tx = db.Column(db.String(80))
     donation_amount = db.Column(db.Integer)
+    key_index = db.Column(db.Integer, unique=True)
+    num_outputs = db.Column(db.Integer)
+    lease_owner = db.Column(db.String(32))
+    lease_expires = db.Column(db.DateTime)
+    forward_outputs = db.relationship('ForwardOutput', backref='forward_address',
+                                      cascade='all, delete-orphan')
 
-    def __init__(self, private_key=None, outputs=None, previous_n=0):
-        if not private_key:
-            self.private_key = bitcoin.electrum_privkey(current_app.config.get('BITCOIN_KEY_SEED'), previous_n+1)
+    def __init__(self, private_key=None, outputs=None, previous_n=0, key_slot=None):
+        if key_slot:
+            # Keys were derived ahead of time by KeySlot.fill()
+            self.key_index = key_slot.key_index
+            self.private_key = key_slot.private_key
+            self.public_key = key_slot.public_key
+            self.address = key_slot.address
         else:
-            self.private_key = private_key
-        self.public_key = bitcoin.privtopub(self.private_key)
-        self.address = bitcoin.pubtoaddr(self.public_key)
+            if not private_key:
+                self.key_index = previous_n+1
+                self.private_key = bitcoin.electrum_privkey(current_app.config.get('BITCOIN_KEY_SEED'), self.key_index)
+            else:
+                self.private_key = private_key
+            self.public_key = bitcoin.privtopub(self.private_key)
+            self.address = bitcoin.pubtoaddr(self.public_key)
         self.outputs = outputs
+        self.num_outputs = len(outputs) if outputs is not None else None
         self.created = datetime.datetime.utcnow()
 
     def __unicode__(self):
         return self.address
 
+    @property
+    def outputs(self):
+        """Donation percent for each relay bitcoin address"""
+        return dict((output.address, output.donation_percent) for output in self.forward_outputs)
+
+    @outputs.setter
+    def outputs(self, outputs):
+        self.forward_outputs = [ForwardOutput(address, donation_percent)
+                                for address, donation_percent in (outputs or {}).iteritems()]
+
+    @classmethod
+    def acquire_lease(cls, address, timeout):
+        """
+        Take the lease on forwarding from address for timeout seconds. Returns
+        the lease owner token, or None if another worker holds the lease.
+        """
+        owner = uuid.uuid4().hex
+        now = datetime.datetime.utcnow()
+        leased = cls.query.filter(cls.address == address,
+                                  db.or_(cls.lease_expires == None, cls.lease_expires < now)) \
+            .update({'lease_owner': owner, 'lease_expires': now + datetime.timedelta(seconds=timeout)},
+                    synchronize_session=False)
+        db.session.commit()
+        return owner if leased else None
+
+    @classmethod
+    def release_lease(cls, address, owner):
+        # Anything left uncommitted belongs to a failed forward
+        db.session.rollback()
+        cls.query.filter_by(address=address, lease_owner=owner) \
+            .update({'lease_owner': None, 'lease_expires': None}, synchronize_session=False)
+        db.session.commit()
+
+class ForwardOutput(db.Model):
+    """
+    Relay bitcoin address paid by a ForwardAddress. value is the satoshi
+    forwarded to it, set once the forwarding transaction has been pushed.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    forward_address_id = db.Column(db.Integer, db.ForeignKey('forward_address.id'), nullable=False, index=True)
+    address = db.Column(db.String(80), nullable=False, index=True)
+    donation_percent = db.Column(db.Float, nullable=False)
+    value = db.Column(db.Integer)
+
+    def __init__(self, address, donation_percent):
+        self.address = address
+        self.donation_percent = donation_percent
+
+    def __unicode__(self):
+        return self.address
+
+class ForwardTransaction(db.Model):
+    """
+    Forwarding transaction signed for a set of unspent outputs. outpoints
+    identifies the outputs it spends, so a retried or concurrent forward of
+    the same outputs reuses it rather than signing, pushing or counting the
+    donation again.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    outpoints = db.Column(db.String(64), unique=True, nullable=False)
+    address = db.Column(db.String(80), nullable=False, index=True)
+    tx_hash = db.Column(db.String(80), nullable=False)
+    tx = db.Column(db.Text, nullable=False)
+    value = db.Column(db.Integer, nullable=False)
+    pushed = db.Column(db.Boolean, default=False, nullable=False)
+    created = db.Column(db.DateTime)
+
+    def __init__(self, outpoints, address, tx, value):
+        self.outpoints = outpoints
+        self.address = address
+        self.tx = str(tx)
+        self.tx_hash = bitcoin.txhash(self.tx)
+        self.value = value
+        self.pushed = False
+        self.created = datetime.datetime.utcnow()
+
+    def __unicode__(self):
+        return self.tx_hash
+
+    @staticmethod
+    def outpoints_key(unspent):
+        return hashlib.sha256(','.join(sorted(output['output'] for output in unspent))).hexdigest()
+
+    @classmethod
+    def record(cls, outpoints, address, tx, value):
+        """Store tx as the transaction spending outpoints, unless one already was"""
+        forward_tx = cls(outpoints, address, tx, value)
+        db.session.add(forward_tx)
+        try:
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            forward_tx = cls.query.filter_by(outpoints=outpoints).one()
+        return forward_tx
+
+def payout_report(limit=None):
+    """
+    Total satoshi forwarded to each relay bitcoin address and the number of
+    donations it was paid from, largest first.
+    """
+    total = db.func.sum(ForwardOutput.value)
+    query = db.session.query(ForwardOutput.address, total, db.func.count(ForwardOutput.id)) \
+        .join(ForwardAddress).filter(ForwardAddress.spent == True, ForwardOutput.value > 0) \
+        .group_by(ForwardOutput.address).order_by(total.desc())
+    if limit:
+        query = query.limit(limit)
+    return query.all()
+
+class KeySlot(db.Model):
+    """
+    Keypair derived from the seed ahead of time so creating a ForwardAddress
+    doesn't do any elliptic curve math on the request path.
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    key_index = db.Column(db.Integer, unique=True, nullable=False)
+    private_key = db.Column(db.String(80), unique=True)
+    public_key = db.Column(db.String(80), unique=True)
+    address = db.Column(db.String(80), unique=True)
+    claimed = db.Column(db.Boolean, default=False, nullable=False, index=True)
+
+    def __init__(self, seed, key_index):
+        self.key_index = key_index
+        self.private_key = bitcoin.electrum_privkey(seed, key_index)
+        self.public_key = bitcoin.privtopub(self.private_key)
+        self.address = bitcoin.pubtoaddr(self.public_key)
+        self.claimed = False
+
+    def __unicode__(self):
+        return self.address
+
+    @classmethod
+    def available(cls):
+        return cls.query.filter_by(claimed=False).count()
+
+    @classmethod
+    def next_index(cls):
+        """First key index not used by a slot or a forwarding address"""
+        used = [db.session.query(db.func.max(cls.key_index)).scalar(),
+                db.session.query(db.func.max(ForwardAddress.key_index)).scalar(),
+                # Addresses created before key_index was stored used their id
+                db.session.query(db.func.max(ForwardAddress.id)).scalar()]
+        return max(index or 0 for index in used) + 1
+
+    @classmethod
+    def fill(cls, seed, count, retries=10):
+        """
+        Derive count new slots after the highest key index in use. If another
+        process filled the same indices first the slots are derived again
+        after the ones it added, up to retries times. Returns the number
+        added, 0 if every try collided.
+        """
+        for attempt in range(retries + 1):
+            start = cls.next_index()
+            db.session.add_all([cls(seed, key_index) for key_index in range(start, start + count)])
+            try:
+                db.session.commit()
+                return count
+            except IntegrityError:
+                db.session.rollback()
+        return 0
+
+    @classmethod
+    def claim(cls):
+        """
+        Atomically claim the lowest unclaimed slot, or return None if the pool
+        is empty. The conditional UPDATE only matches if no concurrent request
+        claimed the slot between the SELECT and the UPDATE.
+        """
+        while True:
+            slot = cls.query.filter_by(claimed=False).order_by(cls.key_index).first()
+            if slot is None:
+                return None
+            claimed = cls.query.filter_by(id=slot.id, claimed=False) \
+                .update({'claimed': True}, synchronize_session=False)
+            if claimed:
+                db.session.expire(slot, ['claimed'])
+                return slot
+            db.session.rollback()
+
+class ForwardJob(db.Model):
+    """
+    Request to forward the donations received by a ForwardAddress, processed
+    by the ForwardWorkers. active_address is only set while the job is queued
+    or running, its unique constraint allows one unfinished job per address.
+    """
+    QUEUED, RUNNING, DONE = 'queued', 'running', 'done'
+
+    id = db.Column(db.Integer, primary_key=True)
+    address = db.Column(db.String(80), nullable=False, index=True)
+    active_address = db.Column(db.String(80), unique=True)
+    state = db.Column(db.String(10), nullable=False, index=True)
+    result = db.Column(db.Text)
+    created = db.Column(db.DateTime)
+    updated = db.Column(db.DateTime)
+
+    def __init__(self, address):
+        self.address = address
+        self.active_address = address
+        self.state = self.QUEUED
+        self.created = self.updated = datetime.datetime.utcnow()
+
+    def __unicode__(self):
+        return self.address
+
+    @classmethod
+    def enqueue(cls, address):
+        """
+        Queue a job for address, or return the job which is already queued or
+        running for it so a double-click doesn't forward twice.
+        """
+        while True:
+            job = cls.query.filter_by(active_address=address).first()
+            if job:
+                return job
+            job = cls(address)
+            db.session.add(job)
+            try:
+                db.session.commit()
+                return job
+            except IntegrityError:
+                # A concurrent request queued one first
+                db.session.rollback()
+
+    @classmethod
+    def claim(cls):
+        """
+        Atomically move the oldest queued job to running and return it, or
+        return None if no jobs are queued.
+        """
+        while True:
+            job = cls.query.filter_by(state=cls.QUEUED).order_by(cls.id).first()
+            if job is None:
+                return None
+            claimed = cls.query.filter_by(id=job.id, state=cls.QUEUED) \
+                .update({'state': cls.RUNNING, 'updated': datetime.datetime.utcnow()},
+                        synchronize_session=False)
+            db.session.commit()
+            if claimed:
+                return job
+
+    @classmethod
+    def expire_stale(cls, timeout, result):
+        """Finish jobs left running for longer than timeout seconds, eg. by a killed worker"""
+        stale = cls.query.filter(cls.state == cls.RUNNING,
+                                 cls.updated < datetime.datetime.utcnow() - datetime.timedelta(seconds=timeout))
+        count = stale.update({'state': cls.DONE, 'active_address': None, 'result': result,
+                              'updated': datetime.datetime.utcnow()}, synchronize_session=False)
+        db.session.commit()
+        return count
+
+    def finish(self, result):
+        self.state = self.DONE
+        self.active_address = None
+        self.result = result
+        self.updated = datetime.datetime.utcnow()
+        db.session.commit()
+
 class DataStore(db.Model):
     """Simple Key/value data store instead of using flat file"""
     id = db.Column(db.Integer, primary_key=True)
@@ -39,5 +320,108 @@ class DataStore(db.Model):
         self.key = key
         self.value = value
 
+    @classmethod
+    def setdefault(cls, key, value):
+        if not cls.query.filter_by(key=key).count():
+            db.session.add(cls(key, value))
+            try:
+                db.session.commit()
+            except IntegrityError:
+                db.session.rollback()
+
+    @classmethod
+    def increment(cls, key, amount):
+        """Add amount to an integer value with a single UPDATE instead of a read-modify-write"""
+        return cls.query.filter_by(key=key).update(
+            {'value': db.cast(db.cast(cls.value, db.Integer) + amount, cls.value.type)},
+            synchronize_session=False)
+
     def __unicode__(self):
-        return (self.key, self.value)
\ No newline at end of file
+        return (self.key, self.value)
+
+def upgrade_schema():
+    """
+    Create missing tables, add the ForwardAddress columns introduced since
+    the database was created and move pickled outputs to ForwardOutput.
+    Returns a list of the changes made.
+    """
+    db.create_all()
+    table = ForwardAddress.__table__
+    existing = set(column['name'] for column in db.inspect(db.engine).get_columns(table.name))
+    changes = []
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        db.engine.execute('ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name, column.type.compile(db.engine.dialect)))
+        if column.unique:
+            # SQLite can't add a UNIQUE column, a unique index enforces the same
+            db.engine.execute('CREATE UNIQUE INDEX uq_{0}_{1} ON {0} ({1})'.format(table.name, column.name))
+        changes.append('added column {}'.format(column.name))
+
+    if 'outputs' in existing:
+        changes.append('moved {} pickled outputs to {}'.format(
+            migrate_pickled_outputs(), ForwardOutput.__tablename__))
+
+    db.engine.execute(table.update().where(table.c.num_outputs == None).values(
+        num_outputs=db.select([db.func.count(ForwardOutput.id)])
+            .where(ForwardOutput.forward_address_id == table.c.id).as_scalar()))
+
+    inspector = db.inspect(db.engine)
+    for model_table in db.metadata.sorted_tables:
+        indexes = set(index['name'] for index in inspector.get_indexes(model_table.name))
+        for index in model_table.indexes:
+            if index.name not in indexes:
+                index.create(db.engine)
+                changes.append('created index {}'.format(index.name))
+    return changes
+
+def migrate_pickled_outputs():
+    """
+    Copy the outputs pickled in forward_address.outputs to forward_output
+    rows and drop the column. Spent rows get the value their share of
+    donation_amount would have been, before any outputs below the dust limit
+    were redistributed. Addresses which already have forward_output rows,
+    copied by an earlier run which failed before the column was dropped, are
+    skipped so running the migration again doesn't duplicate them.
+    """
+    table = ForwardAddress.__table__
+    legacy = db.Table(table.name, db.MetaData(),
+                      db.Column('id', db.Integer), db.Column('spent', db.Boolean),
+                      db.Column('donation_amount', db.Integer), db.Column('outputs', db.PickleType))
+    with db.engine.begin() as connection:
+        migrated = set(row[0] for row in connection.execute(
+            db.select([ForwardOutput.forward_address_id]).distinct()))
+        rows = []
+        for forward_address in connection.execute(legacy.select()):
+            if forward_address.id in migrated:
+                continue
+            for address, donation_percent in (forward_address.outputs or {}).iteritems():
+                rows.append({
+                    'forward_address_id': forward_address.id,
+                    'address': address,
+                    'donation_percent': donation_percent,
+                    'value': int(forward_address.donation_amount * donation_percent * 0.01)
+                             if forward_address.spent and forward_address.donation_amount else None
+                })
+        if rows:
+            connection.execute(ForwardOutput.__table__.insert(), rows)
+
+        if db.engine.dialect.name != 'sqlite':
+            connection.execute('ALTER TABLE {} DROP COLUMN outputs'.format(table.name))
+            return len(rows)
+
+        # SQLite can't drop columns, copy the table to one without it. The copy is
+        # renamed rather than the original so forward_output's foreign key still
+        # refers to forward_address. pysqlite commits before each DDL statement,
+        # a copy left behind by a failed run is dropped first.
+        columns = ', '.join(column.name for column in table.columns)
+        ddl = unicode(CreateTable(table).compile(db.engine))
+        connection.execute('DROP TABLE IF EXISTS {}_new'.format(table.name))
+        connection.execute(ddl.replace(table.name, table.name + '_new', 1))
+        connection.execute('INSERT INTO {0}_new ({1}) SELECT {1} FROM {0}'.format(table.name, columns))
+        connection.execute('DROP TABLE {}'.format(table.name))
+        connection.execute('ALTER TABLE {0}_new RENAME TO {0}'.format(table.name))
+        for index in table.indexes:
+            index.create(connection)
+    return len(rows)
@@ -0,0 +1,662 @@
+"""
+Pre-parsed, process-wide view of the relays listed in details.json.
+
+A snapshot is built once each time details.json changes and is then shared
+read-only by every request, so handlers only have to select from it.
+
+`main.py --download` also writes each snapshot in a compact binary form
+(details.snapshot) which web workers memory-map instead of parsing JSON:
+
+    magic | uint32 header length | JSON header | columns | string table
+
+The header lists every column with its dtype, offset and length. Numeric
+columns are fixed width, string columns are uint32 offset arrays into a
+single UTF-8 string table.
+
+Between full rewrites of details.json `--download` records what changed
+since the previous snapshot as a numbered delta file in details.deltas/
+and rewrites details.snapshot, which web workers map again. The deltas are
+only applied when details.snapshot is missing or out of date.
+"""
+import json
+import logging
+import mmap
+import os
+import re
+import struct
+import tempfile
+
+import numpy
+
+logger = logging.getLogger(__name__)
+
+# Onionoo weight fractions and the percentage attribute they map to
+WEIGHT_FIELDS = [
+    ('consensus_weight_fraction', 'cw'),
+    ('advertised_bandwidth_fraction', 'adv_bw'),
+    ('guard_probability', 'p_guard'),
+    ('middle_probability', 'p_middle'),
+    ('exit_probability', 'p_exit'),
+]
+
+# Bit assigned to each relay flag in RelayTable.flags
+FLAG_BITS = dict((flag, 1 << bit) for bit, flag in enumerate([
+    'Authority', 'BadExit', 'Exit', 'Fast', 'Guard', 'HSDir',
+    'Named', 'Running', 'Stable', 'Unnamed', 'V2Dir', 'Valid']))
+
+SNAPSHOT_MAGIC = 'OTSNAP\x00\x04'
+
+# Relay attributes kept in the string table of a binary snapshot
+STRING_FIELDS = ['fingerprint', 'nickname', 'primary_ip', 'as_name', 'bitcoin_address']
+
+
+class Relay(object):
+    """
+    A normalized relay record. Flags are a frozenset, the country code is
+    lowercase, the primary IP is parsed out of or_addresses and the weight
+    fractions are also available as percentages.
+    """
+    __slots__ = ('fingerprint', 'nickname', 'running', 'flags', 'exit', 'guard',
+                 'family', 'country', 'primary_ip', 'as_number', 'as_name', 'bitcoin_address',
+                 'consensus_weight_fraction', 'advertised_bandwidth_fraction',
+                 'guard_probability', 'middle_probability', 'exit_probability',
+                 'cw', 'adv_bw', 'p_guard', 'p_middle', 'p_exit')
+
+    def __init__(self, details):
+        self.fingerprint = details.get('fingerprint')
+        self.nickname = details.get('nickname')
+        self.running = details.get('running', False)
+        self._set_flags(details.get('flags', []))
+        self.family = tuple(details.get('family', []))
+        self.country = details.get('country', '??').lower()
+        self.primary_ip = details.get('or_addresses', ['??:0'])[0].split(':')[0]
+        self.as_number = details.get('as_number', '??')
+        self.as_name = details.get('as_name', '??')
+        self.bitcoin_address = details.get('bitcoin_address', '')
+
+        # Raw fractions keep Onionoo's -1 for "unknown" so filters can reject
+        # them, the percentages treat missing values as zero.
+        for field, percent in WEIGHT_FIELDS:
+            setattr(self, field, details.get(field, -1.0))
+            setattr(self, percent, details.get(field, 0) * 100.0)
+
+    def _set_flags(self, flags):
+        self.flags = frozenset(flags)
+        self.exit = 'Exit' in self.flags and not 'BadExit' in self.flags
+        self.guard = 'Guard' in self.flags
+
+    def to_details(self):
+        """
+        Return this relay as an Onionoo style details dict.
+        """
+        details = {
+            'fingerprint': self.fingerprint,
+            'nickname': self.nickname,
+            'running': self.running,
+            'flags': sorted(self.flags),
+            'family': list(self.family),
+            'country': self.country,
+            'or_addresses': [self.primary_ip],
+            'as_number': self.as_number,
+            'as_name': self.as_name,
+            'bitcoin_address': self.bitcoin_address,
+        }
+        for field, _ in WEIGHT_FIELDS:
+            if getattr(self, field) >= 0.0:
+                details[field] = getattr(self, field)
+        return details
+
+
+def network_family(primary_ip):
+    """
+    Return the /16 network of an IPv4 address, which relays are grouped by.
+    """
+    match = re.match(r'^([0-9]+\.[0-9]+)\.', primary_ip)
+    return '%s.0.0/16' % match.group(1) if match else '??'
+
+
+def _encode(values):
+    """
+    Return the distinct values and an integer code array with one entry per
+    row.
+    """
+    labels = sorted(set(values))
+    ids = dict((label, code) for code, label in enumerate(labels))
+    return labels, numpy.fromiter((ids[value] for value in values), numpy.int32, len(values))
+
+
+class RelayTable(object):
+    """
+    Columnar view of a list of Relay records, row i describes relays[i].
+
+    Weights are float64 arrays (raw fractions and percentages), flags are a
+    bit field using FLAG_BITS and the country, AS and /16 network columns are
+    integer codes into the countries, as_numbers and networks lists.
+    """
+    NUMERIC_COLUMNS = ([field for field, _ in WEIGHT_FIELDS] +
+                       [percent for _, percent in WEIGHT_FIELDS] +
+                       ['running', 'flags', 'country', 'as_number', 'network'])
+
+    def __init__(self, columns, countries, as_numbers, networks):
+        for name in RelayTable.NUMERIC_COLUMNS:
+            setattr(self, name, columns[name])
+        self.countries = countries
+        self.country_ids = dict((label, code) for code, label in enumerate(countries))
+        self.as_numbers = as_numbers
+        self.as_ids = dict((label, code) for code, label in enumerate(as_numbers))
+        self.networks = networks
+
+    @classmethod
+    def from_relays(cls, relays):
+        count = len(relays)
+
+        def column(attr, dtype):
+            return numpy.fromiter((getattr(relay, attr) for relay in relays), dtype, count)
+
+        columns = {}
+        for field, percent in WEIGHT_FIELDS:
+            columns[field] = column(field, numpy.float64)
+            columns[percent] = column(percent, numpy.float64)
+        columns['running'] = column('running', numpy.bool_)
+        columns['flags'] = numpy.fromiter(
+            (sum(FLAG_BITS.get(flag, 0) for flag in relay.flags) for relay in relays),
+            numpy.uint16, count)
+        countries, columns['country'] = _encode([relay.country for relay in relays])
+        as_numbers, columns['as_number'] = _encode([relay.as_number for relay in relays])
+        networks, columns['network'] = _encode([network_family(relay.primary_ip) for relay in relays])
+        return cls(columns, countries, as_numbers, networks)
+
+    def __len__(self):
+        return len(self.running)
+
+    def has_flag(self, flag):
+        return (self.flags & FLAG_BITS[flag]) != 0
+
+
+def _group_rows(codes, labels):
+    """
+    Map each label to the sorted array of rows whose code refers to it.
+    """
+    order = numpy.argsort(codes, kind='mergesort')
+    counts = numpy.bincount(codes, minlength=len(labels))
+    ends = numpy.cumsum(counts)
+    starts = ends - counts
+    return dict((label, order[start:end]) for label, start, end in zip(labels, starts, ends))
+
+
+class RelayIndex(object):
+    """
+    Secondary indexes built when a snapshot is loaded. Each set of relays is
+    a sorted array of row ids, so filters can be combined by intersecting
+    them instead of scanning every relay.
+    """
+    def __init__(self, table, fingerprints, nicknames):
+        self.running = numpy.flatnonzero(table.running)
+        # Same selections as ExitFilter, GuardFilter and ValidWeightFilter
+        self.exits = numpy.flatnonzero(table.exit_probability > 0.0)
+        self.guards = numpy.flatnonzero(table.guard_probability > 0.0)
+        self.valid_weights = numpy.flatnonzero((table.consensus_weight_fraction >= 0.0)
+                                               & (table.guard_probability >= 0.0)
+                                               & (table.exit_probability >= 0.0))
+        self.countries = _group_rows(table.country, table.countries)
+        self.as_numbers = _group_rows(table.as_number, table.as_numbers)
+        self.fingerprints = dict((fingerprint, row) for row, fingerprint in enumerate(fingerprints))
+        self.named = dict((nicknames[row], row) for row in numpy.flatnonzero(table.has_flag('Named')))
+
+    def rows(self, index, keys):
+        """
+        Return the sorted rows of every key in one of the keyed indexes. Each
+        row is returned once however often its key is repeated.
+        """
+        groups = [index[key] for key in set(keys) if key in index]
+        if not groups:
+            return numpy.zeros(0, dtype=numpy.intp)
+        return numpy.sort(numpy.concatenate(groups))
+
+
+class RelaySnapshot(object):
+    """
+    Immutable collection of Relay records loaded from a details document,
+    together with their columnar RelayTable and RelayIndex.
+    """
+    def __init__(self, relays_published, mtime, relays, table):
+        self.relays_published = relays_published
+        self.mtime = mtime
+        self.relays = relays
+        self.table = table
+        # details.json this snapshot was built from and the last delta
+        # applied on top of it, as recorded by write_binary
+        self.base_mtime = mtime
+        self.last_delta = None
+        # JSON encoding of the relay fields of each row, filled by RelayRows
+        self.fragments = {}
+        self.index = RelayIndex(table, self.string_column('fingerprint'), self.string_column('nickname'))
+
+    def __len__(self):
+        return len(self.relays)
+
+    def string_column(self, field):
+        """
+        Return one string attribute of every relay, without building the
+        Relay records of a binary snapshot.
+        """
+        if isinstance(self.relays, LazyRelays):
+            return self.relays.column(field)
+        return [getattr(relay, field) for relay in self.relays]
+
+    def select(self, rows):
+        """
+        Return the Relay records at rows, a list of row numbers. Records of
+        a binary snapshot are built together instead of one by one.
+        """
+        if isinstance(self.relays, LazyRelays):
+            return self.relays.select(rows)
+        return [self.relays[row] for row in rows]
+
+    @property
+    def version(self):
+        """
+        Identifies the data this snapshot was built from.
+        """
+        return '%s/%d' % (self.relays_published, self.mtime or 0)
+
+    @classmethod
+    def from_details(cls, details, mtime=None):
+        relays = tuple(Relay(relay) for relay in details.get('relays', []))
+        return cls(details.get('relays_published'), mtime, relays, RelayTable.from_relays(relays))
+
+    @classmethod
+    def from_file(cls, path):
+        mtime = os.stat(path).st_mtime
+        with open(path) as details_file:
+            return cls.from_details(json.load(details_file), mtime)
+
+    @classmethod
+    def from_binary(cls, path):
+        """
+        Memory-map a snapshot written by write_binary. Columns are read-only
+        views of the mapped file, shared with every other process mapping it,
+        and Relay records are only built for the rows which are accessed.
+        """
+        with open(path, 'rb') as snapshot_file:
+            buf = mmap.mmap(snapshot_file.fileno(), 0, access=mmap.ACCESS_READ)
+        header_start = len(SNAPSHOT_MAGIC) + 4
+        if buf[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+            raise ValueError('%s is not a relay snapshot' % path)
+        header_length, = struct.unpack('<I', buf[len(SNAPSHOT_MAGIC):header_start])
+        header = json.loads(buf[header_start:header_start + header_length])
+        data_start = _align(header_start + header_length)
+
+        columns = {}
+        for name, (dtype, offset, count) in header['columns'].iteritems():
+            if count:
+                columns[name] = numpy.frombuffer(buf, dtype=dtype, count=count,
+                                                 offset=data_start + offset)
+            else:
+                columns[name] = numpy.zeros(0, dtype=dtype)
+        strings = StringTable(buf, data_start + header['strings'], columns)
+
+        table = RelayTable(columns, strings.column('countries'), strings.column('as_numbers'),
+                           strings.column('networks'))
+        relays = LazyRelays(table, strings, header['count'])
+        snapshot = cls(header['relays_published'], header['mtime'], relays, table)
+        snapshot.base_mtime = header['base_mtime']
+        snapshot.last_delta = header['last_delta']
+        return snapshot
+
+    def diff(self, previous):
+        """
+        Return the delta which turns the previous snapshot into this one: the
+        relays added with their position, the fingerprints removed and the
+        changed fields of every other relay. Fields which were dropped are
+        recorded as None.
+        """
+        old = dict((relay.fingerprint, relay.to_details()) for relay in previous.relays)
+        fingerprints = [relay.fingerprint for relay in self.relays]
+        current = set(fingerprints)
+
+        added = []
+        changed = {}
+        for index, relay in enumerate(self.relays):
+            details = relay.to_details()
+            before = old.get(relay.fingerprint)
+            if before is None:
+                added.append([index, details])
+            elif details != before:
+                changed[relay.fingerprint] = dict(
+                    (field, details.get(field)) for field in set(details) | set(before)
+                    if details.get(field) != before.get(field))
+
+        delta = {
+            'base_version': previous.version,
+            'version': self.version,
+            'relays_published': self.relays_published,
+            'mtime': self.mtime,
+            'added': added,
+            'removed': [relay.fingerprint for relay in previous.relays
+                        if relay.fingerprint not in current],
+            'changed': changed,
+        }
+        # Positions of added relays are only enough when the remaining relays
+        # kept their relative order
+        if ([fingerprint for fingerprint in fingerprints if fingerprint in old] !=
+                [relay.fingerprint for relay in previous.relays if relay.fingerprint in current]):
+            delta['order'] = fingerprints
+        return delta
+
+    def apply_delta(self, delta):
+        """
+        Return a new snapshot with delta applied. Unchanged Relay records are
+        shared with this snapshot, only added and changed relays are rebuilt.
+        """
+        if delta['base_version'] != self.version:
+            raise ValueError('Delta for %s cannot be applied to %s' % (delta['base_version'], self.version))
+        removed = set(delta['removed'])
+        changed = delta['changed']
+
+        relays = []
+        for relay in self.relays:
+            if relay.fingerprint in removed:
+                continue
+            if relay.fingerprint in changed:
+                details = relay.to_details()
+                for field, value in changed[relay.fingerprint].iteritems():
+                    if value is None:
+                        details.pop(field, None)
+                    else:
+                        details[field] = value
+                relay = Relay(details)
+            relays.append(relay)
+
+        if 'order' in delta:
+            by_fingerprint = dict((relay.fingerprint, relay) for relay in relays)
+            for _, details in delta['added']:
+                by_fingerprint[details['fingerprint']] = Relay(details)
+            relays = [by_fingerprint[fingerprint] for fingerprint in delta['order']]
+        else:
+            for index, details in delta['added']:
+                relays.insert(index, Relay(details))
+
+        relays = tuple(relays)
+        return RelaySnapshot(delta['relays_published'], delta['mtime'], relays, RelayTable.from_relays(relays))
+
+    def to_details(self):
+        return {
+            'relays_published': self.relays_published,
+            'relays': [relay.to_details() for relay in self.relays]
+        }
+
+    def write_binary(self, path, base_mtime=None, last_delta=None):
+        """
+        Atomically write this snapshot to path in the binary snapshot format.
+        base_mtime is the mtime of the details.json it was built from and
+        last_delta the name of the last delta file it includes, if any.
+        """
+        string_columns = dict((field, [getattr(relay, field) for relay in self.relays])
+                              for field in STRING_FIELDS)
+        string_columns['flag_names'] = [' '.join(sorted(relay.flags)) for relay in self.relays]
+        string_columns['family_members'] = [' '.join(relay.family) for relay in self.relays]
+        string_columns['countries'] = self.table.countries
+        string_columns['as_numbers'] = self.table.as_numbers
+        string_columns['networks'] = self.table.networks
+
+        layout = {}
+        blocks = []
+        size = 0
+        for name in RelayTable.NUMERIC_COLUMNS:
+            column = getattr(self.table, name)
+            column = column.astype(column.dtype.newbyteorder('<'))
+            layout[name] = [column.dtype.str, size, len(column)]
+            blocks.append(column.tostring())
+            size = _align(size + column.nbytes)
+
+        string_table = []
+        string_size = 0
+        for name, values in sorted(string_columns.iteritems()):
+            offsets = [string_size]
+            for value in values:
+                encoded = (value or u'').encode('utf-8')
+                string_table.append(encoded)
+                string_size += len(encoded)
+                offsets.append(string_size)
+            column = numpy.array(offsets, dtype='<u4')
+            layout[name] = [column.dtype.str, size, len(column)]
+            blocks.append(column.tostring())
+            size = _align(size + column.nbytes)
+
+        header = json.dumps({
+            'count': len(self),
+            'relays_published': self.relays_published,
+            'mtime': self.mtime,
+            'base_mtime': self.mtime if base_mtime is None else base_mtime,
+            'last_delta': last_delta,
+            'columns': layout,
+            'strings': size,
+        })
+
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(os.path.abspath(path)), delete=False) as temp_file:
+            temp_file.write(SNAPSHOT_MAGIC)
+            temp_file.write(struct.pack('<I', len(header)))
+            temp_file.write(header)
+            for block in blocks:
+                temp_file.write('\0' * (_align(temp_file.tell()) - temp_file.tell()))
+                temp_file.write(block)
+            temp_file.write('\0' * (_align(temp_file.tell()) - temp_file.tell()))
+            temp_file.write(''.join(string_table))
+        os.rename(temp_file.name, path)
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+class StringTable(object):
+    """
+    Decodes the string columns of a memory-mapped binary snapshot.
+    """
+    def __init__(self, buf, start, columns):
+        self._buf = buf
+        self._start = start
+        self._columns = columns
+
+    def get(self, name, row):
+        offsets = self._columns[name]
+        return self._buf[self._start + offsets[row]:self._start + offsets[row + 1]].decode('utf-8')
+
+    def column(self, name, rows=None):
+        """
+        Return the strings of name at rows, or of every row. An ASCII column
+        is decoded in one go and sliced, others are decoded row by row.
+        """
+        offsets = self._columns[name].tolist()
+        first = offsets[0]
+        block = self._buf[self._start + first:self._start + offsets[-1]]
+        text = block.decode('utf-8')
+        if rows is None:
+            rows = xrange(len(offsets) - 1)
+        if len(text) == len(block):
+            return [text[offsets[row] - first:offsets[row + 1] - first] for row in rows]
+        return [block[offsets[row] - first:offsets[row + 1] - first].decode('utf-8') for row in rows]
+
+
+class LazyRelays(object):
+    """
+    Read-only sequence of the Relay records in a binary snapshot, each record
+    is built the first time its row is accessed. select() and iteration
+    build the missing records together, a column at a time.
+    """
+    def __init__(self, table, strings, count):
+        self._table = table
+        self._strings = strings
+        self._relays = [None] * count
+
+    def __len__(self):
+        return len(self._relays)
+
+    def __iter__(self):
+        return iter(self.select(range(len(self._relays))))
+
+    def column(self, field):
+        return self._strings.column(field)
+
+    def __getitem__(self, row):
+        relay = self._relays[row]
+        if relay is None:
+            relay = self._relays[row] = self._build(row)
+        return relay
+
+    def select(self, rows):
+        """
+        Return the Relay records at rows, a list of row numbers.
+        """
+        missing = [row for row in rows if self._relays[row] is None]
+        if missing:
+            for row, relay in zip(missing, self._build_rows(missing)):
+                self._relays[row] = relay
+        return [self._relays[row] for row in rows]
+
+    def _build(self, row):
+        table = self._table
+        relay = Relay.__new__(Relay)
+        for field in STRING_FIELDS:
+            setattr(relay, field, self._strings.get(field, row))
+        relay.running = bool(table.running[row])
+        relay._set_flags(self._strings.get('flag_names', row).split())
+        relay.family = tuple(self._strings.get('family_members', row).split())
+        relay.country = table.countries[table.country[row]]
+        relay.as_number = table.as_numbers[table.as_number[row]]
+        for field, percent in WEIGHT_FIELDS:
+            setattr(relay, field, float(getattr(table, field)[row]))
+            setattr(relay, percent, float(getattr(table, percent)[row]))
+        return relay
+
+    def _build_rows(self, rows):
+        table = self._table
+        fields = STRING_FIELDS + ['running', 'family', 'country', 'as_number']
+        columns = [self._strings.column(field, rows) for field in STRING_FIELDS]
+        columns.append(table.running[rows].tolist())
+        columns.append([tuple(family.split()) for family in self._strings.column('family_members', rows)])
+        columns.append([table.countries[code] for code in table.country[rows].tolist()])
+        columns.append([table.as_numbers[code] for code in table.as_number[rows].tolist()])
+        for field, percent in WEIGHT_FIELDS:
+            fields += [field, percent]
+            columns.append(getattr(table, field)[rows].tolist())
+            columns.append(getattr(table, percent)[rows].tolist())
+
+        relays = []
+        for flags, values in zip(self._strings.column('flag_names', rows), zip(*columns)):
+            relay = Relay.__new__(Relay)
+            for field, value in zip(fields, values):
+                setattr(relay, field, value)
+            relay._set_flags(flags.split())
+            relays.append(relay)
+        return relays
+
+
+def binary_path(details_path):
+    return os.path.splitext(details_path)[0] + '.snapshot'
+
+
+def delta_dir(details_path):
+    return os.path.splitext(details_path)[0] + '.deltas'
+
+
+def list_deltas(details_path):
+    """
+    Return the names of the delta files recorded for details_path, oldest
+    first.
+    """
+    try:
+        return sorted(name for name in os.listdir(delta_dir(details_path)) if name.endswith('.json'))
+    except OSError:
+        return []
+
+
+def write_delta(details_path, delta):
+    """
+    Atomically record delta as the next numbered delta file of details_path.
+    Numbers keep increasing across compactions, so a reader which saw the
+    deltas before a compaction never skips the ones written after it.
+    """
+    directory = delta_dir(details_path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    sequence_path = os.path.join(directory, 'sequence')
+    deltas = list_deltas(details_path)
+    last = int(deltas[-1][:-5]) if deltas else 0
+    if os.path.exists(sequence_path):
+        with open(sequence_path) as sequence_file:
+            last = max(last, int(sequence_file.read() or 0))
+    name = '%06d.json' % (last + 1)
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temp_file:
+        json.dump(delta, temp_file)
+    os.rename(temp_file.name, os.path.join(directory, name))
+    with tempfile.NamedTemporaryFile(dir=directory, delete=False) as temp_file:
+        temp_file.write(str(last + 1))
+    os.rename(temp_file.name, sequence_path)
+    return name
+
+
+def clear_deltas(details_path):
+    for name in list_deltas(details_path):
+        os.remove(os.path.join(delta_dir(details_path), name))
+
+
+def _apply_deltas(snapshot, details_path, after=None):
+    for name in list_deltas(details_path):
+        if after is not None and name <= after:
+            continue
+        with open(os.path.join(delta_dir(details_path), name)) as delta_file:
+            snapshot = snapshot.apply_delta(json.load(delta_file))
+        after = name
+    return snapshot, after
+
+
+def apply_deltas(snapshot, details_path, after=None):
+    """
+    Apply the delta files of details_path which are newer than the file
+    named after. Returns the resulting snapshot and the name of the last
+    delta file read. If a delta was not based on the snapshot it would be
+    applied to, details_path is loaded again with all of its deltas.
+    """
+    try:
+        return _apply_deltas(snapshot, details_path, after)
+    except ValueError, err:
+        logger.warning('%s, reloading %s', err, details_path)
+        return _load_latest_snapshot(details_path)
+
+
+def _load_latest_snapshot(details_path):
+    snapshot = load_snapshot(details_path)
+    try:
+        return _apply_deltas(snapshot, details_path, snapshot.last_delta)
+    except ValueError:
+        if snapshot.last_delta is None:
+            raise
+    # The binary snapshot already included a delta which doesn't lead to
+    # the later ones, start again from details.json
+    return _apply_deltas(RelaySnapshot.from_file(details_path), details_path)
+
+
+def load_latest_snapshot(details_path):
+    """
+    Load details_path and apply every delta recorded since it was written.
+    Raises ValueError if the deltas do not follow on from each other.
+    """
+    return _load_latest_snapshot(details_path)[0]
+
+
+def load_snapshot(details_path):
+    """
+    Load the snapshot of details_path, memory-mapping its binary form when it
+    was written from the current details.json and parsing the JSON otherwise.
+    The binary form may already include some of the deltas, see last_delta.
+    """
+    mtime = os.stat(details_path).st_mtime
+    try:
+        snapshot = RelaySnapshot.from_binary(binary_path(details_path))
+        if snapshot.base_mtime == mtime:
+            return snapshot
+    except (IOError, OSError, ValueError, KeyError, struct.error):
+        pass
+    return RelaySnapshot.from_file(details_path)
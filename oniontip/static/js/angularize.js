@@ -120,43 +120,67 @@ oniontipModule.controller('OnionTipCtrl',function OnionTipCtrl($scope,$http,$loc
       })
   };
 
+  /**  Forwarding finished successfully **/
+  var forward_success = function(response) {
+    $scope.state = 'success'
+    $('.postdonate').append(
+      $('<a/>')
+        .attr("href", "https://twitter.com/share")
+        .attr("data-text", "I've donated " + response.data.tx_value +" to Tor relay operators. Help support the Tor network and a private internet on #OnionTip")
+        .attr("data-url", "https://oniontip.com")
+        .attr("data-related", "TorProject,EFF")
+        .attr("data-dnt", "true")
+        .attr("data-count", "none")
+        .attr("data-size", "large")
+        .addClass("twitter-hashtag-button")
+        .append("Tweet your support!")
+    );
+    twttr.widgets.load();
+    bootstrap_alert('#payment_errors', 'success', response.data.message);
+    $(".payment-info, .paymentadvice, #checktx-btn").hide();
+    $(".postdonate").show();
+  };
+
+  /**  Forwarding failed, or the job couldn't be queued or checked **/
+  var forward_error = function(response, status) {
+    $scope.state = 'warn'
+    if(response.status == 'fail'){
+      bootstrap_alert('#payment_errors', 'warning', response.data.message);
+    } else if(response.status == 'error'){
+      bootstrap_alert('#payment_errors', 'warning', '<strong>Error '+status+'</strong>: '+response.message);
+    } else {
+      if(status == 408 || status == 522){
+        bootstrap_alert('#payment_errors', 'warning', '<strong>Request Timeout</strong>: Blockchain.info may be down, please try again in a few moments.</strong>');
+      } else {
+        bootstrap_alert('#payment_errors', 'warning', '<strong>Error '+status+'</strong>: An unknown error occured</strong>');
+      }
+    }
+  };
+
+  /**
+   * Long-poll the forwarding job until it has finished. The server answers
+   * 202 while the job is still queued or running.
+   */
+  $scope.waitforward = function(job_id) {
+    $http.get('forward/job/'+job_id, {"params": {"wait": 20}})
+      .success(function(response, status) {
+        if (status == 202) {
+          $scope.waitforward(job_id)
+        } else {
+          forward_success(response)
+        }
+      }).
+      error(forward_error);
+  };
+
   /**  Check transaction **/
   $scope.checktx = function(bitcoin_address) {
     $scope.state = 'loading';
     $http.get('forward/'+bitcoin_address)
       .success(function(response) {
-        $scope.state = 'success'
-        $('.postdonate').append(
-          $('<a/>')
-            .attr("href", "https://twitter.com/share")
-            .attr("data-text", "I've donated " + response.data.tx_value +" to Tor relay operators. Help support the Tor network and a private internet on #OnionTip")
-            .attr("data-url", "https://oniontip.com")
-            .attr("data-related", "TorProject,EFF")
-            .attr("data-dnt", "true")
-            .attr("data-count", "none")
-            .attr("data-size", "large")
-            .addClass("twitter-hashtag-button")
-            .append("Tweet your support!")
-        );
-        twttr.widgets.load();
-        bootstrap_alert('#payment_errors', 'success', response.data.message);
-        $(".payment-info, .paymentadvice, #checktx-btn").hide();
-        $(".postdonate").show();
+        $scope.waitforward(response.data.job_id)
       }).
-      error(function(response, status) {
-        $scope.state = 'warn'
-        if(response.status == 'fail'){
-          bootstrap_alert('#payment_errors', 'warning', response.data.message);
-        } else if(response.status == 'error'){
-          bootstrap_alert('#payment_errors', 'warning', '<strong>Error '+status+'</strong>: '+response.message);
-        } else {
-          if(status == 408 || status == 522){
-            bootstrap_alert('#payment_errors', 'warning', '<strong>Request Timeout</strong>: Blockchain.info may be down, please try again in a few moments.</strong>');
-          } else {
-            bootstrap_alert('#payment_errors', 'warning', '<strong>Error '+status+'</strong>: An unknown error occured</strong>');
-          }
-        }
-      });
+      error(forward_error);
   };
 
   $http.get("static/data/cc.json").success(function(data) {
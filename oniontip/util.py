@@ -12,9 +12,27 @@ import operator
 import sys
 import os
 import urllib
+import urllib2
+import httplib
+import zlib
+import random
+import multiprocessing
 import itertools
-from stem.descriptor.remote import DescriptorDownloader
+import collections
+import threading
+import hashlib
+import heapq
+import gzip
+import StringIO
+import numpy
+import ijson
+import qrcode
+import qrcode.image.svg
+from stem.descriptor.remote import get_authorities
 from oniontip import db, cache, app
+from oniontip.models import KeySlot
+from oniontip.snapshot import (RelaySnapshot, load_snapshot, load_latest_snapshot, binary_path,
+                               apply_deltas, write_delta, clear_deltas, list_deltas, FLAG_BITS)
 
 
 FAST_EXIT_BANDWIDTH_RATE = 95 * 125 * 1024     # 95 Mbit/s
@@ -26,6 +44,9 @@ ALMOST_FAST_EXIT_BANDWIDTH_RATE = 80 * 125 * 1024    # 80 Mbit/s
 ALMOST_FAST_EXIT_ADVERTISED_BANDWIDTH = 2000 * 1024  # 2000 kB/s
 ALMOST_FAST_EXIT_PORTS = [80, 443]
 
+DETAILS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'details.json')
+ADDRESS_CACHE_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'address_cache.json')
+
 def JSON(val):
   try:
     return json.loads(val)
@@ -100,7 +121,92 @@ class Opt(object):
         else:
           setattr(self,key,Opt.default(key))
 
-class Result():
+    def cache_key(self):
+      """
+      Hashable, canonical form of these options. Requests which only differ
+      in the order or case of their countries share the same key. Returns
+      None if there is no such form, eg. for a JSON object as country.
+      """
+      key = []
+      for name in sorted(Opt.option_details):
+        value = getattr(self, name)
+        if isinstance(value, list):
+          if not all(isinstance(x, basestring) for x in value):
+            return None
+          if name == 'country':
+            value = set(x.lower() for x in value)
+          value = tuple(sorted(value))
+        key.append((name, value))
+      key = tuple(key)
+      try:
+        hash(key)
+      except TypeError:
+        return None
+      return key
+
+class LRUCache(object):
+    """
+    Bounded, thread-safe mapping which evicts the least recently used entry
+    once maxsize is reached and counts hits and misses.
+    """
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value = self._entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self._entries[key] = value
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = value
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'size': len(self._entries),
+            'maxsize': self.maxsize
+            }
+
+class Result(object):
+    """
+    One line of a relay selection. Attributes are __slots__ so a result set
+    doesn't carry a dict per relay, FIELDS gives the JSON keys. A relay
+    group also keeps the (bitcoin_address, cw) of its relays in members.
+    The line of a single relay carries the JSON encoding of its
+    RELAY_FIELDS in fragment.
+    """
+    FIELDS = ('index', 'donation_share', 'cw', 'adv_bw', 'p_guard', 'p_exit', 'p_middle',
+              'nick', 'fp', 'link', 'exit', 'guard', 'cc', 'primary_ip',
+              'as_no', 'as_name', 'as_info', 'bitcoin_address')
+    # Fields which only depend on the selection and the ones taken from the relay
+    SELECTION_FIELDS = ('index', 'donation_share', 'link')
+    RELAY_FIELDS = ('cw', 'adv_bw', 'p_guard', 'p_exit', 'p_middle', 'nick', 'fp',
+                    'exit', 'guard', 'cc', 'primary_ip', 'as_no', 'as_name', 'as_info',
+                    'bitcoin_address')
+    __slots__ = FIELDS + ('members', 'fragment')
+
     WEIGHT_FIELDS = {
     'consensus_weight_fraction': 'cw',
     'advertised_bandwidth_fraction': 'adv_bw',
@@ -128,22 +234,103 @@ class Result():
         self.as_name = ""
         self.as_info = ""
         self.bitcoin_address = ""
+        self.members = None
+        self.fragment = None
 
     def __getitem__(self,prop):
-      getattr(self,prop)
+      return getattr(self,prop)
 
     def __setitem__(self,prop,val):
       setattr(self,prop,val)
 
+    def payouts(self):
+      """
+      Return the (bitcoin_address, donation_share) pairs to pay for this
+      line. A group's share is split between its relays in proportion to
+      their consensus weight.
+      """
+      if self.members is None:
+        return [(self.bitcoin_address, self.donation_share)]
+      group_cw = sum(cw for _, cw in self.members)
+      if group_cw > 0:
+        return [(address, self.donation_share * cw / group_cw) for address, cw in self.members]
+      return [(address, self.donation_share / len(self.members)) for address, _ in self.members]
+
     def jsonify(self):
-      return self.__dict__
+      return {
+        'index': self.index, 'donation_share': self.donation_share,
+        'cw': self.cw, 'adv_bw': self.adv_bw, 'p_guard': self.p_guard,
+        'p_exit': self.p_exit, 'p_middle': self.p_middle,
+        'nick': self.nick, 'fp': self.fp, 'link': self.link,
+        'exit': self.exit, 'guard': self.guard, 'cc': self.cc,
+        'primary_ip': self.primary_ip, 'as_no': self.as_no,
+        'as_name': self.as_name, 'as_info': self.as_info,
+        'bitcoin_address': self.bitcoin_address,
+        }
 
 class ResultEncoder(json.JSONEncoder):
   def default(self,obj):
     if isinstance(obj,Result):
-      return obj.__dict__
+      return obj.jsonify()
     return json.JSONEncoder.default(self,obj)
 
+_JSON_STRINGS = frozenset([str, unicode])
+_JSON_NUMBERS = frozenset([int, long, float, bool, type(None)])
+
+def _encode_column(values):
+    """
+    JSON encode each of values. A column of numbers goes through a single
+    json.dumps call, as none of their encodings contain ', ' the list can
+    be split again.
+    """
+    types = set(map(type, values))
+    if types <= _JSON_STRINGS:
+        return map(json.encoder.encode_basestring_ascii, values)
+    if types <= _JSON_NUMBERS:
+        return json.dumps(values)[1:-1].split(', ')
+    return map(json.dumps, values)
+
+def _encode_members(fields, objects):
+    """
+    Return the JSON object members for fields of each object, encoded a
+    column at a time.
+    """
+    template = ', '.join(json.encoder.encode_basestring_ascii(field) + ': %s' for field in fields)
+    columns = map(_encode_column, zip(*map(operator.attrgetter(*fields), objects)))
+    return [template % row for row in zip(*columns)]
+
+def relay_fragments(results):
+    """
+    Return the JSON encoding of the Result.RELAY_FIELDS of each result.
+    """
+    return _encode_members(Result.RELAY_FIELDS, results)
+
+def encode_results(results):
+    """
+    Return the JSON encoding of each Result. Only the SELECTION_FIELDS are
+    encoded for results which carry a fragment.
+    """
+    fragments = [result.fragment for result in results]
+    missing = [result for result in results if result.fragment is None]
+    if missing:
+        encoded = iter(relay_fragments(missing))
+        fragments = [fragment if fragment is not None else next(encoded) for fragment in fragments]
+    selection = _encode_members(Result.SELECTION_FIELDS, results)
+    return ['{%s, %s}' % row for row in zip(selection, fragments)]
+
+def encode_relays(relays):
+    """
+    JSON encode a determine_relays result. The results are written with
+    encode_results, the remaining keys go through the plain encoder.
+    """
+    document = dict(relays)
+    results = document.pop('results')
+    for key in ('excluded', 'total'):
+        if document.get(key) is not None:
+            document[key] = document[key].jsonify()
+    head = json.dumps(document)[:-1] + (', ' if document else '')
+    return '%s"results": [%s]}' % (head, ', '.join(encode_results(results)))
+
 def extract_bitcoin_address(field):
     for bitcoin_match in re.finditer(r"[13][a-km-zA-HJ-NP-Z0-9]{26,33}", field):
         bitcoin_address = bitcoin_match.group(0)
@@ -167,89 +354,488 @@ def format_bitcoin_value(value):
     else:
         return '0 mBTC'
 
+QRCODE_MIMETYPES = {
+    'png': 'image/png',
+    'svg': 'image/svg+xml',
+}
+
+# Rendered QR codes keyed by (address, image_format)
+qrcode_cache = LRUCache(app.config.get('QRCODE_CACHE_SIZE', 256))
+
+def qrcode_etag(address, image_format):
+    return hashlib.sha1('%s:%s' % (image_format, address)).hexdigest()
+
+def render_qrcode(address, image_format='png'):
+    """
+    Return the encoded QR code image for a bitcoin address. Images are kept
+    in qrcode_cache and, if QRCODE_CACHE_DIR is set, on disk so each address
+    is only rendered once. SVG images are rendered without Pillow.
+    """
+    key = (address, image_format)
+    image = qrcode_cache.get(key)
+    if image is not None:
+        return image
+
+    cache_dir = app.config.get('QRCODE_CACHE_DIR')
+    cache_path = os.path.join(cache_dir, '%s.%s' % (address, image_format)) if cache_dir else None
+    if cache_path and os.path.exists(cache_path):
+        with open(cache_path, 'rb') as cache_file:
+            image = cache_file.read()
+    else:
+        qr = qrcode.QRCode(
+            version=None,
+            error_correction=qrcode.constants.ERROR_CORRECT_L,
+            box_size=6,
+            border=2,
+            image_factory=qrcode.image.svg.SvgImage if image_format == 'svg' else None
+        )
+        qr.add_data('bitcoin:' + str(address))
+        qr.make(fit=True)
+
+        img_io = StringIO.StringIO()
+        if image_format == 'svg':
+            qr.make_image().save(img_io)
+        else:
+            qr.make_image().save(img_io, 'PNG')
+        image = img_io.getvalue()
+
+        if cache_path:
+            with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False) as temp_file:
+                temp_file.write(image)
+            os.rename(temp_file.name, cache_path)
+
+    qrcode_cache.put(key, image)
+    return image
+
 class BaseFilter(object):
+    """
+    Filters combine with & (AndFilter), | (OrFilter) and ~ (InverseFilter).
+    Every filter can be evaluated per relay with accept()/load(), as a
+    boolean mask over a snapshot or as sorted snapshot row ids.
+    """
     def accept(self, relay):
         raise NotImplementedError("This isn't implemented by the subclass")
 
+    def __and__(self, other):
+        return AndFilter([self, other])
+
+    def __or__(self, other):
+        return OrFilter([self, other])
+
+    def __invert__(self):
+        return InverseFilter(self)
+
+    def prepare(self, relays):
+        """
+        Called with every relay before accept() is, for filters which need to
+        look at other relays to decide on one.
+        """
+        pass
+
     def load(self, relays):
+        self.prepare(relays)
         return filter(self.accept, relays)
 
+    def mask(self, snapshot):
+        """
+        Return a boolean array selecting the snapshot rows this filter
+        accepts. Subclasses override this with a vectorised version.
+        """
+        self.prepare(snapshot.relays)
+        return numpy.fromiter((self.accept(relay) for relay in snapshot.relays),
+                              numpy.bool_, len(snapshot))
+
+    def rows(self, snapshot):
+        """
+        Return the sorted snapshot row ids this filter accepts. Filters
+        backed by a RelayIndex return its precomputed rows.
+        """
+        return numpy.flatnonzero(self.mask(snapshot))
+
 class CountryFilter(BaseFilter):
     def __init__(self, countries=[]):
         self._countries = [x.lower() for x in countries]
 
     def accept(self, relay):
-        return relay.get('country', None) in self._countries
+        return relay.country in self._countries
+
+    def mask(self, snapshot):
+        table = snapshot.table
+        codes = [table.country_ids[cc] for cc in self._countries if cc in table.country_ids]
+        return numpy.in1d(table.country, codes)
+
+    def rows(self, snapshot):
+        return snapshot.index.rows(snapshot.index.countries, self._countries)
 
 class ExitFilter(BaseFilter):
     def accept(self, relay):
-        return relay.get('exit_probability', -1) > 0.0
+        return relay.exit_probability > 0.0
+
+    def mask(self, snapshot):
+        return snapshot.table.exit_probability > 0.0
+
+    def rows(self, snapshot):
+        return snapshot.index.exits
 
 class GuardFilter(BaseFilter):
     def accept(self, relay):
-        return relay.get('guard_probability', -1) > 0.0
+        return relay.guard_probability > 0.0
+
+    def mask(self, snapshot):
+        return snapshot.table.guard_probability > 0.0
+
+    def rows(self, snapshot):
+        return snapshot.index.guards
 
 class RunningFilter(BaseFilter):
     def accept(self, relay):
-        return relay.get('running', False)
+        return relay.running
+
+    def mask(self, snapshot):
+        return snapshot.table.running
+
+    def rows(self, snapshot):
+        return snapshot.index.running
 
 class ValidWeightFilter(BaseFilter):
     def accept(self, relay):
-        if (relay.get('consensus_weight_fraction', -1) >= 0.0
-          and relay.get('guard_probability', -1) >= 0.0
-          and relay.get('exit_probability', -1) >= 0.0):
+        if (relay.consensus_weight_fraction >= 0.0
+          and relay.guard_probability >= 0.0
+          and relay.exit_probability >= 0.0):
             return True
         else:
             return False
 
+    def mask(self, snapshot):
+        table = snapshot.table
+        return ((table.consensus_weight_fraction >= 0.0)
+                & (table.guard_probability >= 0.0)
+                & (table.exit_probability >= 0.0))
+
+    def rows(self, snapshot):
+        return snapshot.index.valid_weights
+
+class ASFilter(BaseFilter):
+    def __init__(self, ases=[]):
+        self._ases = [x.upper() if x.upper().startswith('AS') else 'AS' + x for x in ases]
+
+    def accept(self, relay):
+        return relay.as_number in self._ases
+
+    def mask(self, snapshot):
+        table = snapshot.table
+        codes = [table.as_ids[asn] for asn in self._ases if asn in table.as_ids]
+        return numpy.in1d(table.as_number, codes)
+
+    def rows(self, snapshot):
+        return snapshot.index.rows(snapshot.index.as_numbers, self._ases)
+
+class FamilyFilter(BaseFilter):
+    """
+    Select the relay given by fingerprint, or by nickname if it is Named,
+    together with the relays in its family which declare it in theirs.
+    """
+    def __init__(self, family):
+        self._family = family.lstrip('$')
+        self._members = None
+
+    def _find(self, fingerprints, named):
+        if len(self._family) == 40:
+            return fingerprints.get(self._family.upper())
+        return named.get(self._family)
+
+    @staticmethod
+    def _members_of(relay, lookup):
+        """
+        Return relay and the relays in its family which declare it in theirs,
+        lookup returns the relay with a fingerprint or None.
+        """
+        mentions = set(['$' + relay.fingerprint])
+        if 'Named' in relay.flags:
+            mentions.add(relay.nickname)
+        members = [relay]
+        for member in relay.family:
+            member_relay = lookup(member.lstrip('$'))
+            if (member.startswith('$') and member_relay is not None and
+                    mentions.intersection(member_relay.family)):
+                members.append(member_relay)
+        return members
+
+    def prepare(self, relays):
+        fingerprints = dict((relay.fingerprint, relay) for relay in relays)
+        named = dict((relay.nickname, relay) for relay in relays if 'Named' in relay.flags)
+        relay = self._find(fingerprints, named)
+        members = self._members_of(relay, fingerprints.get) if relay is not None else []
+        self._members = set(member.fingerprint for member in members)
+
+    def accept(self, relay):
+        if self._members is None:
+            raise ValueError('FamilyFilter.prepare() must be called with the relays first')
+        return relay.fingerprint in self._members
+
+    def mask(self, snapshot):
+        mask = numpy.zeros(len(snapshot), dtype=numpy.bool_)
+        mask[self.rows(snapshot)] = True
+        return mask
+
+    def rows(self, snapshot):
+        index = snapshot.index
+        row = self._find(index.fingerprints, index.named)
+        if row is None:
+            return numpy.zeros(0, dtype=numpy.intp)
+
+        def lookup(fingerprint):
+            member_row = index.fingerprints.get(fingerprint)
+            return snapshot.relays[member_row] if member_row is not None else None
+        members = self._members_of(snapshot.relays[row], lookup)
+        return numpy.unique(numpy.array([index.fingerprints[member.fingerprint] for member in members],
+                                        dtype=numpy.intp))
+
 class InverseFilter(BaseFilter):
     def __init__(self, orig_filter):
         self.orig_filter = orig_filter
 
-    def load(self, all_relays):
-        matching_relays = self.orig_filter.load(all_relays)
-        inverse_relays = []
-        for relay in all_relays:
-            if relay not in matching_relays:
-                inverse_relays.append(relay)
-        return inverse_relays
+    def prepare(self, relays):
+        self.orig_filter.prepare(relays)
+
+    def accept(self, relay):
+        return not self.orig_filter.accept(relay)
+
+    def mask(self, snapshot):
+        return ~self.orig_filter.mask(snapshot)
+
+    def rows(self, snapshot):
+        return numpy.setdiff1d(numpy.arange(len(snapshot)), self.orig_filter.rows(snapshot),
+                               assume_unique=True)
+
+class AndFilter(BaseFilter):
+    def __init__(self, filters):
+        self.filters = filters
+
+    def prepare(self, relays):
+        for f in self.filters:
+            f.prepare(relays)
+
+    def accept(self, relay):
+        return all(f.accept(relay) for f in self.filters)
+
+    def mask(self, snapshot):
+        mask = numpy.ones(len(snapshot), dtype=numpy.bool_)
+        for f in self.filters:
+            mask &= f.mask(snapshot)
+        return mask
+
+    def rows(self, snapshot):
+        # Intersect starting with the smallest set of rows
+        rows = None
+        for filter_rows in sorted((f.rows(snapshot) for f in self.filters), key=len):
+            if rows is None:
+                rows = filter_rows
+            else:
+                rows = numpy.intersect1d(rows, filter_rows, assume_unique=True)
+        return rows if rows is not None else numpy.arange(len(snapshot))
+
+class OrFilter(BaseFilter):
+    def __init__(self, filters):
+        self.filters = filters
+
+    def prepare(self, relays):
+        for f in self.filters:
+            f.prepare(relays)
+
+    def accept(self, relay):
+        return any(f.accept(relay) for f in self.filters)
+
+    def mask(self, snapshot):
+        mask = numpy.zeros(len(snapshot), dtype=numpy.bool_)
+        for f in self.filters:
+            mask |= f.mask(snapshot)
+        return mask
+
+    def rows(self, snapshot):
+        rows = numpy.zeros(0, dtype=numpy.intp)
+        for f in self.filters:
+            rows = numpy.union1d(rows, f.rows(snapshot))
+        return rows
+
+class SnapshotReloader(object):
+    """
+    Keeps app.relay_snapshot up to date from a background timer thread so that
+    requests never have to parse relay data themselves. Reloads are
+    single-flight: only one load runs at a time and the new snapshot is
+    swapped in atomically. details.json is only reloaded in full when it has
+    been rewritten, new delta files are applied to the current snapshot.
+    """
+    def __init__(self, datafile_name, interval=60):
+        self.datafile_name = datafile_name
+        self.interval = interval
+        self.reloads = 0
+        self.delta_reloads = 0
+        self.last_reload = None
+        self.last_reload_duration = None
+        self._base_mtime = None
+        self._binary_mtime = None
+        self._last_delta = None
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def reload(self, block=True):
+        """
+        Load a new snapshot if details.json or its deltas changed. Returns False
+        without doing anything if block is False and a reload is already running.
+        """
+        if not self._lock.acquire(block):
+            return False
+        try:
+            mtime = os.stat(self.datafile_name).st_mtime
+            try:
+                binary_mtime = os.stat(binary_path(self.datafile_name)).st_mtime
+            except OSError:
+                binary_mtime = None
+            current = getattr(app, 'relay_snapshot', None)
+            started = time.time()
+            if current is None or self._base_mtime != mtime or self._binary_mtime != binary_mtime:
+                # Every download rewrites the binary snapshot, re-mapping it is
+                # cheaper than applying the deltas it already includes
+                snapshot = load_snapshot(self.datafile_name)
+                snapshot, self._last_delta = apply_deltas(snapshot, self.datafile_name, snapshot.last_delta)
+                self._base_mtime = mtime
+                self._binary_mtime = binary_mtime
+                self.reloads += 1
+            else:
+                snapshot, self._last_delta = apply_deltas(current, self.datafile_name, self._last_delta)
+                if snapshot is not current:
+                    self.delta_reloads += 1
+            if snapshot is not current:
+                app.relay_snapshot = snapshot
+                result_cache.clear()
+                self.last_reload = time.time()
+                self.last_reload_duration = self.last_reload - started
+        finally:
+            self._lock.release()
+        return True
+
+    def snapshot(self):
+        """
+        Return the current snapshot. Only the very first call loads it on the
+        request path, concurrent first requests wait for that single load.
+        """
+        snapshot = getattr(app, 'relay_snapshot', None)
+        if snapshot is None:
+            self.reload()
+            snapshot = app.relay_snapshot
+        return snapshot
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='snapshot-reloader')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.reload(block=False)
+            except Exception:
+                app.logger.exception('Unable to reload relay data from {}'.format(self.datafile_name))
+
+    def stats(self):
+        snapshot = getattr(app, 'relay_snapshot', None)
+        return {
+            'relays_published': snapshot.relays_published if snapshot else None,
+            'snapshot_age': time.time() - snapshot.mtime if snapshot else None,
+            'reloads': self.reloads,
+            'delta_reloads': self.delta_reloads,
+            'last_reload': self.last_reload,
+            'last_reload_duration': self.last_reload_duration
+            }
+
+snapshot_reloader = SnapshotReloader(DETAILS_FILE, app.config.get('SNAPSHOT_RELOAD_INTERVAL', 60))
+
+class KeyPoolFiller(object):
+    """
+    Keeps at least size unclaimed KeySlots derived ahead of time from a
+    background thread, in batches so each commit stays short.
+    """
+    def __init__(self, size=100, batch=20, interval=30):
+        self.size = size
+        self.batch = batch
+        self.interval = interval
+        self.filled = 0
+        self.inline_fills = 0
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def fill(self):
+        with self._lock:
+            try:
+                while KeySlot.available() < self.size:
+                    self.filled += KeySlot.fill(app.config.get('BITCOIN_KEY_SEED'), self.batch)
+            finally:
+                db.session.remove()
+
+    def claim(self, attempts=3):
+        """
+        Claim a slot for a new forwarding address. If the pool ran dry a slot
+        is derived on the request path rather than failing the request. Only
+        fills which added nothing count as failed attempts, a slot which a
+        concurrent request claimed first is simply replaced.
+        """
+        failed = 0
+        while True:
+            slot = KeySlot.claim()
+            if slot:
+                return slot
+            self.inline_fills += 1
+            if not KeySlot.fill(app.config.get('BITCOIN_KEY_SEED'), 1):
+                failed += 1
+                if failed == attempts:
+                    raise RuntimeError('Unable to claim a key slot after {} attempts'.format(attempts))
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name='key-pool-filler')
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self.fill()
+            except Exception:
+                app.logger.exception('Unable to fill the key pool')
+            time.sleep(self.interval)
+
+    def stats(self):
+        return {
+            'available': KeySlot.available(),
+            'filled': self.filled,
+            'inline_fills': self.inline_fills
+            }
+
+key_pool = KeyPoolFiller(app.config.get('KEY_POOL_SIZE', 100), app.config.get('KEY_POOL_BATCH', 20),
+                         app.config.get('KEY_POOL_INTERVAL', 30))
 
 class RelayStats(object):
-    def __init__(self, options, custom_datafile="details.json"):
-        self._data = None
-        self._datafile_name = os.path.join(os.path.dirname(os.path.abspath(__file__)), custom_datafile)
+    def __init__(self, options):
         self._filters = self._create_filters(options)
-        self._get_group = self._get_group_function(options)
         self._relays = None
-        self._max_age_secs = 60 * 60   # 1 hour
-        #slef._relays_published = None
 
     @property
-    def data(self):
-      try:
-        if time.time() - app.relay_data_mtime > self._max_age_secs:
-          if time.time() - app.relay_data_last_checked > self._max_age_secs / 2:
-              self._load_data()
-        return app.relay_data
-      except AttributeError:
-        self._load_data()
-        return app.relay_data
-
-    def _load_data(self):
-      app.relay_data = json.load(file(self._datafile_name))
-      app.relay_data_mtime = (os.stat(self._datafile_name)).st_mtime
-      app.relay_data_last_checked = time.time()
+    def snapshot(self):
+      """
+      The process-wide RelaySnapshot, kept up to date by snapshot_reloader.
+      """
+      return snapshot_reloader.snapshot()
 
     @property
     def relays(self):
-        if self._relays:
-            return self._relays
-        self._relays = {}
-        relays = self.data['relays']
-        for f in self._filters:
-            relays = f.load(relays)
-        for relay in relays:
-            self.add_relay(relay)
+        """
+        Array of the snapshot row ids which pass every filter.
+        """
+        if self._relays is None:
+            self._relays = AndFilter(self._filters).rows(self.snapshot)
         return self._relays
 
     def _create_filters(self, options):
@@ -262,97 +848,100 @@ class RelayStats(object):
             filters.append(ExitFilter())
         if options.guards_only:
             filters.append(GuardFilter())
+        if options.ases:
+            filters.append(ASFilter(options.ases))
+        if options.family:
+            filters.append(FamilyFilter(options.family))
         return filters
 
-    def _get_group_function(self, options):
-        funcs = []
-        funcs.append(lambda relay: relay.get('fingerprint'))
-        return lambda relay: tuple([func(relay) for func in funcs])
-
-    def add_relay(self, relay):
-        key = self._get_group(relay)
-        if key not in self._relays:
-            self._relays[key] = []
-        self._relays[key].append(relay)
-
-    WEIGHTS = ['consensus_weight_fraction', 'advertised_bandwidth_fraction', 'guard_probability', 'middle_probability', 'exit_probability']
+    # Result attributes which have a matching RelayTable column
+    SORT_COLUMNS = ['cw', 'adv_bw', 'p_guard', 'p_middle', 'p_exit']
 
-    def sort_and_reduce(self, relay_set, options):
+    def _sort_order(self, lines, options, top):
       """
-      Take a set of relays (has already been grouped and
-      filtered), sort it and return the ones requested
-      in the 'top' option.  Add index numbers to them as well.
+      Return the positions into lines of the first top lines in the
+      requested order, the same as a full stable sort truncated to top.
+      Weight columns only partition out the top values, any other Result
+      attribute falls back to a heap selection over Result objects.
+      """
+      if options.sort in RelayStats.SORT_COLUMNS:
+        values = lines.column(options.sort)
+        if options.sort_reverse:
+          values = -values
+        if top >= len(values):
+          return numpy.argsort(values, kind='mergesort')
+        if top <= 0:
+          return numpy.zeros(0, dtype=numpy.intp)
+        # Everything below the top'th value is selected, ties at that value
+        # are taken in row order as a stable sort would
+        threshold = values[numpy.argpartition(values, top - 1)[top - 1]]
+        below = numpy.flatnonzero(values < threshold)
+        ties = numpy.flatnonzero(values == threshold)[:top - len(below)]
+        candidates = numpy.concatenate([below, ties])
+        return candidates[numpy.argsort(values[candidates], kind='mergesort')]
+
+      results = lines.results(numpy.arange(len(lines)))
+      def sort_fn(i):
+        return getattr(results[i], options.sort)
+      select = heapq.nlargest if options.sort_reverse else heapq.nsmallest
+      return numpy.array(select(top, xrange(len(results)), key=sort_fn), dtype=numpy.intp)
+
+    def sort_and_reduce(self, rows, options):
+      """
+      Take the snapshot rows which passed the filters, group them if
+      requested, sort them and return the ones requested in the 'top'
+      option.  Add index numbers to them as well.
 
       Returns a hash with three values:
         *results*: A list of Result objects representing the selected
-                   relays
+                   relays or relay groups
         *excluded*: A Result object representing the stats for the
                     filtered out relays. May be None
         *total*: A Result object representing the stats for all of the
                  relays in this filterset.
       """
-      output_relays = list()
-      excluded_relays = None
-      output_relays_cw = 0
-      total_relays = None
-
-      # We need a simple sorting key function
-      def sort_fn(r):
-        return getattr(r,options.sort)
-
-      relay_set.sort(key=sort_fn,reverse=options.sort_reverse)
+      if options.by_country or options.by_as or options.by_network_family:
+          lines = RelayGroups(self.snapshot, rows, options)
+          filtered = "relay groups"
+      else:
+          lines = RelayRows(self.snapshot, rows, options)
+          filtered = "relays"
+      top = options.top if options.top >= 0 else len(lines)
 
-      if options.top < 0:
-        options.top = len(relay_set)
+      selected = self._sort_order(lines, options, top)
+      output_relays = lines.results(selected)
+      for i, relay in enumerate(output_relays):
+        relay.index = i + 1
 
       # Set up to handle the special lines at the bottom
       excluded_relays = Result(zero_probs=True)
       total_relays = Result(zero_probs=True)
-      if options.by_country or options.by_as or options.by_network_family:
-          filtered = "relay groups"
-      else:
-          filtered = "relays"
 
-      # Add selected relays to the result set
-      for i,relay in enumerate(relay_set):
-        # We have no links if we're grouping
-        if options.by_country or options.by_as or options.by_network_family:
-          relay.link = False
-
-        if i < options.top:
-          relay.index = i + 1
-          output_relays.append(relay)
-          output_relays_cw += relay.cw
-
-        if i >= options.top:
-          excluded_relays.p_guard += relay.p_guard
-          excluded_relays.p_exit += relay.p_exit
-          excluded_relays.p_middle += relay.p_middle
-          excluded_relays.adv_bw += relay.adv_bw
-          excluded_relays.cw += relay.cw
-
-        total_relays.p_guard += relay.p_guard
-        total_relays.p_exit += relay.p_exit
-        total_relays.p_middle += relay.p_middle
-        total_relays.adv_bw += relay.adv_bw
-        total_relays.cw += relay.cw
-
-        excluded_relays.nick = "(%d other %s)" % (
-                                  len(relay_set) - options.top,
-                                  filtered)
-        total_relays.nick = "(total in selection)"
+      for weight in RelayStats.SORT_COLUMNS:
+        column = lines.column(weight)
+        total = column.sum()
+        setattr(excluded_relays, weight, float(total - column[selected].sum()))
+        setattr(total_relays, weight, float(total))
+
+      excluded_relays.nick = "(%d other %s)" % (len(lines) - top, filtered)
+      total_relays.nick = "(total in selection)"
 
       # Only include the excluded line if
-      if len(relay_set) <= options.top:
+      if len(lines) <= top:
         excluded_relays = None
 
       # Only include the last line if
       if total_relays.cw > 99.9:
         total_relays = None
 
-      for relay in output_relays:
-        relay.donation_share = (relay.cw / output_relays_cw) * 100
-        total_relays.donation_share += relay.donation_share
+      selected_cw = lines.column('cw')[selected]
+      output_relays_cw = selected_cw.sum()
+      if output_relays_cw > 0:
+        shares = (selected_cw / output_relays_cw) * 100
+        for relay, share in itertools.izip(output_relays, shares.tolist()):
+          relay.donation_share = share
+        if total_relays is not None:
+          total_relays.donation_share = float(shares.sum())
 
       return {
               'results': output_relays,
@@ -361,124 +950,522 @@ class RelayStats(object):
               }
 
 
-    def select_relays(self, grouped_relays, options):
+class RelayRows(object):
+    """
+    The snapshot rows which passed the filters, one result line per relay.
+    """
+    def __init__(self, snapshot, rows, options):
+        self.snapshot = snapshot
+        self.rows = rows
+        self.options = options
+
+    def __len__(self):
+        return len(self.rows)
+
+    def column(self, name):
+        return getattr(self.snapshot.table, name)[self.rows]
+
+    def results(self, positions):
       """
-      Return a Pythonic representation of the relays result set. Return it as a set of Result objects.
+      Return a Pythonic representation of the relays at positions. Return it as a list of Result objects.
       """
+      rows = self.rows[positions].tolist()
+      fragments = self.snapshot.fragments
       results = []
-      for group in grouped_relays.itervalues():
-        #Initialize some stuff
-        group_weights = dict.fromkeys(RelayStats.WEIGHTS, 0)
-        relays_in_group, exits_in_group, guards_in_group = 0, 0, 0
-        ases_in_group = set()
-        countries_in_group = set()
-        network_families_in_group = set()
+      new = []
+      for row, relay in itertools.izip(rows, self.snapshot.select(rows)):
         result = Result()
-        for relay in group:
-            for weight in RelayStats.WEIGHTS:
-                group_weights[weight] += relay.get(weight, 0)
-
-            result.nick = relay['nickname']
-            result.fp = relay['fingerprint']
-            result.link = options.links
-
-            if 'Exit' in set(relay['flags']) and not 'BadExit' in set(relay['flags']):
-                result.exit = True
-                exits_in_group += 1
-            if 'Guard' in set(relay['flags']):
-                result.guard = True
-                guards_in_group += 1
-            result.cc = relay.get('country', '??').lower()
-            countries_in_group.add(result.cc)
-            result.primary_ip = relay.get('or_addresses', ['??:0'])[0].split(':')[0]
-            result.as_no = relay.get('as_number', '??')
-            result.as_name = relay.get('as_name', '??')
-            result.as_info = "%s %s" %(result.as_no, result.as_name)
-            ases_in_group.add(result.as_info)
-            result.bitcoin_address = relay.get('bitcoin_address', '')
-            relays_in_group += 1
-
-        # If we want to group by things, we need to handle some fields
-        # specially
-        if options.by_country or options.by_as:
-            result.nick = "*"
-            result.fp = "(%d relays)" % relays_in_group
-            result.exit = "(%d)" % exits_in_group
-            result.guard = "(%d)" % guards_in_group
-            if not options.by_as and not options.ases:
-                result.as_info = "(%d)" % len(ases_in_group)
-            if not options.by_country and not options.country:
-                result.cc = "(%d)" % len(countries_in_group)
-            if not options.by_network_family:
-                result.primary_ip = "(%d diff. /16)" % len(network_families_in_group)
-            else:
-                result.primary_ip = network_families_in_group.pop()
+        result.fragment = fragments.get(row)
+        if result.fragment is None:
+          new.append((row, result))
+        result.cw = relay.cw
+        result.adv_bw = relay.adv_bw
+        result.p_guard = relay.p_guard
+        result.p_middle = relay.p_middle
+        result.p_exit = relay.p_exit
+
+        result.nick = relay.nickname
+        result.fp = relay.fingerprint
+        result.link = self.options.links
+        if relay.exit:
+            result.exit = True
+        if relay.guard:
+            result.guard = True
+        result.cc = relay.country
+        result.primary_ip = relay.primary_ip
+        result.as_no = relay.as_number
+        result.as_name = relay.as_name
+        result.as_info = "%s %s" %(result.as_no, result.as_name)
+        result.bitcoin_address = relay.bitcoin_address
+        results.append(result)
+
+      # JSON for the relay fields is only encoded once per snapshot
+      for (row, result), fragment in zip(new, relay_fragments([result for _, result in new])):
+        result.fragment = fragments[row] = fragment
+
+      return results
+
+
+def _group_sums(group, count, weights=None):
+    """
+    Count the entries of each of count groups, or sum their weights.
+    """
+    if not count:
+        return numpy.zeros(0, dtype=numpy.int64)
+    sums = numpy.bincount(group, weights, count)
+    return sums if weights is None or weights.dtype.kind == 'f' else sums.astype(numpy.int64)
 
-        #Include our weight values
-        for weight in group_weights.iterkeys():
-          result['cw'] = group_weights['consensus_weight_fraction'] * 100.0
-          result['adv_bw'] = group_weights['advertised_bandwidth_fraction'] * 100.0
-          result['p_guard'] = group_weights['guard_probability'] * 100.0
-          result['p_middle'] = group_weights['middle_probability'] * 100.0
-          result['p_exit'] = group_weights['exit_probability'] * 100.0
 
+class RelayGroups(object):
+    """
+    The snapshot rows which passed the filters aggregated by country, AS
+    and/or /16 network in a single pass, one result line per group. Weights
+    are summed per group and the relays, exits, guards and distinct
+    countries, ASes and networks in each group are counted.
+    """
+    def __init__(self, snapshot, rows, options):
+        self.snapshot = snapshot
+        self.rows = rows
+        self.options = options
+        table = snapshot.table
+
+        # Combine the codes of every grouping column into one key per row
+        key = numpy.zeros(len(rows), dtype=numpy.int64)
+        for enabled, codes, labels in ((options.by_country, table.country, table.countries),
+                                       (options.by_as, table.as_number, table.as_numbers),
+                                       (options.by_network_family, table.network, table.networks)):
+            if enabled:
+                key = key * max(len(labels), 1) + codes[rows]
+        keys, self.group = numpy.unique(key, return_inverse=True)
+        count = len(keys)
+
+        self._weights = dict((weight, _group_sums(self.group, count, getattr(table, weight)[rows]))
+                             for weight in RelayStats.SORT_COLUMNS)
+        flags = table.flags[rows]
+        exits = ((flags & FLAG_BITS['Exit']) != 0) & ((flags & FLAG_BITS['BadExit']) == 0)
+        self.relays = _group_sums(self.group, count)
+        self.exits = _group_sums(self.group, count, exits)
+        self.guards = _group_sums(self.group, count, (flags & FLAG_BITS['Guard']) != 0)
+        self.countries = self._distinct(table.country[rows], len(table.countries))
+        self.ases = self._distinct(table.as_number[rows], len(table.as_numbers))
+        self.networks = self._distinct(table.network[rows], len(table.networks))
+
+        # Member positions into rows, grouped and in row order within a group
+        self._members = numpy.argsort(self.group, kind='mergesort')
+        self._ends = numpy.cumsum(self.relays)
+
+    def _distinct(self, codes, size):
+        pairs = numpy.unique(self.group.astype(numpy.int64) * max(size, 1) + codes)
+        return _group_sums(pairs // max(size, 1), len(self))
+
+    def __len__(self):
+        return len(self.relays)
+
+    def column(self, name):
+        return self._weights[name]
+
+    def members(self, group):
+        end = self._ends[group]
+        return self.rows[self._members[end - self.relays[group]:end]]
+
+    def results(self, positions):
+      """
+      Return a Result object for each group at positions. The first relay of
+      the group supplies the fields which are shared by the whole group.
+      """
+      options = self.options
+      table = self.snapshot.table
+      results = []
+      for group in positions:
+        members = self.members(group).tolist()
+        member_relays = self.snapshot.select(members)
+        relay = member_relays[0]
+        result = Result()
+        for weight in RelayStats.SORT_COLUMNS:
+          setattr(result, weight, float(self._weights[weight][group]))
+
+        # We have no links if we're grouping
+        result.link = False
+        result.nick = "*"
+        result.fp = "(%d relays)" % self.relays[group]
+        result.exit = "(%d)" % self.exits[group]
+        result.guard = "(%d)" % self.guards[group]
+        result.cc = relay.country
+        result.as_no = relay.as_number
+        result.as_name = relay.as_name
+        result.as_info = "%s %s" %(result.as_no, result.as_name)
+        if not options.by_as and not options.ases:
+            result.as_info = "(%d)" % self.ases[group]
+        if not options.by_country and not options.country:
+            result.cc = "(%d)" % self.countries[group]
+        if not options.by_network_family:
+            result.primary_ip = "(%d diff. /16)" % self.networks[group]
+        else:
+            result.primary_ip = table.networks[table.network[members[0]]]
+
+        # The group's donation share is split between its relays
+        result.members = [(member.bitcoin_address, cw) for member, cw in
+                          itertools.izip(member_relays, table.cw[members].tolist())]
+        result.bitcoin_address = "(%d)" % len(set(address for address, _ in result.members))
         results.append(result)
 
       return results
 
 
-#@cache.memoize(timeout=300)
-def determine_relays(options):
+class Selection(object):
+    """
+    A relay selection as returned by determine_relays together with its
+    JSON encoding. The plain and gzipped bodies are produced on first use
+    and reused by every later request for the same selection.
+    """
+    def __init__(self, relays, etag):
+        self.relays = relays
+        self.etag = etag
+        self._body = None
+        self._gzip_body = None
+
+    @property
+    def body(self):
+        if self._body is None:
+            self._body = encode_relays(self.relays)
+        return self._body
+
+    @property
+    def gzip_body(self):
+        if self._gzip_body is None:
+            buf = StringIO.StringIO()
+            with gzip.GzipFile(fileobj=buf, mode='wb', mtime=0) as gzip_file:
+                gzip_file.write(self.body)
+            self._gzip_body = buf.getvalue()
+        return self._gzip_body
+
+# Selections are shared between requests and must be treated as read-only
+result_cache = LRUCache(app.config.get('RESULT_CACHE_SIZE', 128))
+
+def cached_selection(options):
+    """
+    Return the Selection for these options, building it only if it isn't
+    cached for the current relay snapshot yet. Options without a cache key
+    are selected every time.
+    """
     stats = RelayStats(options)
-    results = stats.select_relays(stats.relays, options)
-    relays = stats.sort_and_reduce(results, options)
-    relays['relays_published'] = stats.data.get('relays_published')
-    return relays
+    snapshot = stats.snapshot
+    options_key = options.cache_key()
+    if options_key is None:
+        key = (snapshot.version, repr(options))
+        selection = None
+    else:
+        key = (snapshot.version, options_key)
+        selection = result_cache.get(key)
+    if selection is None:
+        relays = stats.sort_and_reduce(stats.relays, options)
+        relays['relays_published'] = snapshot.relays_published
+        selection = Selection(relays, hashlib.sha1(repr(key)).hexdigest())
+        if options_key is not None:
+            result_cache.put(key, selection)
+    return selection
+
+def determine_relays(options):
+    return cached_selection(options).relays
+
+ONIONOO_DETAILS_URL = 'https://onionoo.torproject.org/details?type=relay'
+
+# Relay fields written to details.json, everything else is dropped while streaming
+RETAINED_FIELDS = ['nickname', 'fingerprint', 'or_addresses', 'running', 'flags',
+                   'country', 'as_number', 'as_name', 'family', 'bitcoin_address',
+                   'consensus_weight_fraction', 'advertised_bandwidth_fraction',
+                   'guard_probability', 'middle_probability', 'exit_probability']
+
+def download_details_file(source=None):
+    """
+    Open the Onionoo details document for streaming. If source is given it is
+    a previously saved response which is replayed from disk instead.
+    """
+    if source:
+        return open(source, 'rb')
+    return urllib.urlopen(ONIONOO_DETAILS_URL)
+
+def iter_details(details_file, header):
+    """
+    Incrementally parse an Onionoo details document, yielding one relay dict
+    at a time. Top-level scalar fields such as relays_published are stored in
+    header as they are encountered.
+    """
+    builder = None
+    for prefix, event, value in ijson.parse(details_file):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == 'relays.item' and event == 'end_map':
+                yield builder.value
+                builder = None
+        elif prefix == 'relays.item' and event == 'start_map':
+            builder = ijson.common.ObjectBuilder()
+            builder.event(event, value)
+        elif '.' not in prefix and event in ('string', 'number', 'boolean', 'null'):
+            header[prefix] = value
+
+SERVER_DESCRIPTORS_RESOURCE = '/tor/server/all.z'
+
+X_BITCOIN_RE = re.compile(r'^X-bitcoin (.*)$', re.MULTILINE)
+FINGERPRINT_RE = re.compile(r'^(?:opt )?fingerprint ((?:[0-9A-F]{4} ?){10})', re.MULTILINE)
+
+def download_server_descriptors(source=None):
+    """
+    Return the raw text of all current server descriptors, downloaded from a
+    directory authority or read from a cached descriptor archive (such as
+    tor's cached-descriptors or a saved all.z document) if source is given.
+    """
+    if source:
+        with open(source, 'rb') as descriptors_file:
+            raw_descriptors = descriptors_file.read()
+    else:
+        authorities = [authority for authority in get_authorities().values() if authority.dir_port]
+        random.shuffle(authorities)
+        for authority in authorities:
+            url = 'http://%s:%i%s' % (authority.address, authority.dir_port, SERVER_DESCRIPTORS_RESOURCE)
+            try:
+                raw_descriptors = urllib2.urlopen(url, timeout=60).read()
+                break
+            except (IOError, httplib.HTTPException):
+                continue
+        else:
+            raise IOError('No directory authority provided the server descriptors')
+
+    if raw_descriptors.startswith('\x1f\x8b'):
+        return zlib.decompress(raw_descriptors, 16 + zlib.MAX_WBITS)
+    if not raw_descriptors.startswith(('router ', '@')):
+        return zlib.decompress(raw_descriptors)
+    return raw_descriptors
 
-def download_details_file():
-    url = urllib.urlopen('https://onionoo.torproject.org/details?type=relay')
-    return url.read()
+def split_descriptors(raw_descriptors, chunk_size):
+    """
+    Return (start, end) offsets splitting raw_descriptors into chunks of
+    roughly chunk_size bytes which only break between descriptors.
+    """
+    chunks = []
+    start = 0
+    while start < len(raw_descriptors):
+        end = raw_descriptors.find('\nrouter ', start + chunk_size)
+        end = len(raw_descriptors) if end == -1 else end + 1
+        chunks.append((start, end))
+        start = end
+    return chunks
+
+class AddressCache(object):
+    """
+    Persistent record of the bitcoin address extracted from each relay's
+    contact and X-bitcoin fields, keyed by fingerprint and a hash of the
+    field text. Fields which haven't changed since the last download skip
+    the regex and checksum validation in extract_bitcoin_address.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._entries = {}
+        self._seen = set()
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache_file:
+                    self._entries = json.load(cache_file)
+            except ValueError:
+                pass
+
+    @staticmethod
+    def _key(fingerprint, source):
+        return '%s:%s' % (fingerprint, source)
+
+    def lookup(self, fingerprint, source, text):
+        """
+        Return (digest, address, cached) for a field. Only fields which
+        changed since they were cached are run through extract_bitcoin_address.
+        """
+        digest = hashlib.sha1(text.encode('utf-8') if isinstance(text, unicode) else text).hexdigest()
+        entry = self._entries.get(self._key(fingerprint, source))
+        if entry is not None and entry[0] == digest:
+            return digest, entry[1], True
+        return digest, extract_bitcoin_address(text), False
+
+    def record(self, fingerprint, source, digest, address, cached):
+        self._seen.add(fingerprint)
+        if cached:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self._entries[self._key(fingerprint, source)] = [digest, address]
+
+    def extract(self, fingerprint, source, text):
+        digest, address, cached = self.lookup(fingerprint, source, text)
+        self.record(fingerprint, source, digest, address, cached)
+        return address
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return 100.0 * self.hits / lookups if lookups else 0.0
+
+    def save(self):
+        """
+        Write the cache to disk, evicting relays which weren't seen during
+        this run because they have left the network. Returns the number of
+        evicted relays.
+        """
+        entries = dict((key, entry) for key, entry in self._entries.iteritems()
+                       if key.rsplit(':', 1)[0] in self._seen)
+        evicted = (len(set(key.rsplit(':', 1)[0] for key in self._entries)) -
+                   len(set(key.rsplit(':', 1)[0] for key in entries)))
+        self._entries = entries
+        if self.path:
+            with tempfile.NamedTemporaryFile(dir=os.path.dirname(self.path), delete=False) as temp_file:
+                json.dump(entries, temp_file)
+            shutil.move(temp_file.name, self.path)
+        return evicted
+
+def extract_chunk_addresses(chunk, address_cache):
+    """
+    Return the number of server descriptors in a chunk of raw descriptor text
+    and a (fingerprint, digest, address, cached) tuple for each X-bitcoin
+    field, as returned by address_cache.lookup.
+    """
+    results = []
+    for x_bitcoin_field in X_BITCOIN_RE.finditer(chunk):
+        # Only the descriptor holding this field is searched for its fingerprint
+        start = chunk.rfind('\nrouter ', 0, x_bitcoin_field.start()) + 1
+        end = chunk.find('\nrouter ', x_bitcoin_field.end())
+        fingerprint = FINGERPRINT_RE.search(chunk, start, len(chunk) if end == -1 else end)
+        if fingerprint:
+            fingerprint = fingerprint.group(1).replace(' ', '')
+            results.append((fingerprint,) + address_cache.lookup(fingerprint, 'x-bitcoin', x_bitcoin_field.group(1)))
+    return chunk.count('\nrouter ') + chunk.startswith('router '), results
+
+# Raw descriptors and address cache inherited by the worker processes of
+# extract_x_bitcoin_addresses
+_worker_descriptors = None
+_worker_address_cache = None
+
+def _init_descriptor_worker(raw_descriptors, address_cache):
+    global _worker_descriptors, _worker_address_cache
+    _worker_descriptors = raw_descriptors
+    _worker_address_cache = address_cache
+
+def _extract_descriptor_range(bounds):
+    start, end = bounds
+    return extract_chunk_addresses(_worker_descriptors[start:end], _worker_address_cache)
+
+def extract_x_bitcoin_addresses(raw_descriptors, address_cache=None, processes=None):
+    """
+    Parse the X-bitcoin fields of raw server descriptors in chunks spread
+    across a process pool. Returns the bitcoin addresses keyed by
+    fingerprint and the number of descriptors which were parsed.
+    """
+    address_cache = address_cache or AddressCache()
+    processes = processes or multiprocessing.cpu_count()
+    chunk_size = max(len(raw_descriptors) // (processes * 4), 64 * 1024)
+    pool = multiprocessing.Pool(processes, _init_descriptor_worker, (raw_descriptors, address_cache))
+    try:
+        results = pool.map(_extract_descriptor_range, split_descriptors(raw_descriptors, chunk_size))
+    finally:
+        pool.close()
+        pool.join()
 
-def check_and_update_bitcoin_fields(relay_details):
+    extracted_addresses = {}
+    descriptor_count = 0
+    for chunk_count, chunk_results in results:
+        descriptor_count += chunk_count
+        for fingerprint, digest, bitcoin_address, cached in chunk_results:
+            address_cache.record(fingerprint, 'x-bitcoin', digest, bitcoin_address, cached)
+            if bitcoin_address:
+                extracted_addresses[fingerprint] = bitcoin_address
+    return extracted_addresses, descriptor_count
+
+def check_and_update_bitcoin_fields(details_source=None, descriptors_source=None, compact=False):
     """
     Load full descriptors and parse bitcoin address from X-bitcoin and contact fields then update
     the details.json file with the bitcoin address as a bitcoin_address field. The X-bitcoin field
     takes precedence over the contact field if both both contain bitcoin addresses.
-    """
-    data = json.loads(relay_details)
 
-    downloader = DescriptorDownloader()
+    The details document is streamed relay by relay, only relays with a bitcoin address are
+    kept and only their RETAINED_FIELDS are written out. Returns the number of relays written.
+
+    Changes since the previous download are recorded as a delta file. Once DELTA_COMPACT_INTERVAL
+    deltas have been written, or if compact is set, details.json is rewritten in full instead.
+    """
+    address_cache = AddressCache(ADDRESS_CACHE_FILE)
     extracted_addresses = {}
     try:
-      # Parse X-bitcoin fields from the network consensus
-      for relay_desc in downloader.get_server_descriptors().run():
-        x_bitcoin_field = re.search("^X-bitcoin (.*)", str(relay_desc), re.MULTILINE)
-        if x_bitcoin_field:
-            if extract_bitcoin_address(x_bitcoin_field.group()):
-                extracted_addresses[relay_desc.fingerprint] = extract_bitcoin_address(x_bitcoin_field.group())
+        # Parse X-bitcoin fields from the network consensus
+        raw_descriptors = download_server_descriptors(descriptors_source)
+        started = time.time()
+        extracted_addresses, descriptor_count = extract_x_bitcoin_addresses(raw_descriptors, address_cache)
+        elapsed = max(time.time() - started, 0.001)
+        print "Parsed {} server descriptors in {:.2f}s ({:.0f} descriptors/s), {} X-bitcoin addresses found".format(
+            descriptor_count, elapsed, descriptor_count / elapsed, len(extracted_addresses))
     except Exception as exc:
         print "Unable to retrieve the network consensus: %s" % exc
 
-    for relay in data['relays']:
-        # Check if a bitcoin address was already extracted from X-bitcoin field
-        if relay.get('fingerprint') in extracted_addresses:
-            relay['bitcoin_address'] = extracted_addresses[relay.get('fingerprint')]
-
-        # Parse bitcoin addresses from the contact field of details.json
-        elif relay.get('contact') is not None:
-            if extract_bitcoin_address(relay.get('contact')):
-                relay['bitcoin_address'] = extract_bitcoin_address(relay.get('contact'))
-
-    # Remove any relays without a bitcoin address or with weight_fraction of -1.0 as they can't be used
-    # to determine donation share
-    data['relays'][:] = [relay for relay in data['relays'] if (relay.get('bitcoin_address'))]
+    details_file_path = DETAILS_FILE
 
-    with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-        temp_file_name = temp_file.name
-        json.dump(data, temp_file)
+    header = {}
+    relay_count = 0
+    details_file = download_details_file(details_source)
+    try:
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(details_file_path), delete=False) as temp_file:
+            temp_file_name = temp_file.name
+            temp_file.write('{"relays": [\n')
+            for relay in iter_details(details_file, header):
+                # Check if a bitcoin address was already extracted from X-bitcoin field,
+                # otherwise parse bitcoin addresses from the contact field
+                bitcoin_address = extracted_addresses.get(relay.get('fingerprint'))
+                if not bitcoin_address and relay.get('contact') is not None:
+                    bitcoin_address = address_cache.extract(relay.get('fingerprint'), 'contact', relay.get('contact'))
+
+                # Drop relays without a bitcoin address as they can't receive a donation share
+                if not bitcoin_address:
+                    continue
+                relay['bitcoin_address'] = bitcoin_address
+
+                if relay_count:
+                    temp_file.write(',\n')
+                # ijson returns non-integer numbers as Decimals
+                json.dump(dict((field, relay[field]) for field in RETAINED_FIELDS if field in relay),
+                          temp_file, default=float)
+                relay_count += 1
+            temp_file.write('\n]')
+            for key, value in header.iteritems():
+                temp_file.write(', %s: %s' % (json.dumps(key), json.dumps(value, default=float)))
+            temp_file.write('}\n')
+    finally:
+        details_file.close()
+
+    evicted = address_cache.save()
+    print "Bitcoin address cache: {} hits, {} misses ({:.1f}% hit rate), {} departed relays evicted".format(
+        address_cache.hits, address_cache.misses, address_cache.hit_rate(), evicted)
+
+    snapshot = RelaySnapshot.from_file(temp_file_name)
+    previous = None
+    if (not compact and os.path.exists(details_file_path) and
+            len(list_deltas(details_file_path)) < app.config.get('DELTA_COMPACT_INTERVAL', 24)):
+        try:
+            previous = load_latest_snapshot(details_file_path)
+        except ValueError, err:
+            print "Unable to apply the recorded deltas ({}), compacting them".format(err)
+    if previous is not None:
+        # Only record what changed so web workers can update their snapshot in place
+        delta = snapshot.diff(previous)
+        name = write_delta(details_file_path, delta)
+        os.remove(temp_file_name)
+        # Web workers re-map the updated binary snapshot instead of each
+        # applying the delta themselves
+        snapshot.write_binary(binary_path(details_file_path), os.stat(details_file_path).st_mtime, name)
+        print "Wrote delta {}: {} relays added, {} removed, {} changed".format(
+            name, len(delta['added']), len(delta['removed']), len(delta['changed']))
+        return relay_count
 
     # Atomically move the new json file to avoid errors where Oniontip
     # tries to parse a partially written json file.
-    details_file_path = os.path.join(os.path.dirname(
-        os.path.abspath(__file__)), 'details.json')
     shutil.move(temp_file_name, details_file_path)
+
+    # Web workers memory-map the binary form instead of parsing details.json
+    snapshot.write_binary(binary_path(details_file_path))
+    clear_deltas(details_file_path)
+    print "Compacted relay deltas into a full details.json"
+    return relay_count
@@ -1,24 +1,41 @@
-from flask import request, jsonify, render_template, Response, send_file
+from flask import request, jsonify, render_template, Response
 from flask.ext.sqlalchemy import SQLAlchemy
 
-from oniontip import app, db
-from models import ForwardAddress, DataStore
+from oniontip import app, db, cache
+from models import ForwardAddress, ForwardJob, ForwardTransaction, DataStore
+import blockchain
+import jobs
 import util
 
 import os
 import sys
 import re
 import json
-import qrcode
-import StringIO
 import math
 import bitcoin # pybitcointools
+import bitcoinaddress
 import datetime
+import itertools
+from multiprocessing.pool import ThreadPool
 from werkzeug.contrib.atom import AtomFeed
 
 TX_FEE_PER_KB = 10000   # 
 MIN_OUTPUT = 5460       # Bitcoin dust limit
 
+blockchain_backend = blockchain.create_backend(app.config)
+
+@app.before_first_request
+def start_snapshot_reloader():
+    util.snapshot_reloader.start()
+
+@app.before_first_request
+def start_key_pool_filler():
+    util.key_pool.start()
+
+@app.before_first_request
+def start_forward_workers():
+    forward_workers.start()
+
 @app.route('/')
 def index():
     return render_template('home.html', script_root=request.script_root, total_donated=total_donated())
@@ -29,30 +46,55 @@ def format_transaction(payment):
         'time': payment.created.strftime("%Y-%m-%d %H:%M:%S"),
         'address': payment.address,
         'tx_hash': payment.spending_tx,
-        'num_outputs': len(payment.outputs),
+        'num_outputs': payment.num_outputs,
         'value': payment.donation_amount,
         'value_formatted': util.format_bitcoin_value(payment.donation_amount)
         }
     return transaction
 
 
+def spent_payments(limit, before=None):
+    """
+    Most recent spent addresses, newest first. before is the id of the last
+    address on the previous page.
+    """
+    query = ForwardAddress.query.filter_by(spent=True)
+    if before is not None:
+        query = query.filter(ForwardAddress.id < before)
+    return query.order_by(ForwardAddress.id.desc()).limit(limit).all()
+
+
 @app.route('/transactions')
 def previous_transactions():
-    payment_addresses = ForwardAddress.query.filter_by(spent=1).all()
-    transactions = [format_transaction(payment) for payment in payment_addresses]
-    return render_template('transactions.html', script_root=request.script_root, total_donated=total_donated(), transactions=transactions)
+    per_page = app.config.get('TRANSACTIONS_PER_PAGE', 50)
+    before = request.args.get('before', type=int)
+    # One extra row tells whether there is an older page
+    payment_addresses = spent_payments(per_page + 1, before)
+    older = payment_addresses[per_page - 1].id if len(payment_addresses) > per_page else None
+    transactions = [format_transaction(payment) for payment in payment_addresses[:per_page]]
+    return render_template('transactions.html', script_root=request.script_root, total_donated=total_donated(),
+                           transactions=transactions, newer=before is not None, older=older)
 
 
 @app.route('/transactions/feed')
 def previous_transactions_feed():
-    """Provide an Atom feed listing recent transactions."""
+    """
+    Provide an Atom feed listing recent transactions. The feed is cached
+    until the donation total changes, ie. a new spend is recorded.
+    """
+    cache_key = 'transactions_feed:{}:{}'.format(total_donated_value(), request.url)
+    body = cache.get(cache_key)
+    if body is None:
+        body = render_transactions_feed()
+        # Keyed on the total, so it only needs to expire to free the memory
+        cache.set(cache_key, body, timeout=24 * 60 * 60)
+    return Response(body, mimetype='application/atom+xml')
+
+def render_transactions_feed():
     feed = AtomFeed('OnionTip - Recent Transactions',
                     feed_url=request.url,
                     url=request.url_root)
-    payment_addresses = ForwardAddress.query \
-        .filter_by(spent=1).order_by(ForwardAddress.created.desc()) \
-        .limit(50).all()
-    for payment in payment_addresses:
+    for payment in spent_payments(50):
         item_title = 'New transaction %s' % payment.spending_tx
         item_content = render_template('transaction_feed.html',
                                        script_root=request.script_root,
@@ -63,14 +105,36 @@ def previous_transactions_feed():
                  content_type='html',
                  published=payment.created,
                  updated=payment.created)
-    return feed.get_response()
+    return feed.to_string()
 
 
 @app.route('/result.json', methods=['GET'])
 def json_result():
     options = util.Opt(dict(request.args.items()))
-    relays = util.determine_relays(options)
-    return Response(json.dumps(relays, cls=util.ResultEncoder), mimetype='application/json')
+    selection = util.cached_selection(options)
+    gzipped = app.config.get('RESULT_GZIP') and 'gzip' in request.accept_encodings
+    # The gzip and identity bodies differ byte for byte, so each gets its own ETag
+    etag = selection.etag + '-gz' if gzipped else selection.etag
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    elif gzipped:
+        response = Response(selection.gzip_body, mimetype='application/json')
+        response.headers['Content-Encoding'] = 'gzip'
+    else:
+        response = Response(selection.body, mimetype='application/json')
+    response.set_etag(etag)
+    response.vary.add('Accept-Encoding')
+    return response
+
+@app.route('/status.json', methods=['GET'])
+def status():
+    """Report cache counters and relay data reload metrics for monitoring"""
+    return Response(json.dumps({
+        'result_cache': util.result_cache.stats(),
+        'relay_snapshot': util.snapshot_reloader.stats(),
+        'key_pool': util.key_pool.stats(),
+        'forward_jobs': forward_workers.stats()
+        }), mimetype='application/json')
 
 @app.route('/payment.json', methods=['GET'])
 def payment_info():
@@ -82,21 +146,17 @@ def payment_info():
     relays = util.determine_relays(options)
 
     for relay in relays['results']:
-        # If this address already has an output, add the share
-        if relay.bitcoin_address in outputs:
-            outputs[relay.bitcoin_address] += relay.donation_share
-        else:
-            outputs[relay.bitcoin_address] = relay.donation_share
+        # Relay groups pay out to each of their relays
+        for bitcoin_address, donation_share in relay.payouts():
+            # If this address already has an output, add the share
+            if bitcoin_address in outputs:
+                outputs[bitcoin_address] += donation_share
+            else:
+                outputs[bitcoin_address] = donation_share
             
     if outputs:
-        '''
-        Retrieve last id and provide it when creating next privkey from seed.
-        NOTE: Possible race condition? Two people may get the same address?
-        '''
-        last_address = ForwardAddress.query.order_by(ForwardAddress.id.desc()).first()
-        previous_id = last_address.id if last_address else 0
-
-        donation_request = ForwardAddress(outputs=outputs, previous_n=previous_id)
+        # The slot claim is rolled back along with the address if the commit fails
+        donation_request = ForwardAddress(outputs=outputs, key_slot=util.key_pool.claim())
         db.session.add(donation_request)
         db.session.commit()
 
@@ -114,35 +174,75 @@ def payment_info():
 
 @app.route('/qr/<address>')
 def get_qrcode(address):
-    """Generate a QR Code"""
-    qr = qrcode.QRCode(
-        version=None,
-        error_correction=qrcode.constants.ERROR_CORRECT_L,
-        box_size=6,
-        border=2,
-    )
-
-    qr.add_data('bitcoin:'+str(address))
-    qr.make(fit=True)
-
-    img = qr.make_image()
-
-    img_io = StringIO.StringIO()
-    img.save(img_io, 'PNG')
-    img_io.seek(0)
+    """Generate a QR Code, as SVG with ?format=svg"""
+    image_format = request.args.get('format', 'png')
+    if image_format not in util.QRCODE_MIMETYPES:
+        return Response(json.dumps({'status': 'Unsupported image format'}), mimetype='application/json'), 400
+    if not bitcoinaddress.validate(address):
+        return Response(json.dumps({'status': 'Invalid bitcoin address'}), mimetype='application/json'), 404
+
+    # The image for an address never changes
+    etag = util.qrcode_etag(address, image_format)
+    if etag in request.if_none_match:
+        response = Response(status=304)
+    else:
+        response = Response(util.render_qrcode(address, image_format),
+                            mimetype=util.QRCODE_MIMETYPES[image_format])
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = app.config.get('QRCODE_MAX_AGE', 31536000)
+    return response
+
+def fetch_histories(addresses):
+    '''
+    Look up the transaction history of a batch of addresses. Returns a
+    (history, error) pair for each address so lookups can run on worker
+    threads and be handled later.
+    '''
+    try:
+        histories = blockchain_backend.history_many(addresses)
+    except Exception, err:
+        return dict((address, (None, err)) for address in addresses)
+    return dict((address, (histories[address], None)) for address in addresses)
 
-    return send_file(img_io, mimetype='image/png')
+def fetch_history(address):
+    return fetch_histories([address])[address]
 
-def check_and_send(address):
+def check_and_send(address, history=None):
     '''
     Check generated address and forwarded any unspent outputs
 
     Check_and_send does the heavy lifting for creating the bitcoin transactions for
-    users on the web interface and for requests from the automated cronjob on the CLI
+    users on the web interface and for requests from the automated cronjob on the CLI.
+    history is the result of fetch_history if the address was already looked up.
+
+    Only one process forwards from an address at a time, others fail straight
+    away without looking up the address history.
     '''
+    if not ForwardAddress.query.filter_by(address=address).count():
+        app.logger.error('Could not find keys for addresss {} in the database'.format(address))
+        return {'status': 'fail',
+                'data': {
+                    'message': 'Could not find the keys for this address in the database.',
+                    'code': 404
+                    }}
+
+    lease = ForwardAddress.acquire_lease(address, app.config.get('FORWARD_LEASE_TIMEOUT', 120))
+    if lease is None:
+        app.logger.info('Donations to {} are already being forwarded by another worker'.format(address))
+        return {'status': 'fail',
+                'data': {
+                    'message': 'The donations to this address are already being forwarded, please wait a moment.',
+                    'code': 409
+                }}
     try:
-        address_history = bitcoin.history(address)
-    except Exception, err:
+        return forward_unspent(address, history)
+    finally:
+        ForwardAddress.release_lease(address, lease)
+
+def forward_unspent(address, history=None):
+    address_history, err = history or fetch_history(address)
+    if err is not None:
         app.logger.error('Error retrieving address history for {} from blockchain.info: {}'.format(address, str(err)))
         return {'status': 'error',
                 'message': '<strong>Blockchain.info Error:</strong> {}'.format(str(err))
@@ -166,113 +266,134 @@ def check_and_send(address):
                 }}
 
     address_info = ForwardAddress.query.filter_by(address=address).first()
-    if address_info:
-        estimate_fee = util.calculate_fee(num_inputs=len(address_unspent),num_outputs=len(address_info.outputs), kb_tx_fee=TX_FEE_PER_KB)
-        unspent_value = sum(output.get('value') for output in address_unspent)
-        spendable_value = unspent_value - estimate_fee 
-        if spendable_value <= 0:
-            app.logger.warn('Not enough unspent bitcoin at address {} to pay tx fee of {} satoshi. '.format(address, estimate_fee))
-            return {'status': 'fail',
-                    'data': {
-                        'message': 'There is not enough unspent bitcoin at this address to pay the transaction fee of {} satoshis.'.format(estimate_fee),
-                        'code': 500
-                    }}
-        
-        outs = []
-        discarded_value = 0
-        # Create the outputs, if any are too small, remove them and add them to remaining as can only get bigger
-        for address, donation_percent in address_info.outputs.iteritems():
-            value = int(math.floor((donation_percent * 0.01) * spendable_value))
-            if value >= MIN_OUTPUT:
-                outs.append({
-                    'address': address,
-                    'value': value
-                })
-            else:
-                discarded_value += value
-        if discarded_value > 0:
-            for out in outs:
-                new_ratio = float(out['value']) / (spendable_value - discarded_value)
-                out['value'] += int(math.floor(new_ratio * discarded_value))
-
-        if not outs:
-            app.logger.warn('Could not find addresses suitable to spend to from {}. Outputs may be too small.'.format(address))
-            return {'status': 'fail',
-                    'data': {
-                        'message': 'There are no addresses to where the donation can be successfully forwarded. The value of the donation may be too low, try sending a little more.',
-                        'code': 500
-                    }}
+    outpoints = ForwardTransaction.outpoints_key(address_unspent)
+    forward_tx = ForwardTransaction.query.filter_by(outpoints=outpoints).first()
+    if forward_tx and forward_tx.pushed:
+        # The explorer hasn't seen the forwarding transaction spend these outputs yet
+        app.logger.info('Unspent outputs of {} were already forwarded in tx {}'.format(address, forward_tx.tx_hash))
+        return forward_success(forward_tx.tx_hash)
+
+    estimate_fee = util.calculate_fee(num_inputs=len(address_unspent),num_outputs=len(address_info.outputs), kb_tx_fee=TX_FEE_PER_KB)
+    unspent_value = sum(output.get('value') for output in address_unspent)
+    spendable_value = unspent_value - estimate_fee 
+    if spendable_value <= 0:
+        app.logger.warn('Not enough unspent bitcoin at address {} to pay tx fee of {} satoshi. '.format(address, estimate_fee))
+        return {'status': 'fail',
+                'data': {
+                    'message': 'There is not enough unspent bitcoin at this address to pay the transaction fee of {} satoshis.'.format(estimate_fee),
+                    'code': 500
+                }}
+    
+    outs = []
+    discarded_value = 0
+    # Create the outputs, if any are too small, remove them and add them to remaining as can only get bigger
+    for output_address, donation_percent in address_info.outputs.iteritems():
+        value = int(math.floor((donation_percent * 0.01) * spendable_value))
+        if value >= MIN_OUTPUT:
+            outs.append({
+                'address': output_address,
+                'value': value
+            })
+        else:
+            discarded_value += value
+    if discarded_value > 0:
+        for out in outs:
+            new_ratio = float(out['value']) / (spendable_value - discarded_value)
+            out['value'] += int(math.floor(new_ratio * discarded_value))
+
+    if not outs:
+        app.logger.warn('Could not find addresses suitable to spend to from {}. Outputs may be too small.'.format(address))
+        return {'status': 'fail',
+                'data': {
+                    'message': 'There are no addresses to where the donation can be successfully forwarded. The value of the donation may be too low, try sending a little more.',
+                    'code': 500
+                }}
+    tx_total = sum(out.get('value') for out in outs)
 
+    if forward_tx is None:
         raw_tx = bitcoin.transaction.mktx(address_unspent, outs)
-        tx = bitcoin.transaction.signall(raw_tx, address_info.private_key)
-        tx_hash = bitcoin.transaction.txhash(tx)
-
-        try:
-            try:
-                push_result = bitcoin.pushtx(tx)
-            except:
-                push_result = bitcoin.blockr_pushtx(tx)
-            tx_total = sum(out.get('value') for out in outs)
-
-            # This address has been successfully spent from, update tx info and don't check it again.
-            address_info.spent = True
-            address_info.spending_tx = tx_hash
-            address_info.donation_amount = tx_total
-
-            # Keep a total of all bitcoins tipped
-            total_donated = DataStore.query.filter_by(key='total_donated').first()
-            if total_donated:
-                total_donated.value = int(int(total_donated.value) + tx_total)
-            else:
-                total_donated = DataStore('total_donated', tx_total)
-                db.session.add(total_donated)
-            db.session.commit()
-
-            app.logger.info('Transaction successfully sent {} satoshi from {} in tx {}.'.format(tx_total, address, tx_hash))
-            return {'status': 'success',
-                    'data': {
-                        'message': '<strong>Success!</strong> Your transaction was received and forwarded to your selected relays. '
-                                    '<a target="_blank" href="https://blockchain.info/tx/'+tx_hash+'">'+tx_hash[0:10]+'..</a>',
-                        'tx_hash': tx_hash
-                    }}
-        except Exception, err:
-            if err:
-                app.logger.error('Error from blockchain.info when sending tx from address {}: {}.'.format(address, str(err)))
-                return {'status': 'error',
-                        'message': '<strong>Blockchain.info Error:</strong> {}.'.format(err)
-                        }
-            else:
-                app.logger.error('Unknown error when pushing forwarding tx to blockchain.info for addresss {}'.format(address))
-                return {'status': 'error',
-                        'message': 'There was an unknown error when trying to push the forwarding transaction to the blockchain.'
-                        }
-
+        tx = bitcoin.transaction.signall(raw_tx, str(address_info.private_key))
+        forward_tx = ForwardTransaction.record(outpoints, address, tx, tx_total)
     else:
-        app.logger.error('Could not find keys for addresss {} in the database'.format(address))
-        return {'status': 'fail',
-                'data': {
-                    'message': 'Could not find the keys for this address in the database.',
-                    'code': 404
-                    }}
+        # A previous attempt signed a transaction for these outputs but didn't push it
+        app.logger.info('Retrying tx {} from address {}'.format(forward_tx.tx_hash, address))
+    tx_hash = forward_tx.tx_hash
+    # Make sure the increment below has a row to update
+    DataStore.setdefault('total_donated', 0)
+
+    try:
+        # The database returns the hex transaction as unicode, pybitcointools wants str
+        push_result = blockchain_backend.pushtx(str(forward_tx.tx))
+    except Exception, err:
+        if err:
+            app.logger.error('Error from blockchain.info when sending tx from address {}: {}.'.format(address, str(err)))
+            return {'status': 'error',
+                    'message': '<strong>Blockchain.info Error:</strong> {}.'.format(err)
+                    }
+        else:
+            app.logger.error('Unknown error when pushing forwarding tx to blockchain.info for addresss {}'.format(address))
+            return {'status': 'error',
+                    'message': 'There was an unknown error when trying to push the forwarding transaction to the blockchain.'
+                    }
+
+    # This address has been successfully spent from, update tx info and don't check it again.
+    forward_tx.pushed = True
+    address_info.spent = True
+    address_info.spending_tx = tx_hash
+    address_info.donation_amount = forward_tx.value
+    address_info.num_outputs = len(address_info.forward_outputs)
+    # Outputs below the dust limit weren't paid
+    values = dict((out['address'], out['value']) for out in outs)
+    for forward_output in address_info.forward_outputs:
+        forward_output.value = values.get(forward_output.address, 0)
+
+    # Keep a total of all bitcoins tipped
+    DataStore.increment('total_donated', forward_tx.value)
+    db.session.commit()
+    cache.delete('total_donated')
+
+    app.logger.info('Transaction successfully sent {} satoshi from {} in tx {}.'.format(forward_tx.value, address, tx_hash))
+    return forward_success(tx_hash)
+
+def forward_success(tx_hash):
+    return {'status': 'success',
+            'data': {
+                'message': '<strong>Success!</strong> Your transaction was received and forwarded to your selected relays. '
+                            '<a target="_blank" href="https://blockchain.info/tx/'+tx_hash+'">'+tx_hash[0:10]+'..</a>',
+                'tx_hash': tx_hash
+            }}
 
 def find_unsent_payments(check_all=False):
     """
     Forward unspent transactions sent to oniontip addresses
 
     This function is called from the CLI to recheck recent
-    addresses (< 2 hours) for any payments which the user
-    may not have forwarded on the web UI. 
+    addresses (< 3 hours) for any payments which the user
+    may not have forwarded on the web UI. Address histories are
+    fetched in batches by CHECK_WORKERS concurrent threads, forwarding
+    and database updates happen one address at a time on this thread.
     """
+    query = ForwardAddress.query.filter_by(spent=False)
+    if not check_all:
+        query = query.filter(ForwardAddress.created > datetime.datetime.utcnow() - datetime.timedelta(hours=3))
+    addresses = [unspent.address for unspent in query.all()]
 
-    unspent_addresses = ForwardAddress.query.filter_by(spent=False).all()
     successful_txs = []
-    for unspent in unspent_addresses:
-        if ((datetime.datetime.utcnow() - unspent.created) < datetime.timedelta(hours=3)) or check_all:
-            response = check_and_send(unspent.address)
+    if not addresses:
+        return successful_txs
+    batch_size = blockchain_backend.batch_size
+    batches = [addresses[start:start + batch_size] for start in xrange(0, len(addresses), batch_size)]
+    pool = ThreadPool(min(app.config.get('CHECK_WORKERS', 8), len(batches)))
+    try:
+        results = ((address, histories[address])
+                   for batch, histories in itertools.izip(batches, pool.imap(fetch_histories, batches))
+                   for address in batch)
+        for address, history in results:
+            response = check_and_send(address, history)
             if response.get('status') == 'success':
-                app.logger.info('Transaction successfully sent from CLI from {} in tx {}.'.format(unspent.address, response['data']['tx_hash']))
+                app.logger.info('Transaction successfully sent from CLI from {} in tx {}.'.format(address, response['data']['tx_hash']))
                 successful_txs.append({
-                    'address': unspent.address,
+                    'address': address,
                     'tx_hash': response['data']['tx_hash']}
                     )
             elif response.get('status') == 'fail':
@@ -281,15 +402,60 @@ def find_unsent_payments(check_all=False):
                 app.logger.error('CLI Errror: {}'.format(response['message']))
             else:
                 app.logger.error('An unknown error occured in the application.')
+    finally:
+        pool.close()
+        pool.join()
     return successful_txs
 
-@app.route('/forward/<address>')
+forward_workers = jobs.ForwardWorkers(check_and_send,
+                                      app.config.get('FORWARD_WORKERS', 2),
+                                      app.config.get('FORWARD_POLL_INTERVAL', 5),
+                                      app.config.get('FORWARD_JOB_TIMEOUT', 300))
+
+def job_status(job):
+    return Response(json.dumps({
+        'status': job.state,
+        'data': {
+            'job_id': job.id,
+            'status_url': '{}/forward/job/{}'.format(request.script_root, job.id)
+        }}), mimetype='application/json'), 202
+
+@app.route('/forward/<address>', methods=['GET', 'POST'])
 def forward_from_address(address):
+    '''
+    Queue a job forwarding the donations received by address and return its
+    id, or the id of the job already queued for the address.
+    '''
+    if not ForwardAddress.query.filter_by(address=address).count():
+        return Response(json.dumps({'status': 'fail',
+                'data': {
+                    'message': 'Could not find the keys for this address in the database.',
+                    'code': 404
+                }}), mimetype='application/json'), 404
+    return job_status(forward_workers.enqueue(address))
+
+@app.route('/forward/job/<int:job_id>')
+def forward_job(job_id):
+    '''
+    Report the state of a forwarding job, waiting up to ?wait= seconds for it
+    to finish. Once finished, the result of check_and_send is returned with
+    the same HTTP response codes /forward/<address> used to return.
+    '''
+    wait = max(0, min(request.args.get('wait', 0, type=float), app.config.get('FORWARD_LONG_POLL', 25)))
+    job = forward_workers.wait(job_id, wait)
+    if job is None:
+        return Response(json.dumps({'status': 'fail',
+                'data': {'message': 'Unknown forwarding job.', 'code': 404}
+                }), mimetype='application/json'), 404
+    if job.state != ForwardJob.DONE:
+        return job_status(job)
+    return forward_response(json.loads(job.result))
+
+def forward_response(response):
     '''
     Parse the results of the check_and_send function and provide the
     correct HTTP response codes for display to the user on the frontend.
     '''
-    response = check_and_send(address)
     if response.get('status') == 'success':
         return Response(json.dumps(response), mimetype='application/json')
     elif response.get('status') == 'fail' or response.get('status') == 'error':
@@ -301,9 +467,18 @@ def forward_from_address(address):
     else:
         return Response(json.dumps({'message': 'An unknown error occured in the application.'}), mimetype='application/json'), 500
 
+def total_donated_value():
+    """
+    Total satoshi donated, cached for DONATION_CACHE_TIMEOUT seconds. The
+    process recording a spend drops it straight away, other processes such
+    as the web workers pick up spends by main.py --check when it expires.
+    """
+    value = cache.get('total_donated')
+    if value is None:
+        total_donated = DataStore.query.filter_by(key='total_donated').first()
+        value = int(total_donated.value) if total_donated is not None else 0
+        cache.set('total_donated', value, timeout=app.config.get('DONATION_CACHE_TIMEOUT', 60))
+    return value
+
 def total_donated():
-    total_donated = DataStore.query.filter_by(key='total_donated').first()
-    if total_donated is not None:
-        return util.format_bitcoin_value(total_donated.value)
-    else:
-        return util.format_bitcoin_value(0)
+    return util.format_bitcoin_value(total_donated_value())
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Time relay filters over synthetic snapshots of increasing size, comparing
+the old list-membership InverseFilter with the filter algebra evaluated per
+relay, as a boolean mask and over the snapshot indexes.
+'''
+
+import os
+import random
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from oniontip.snapshot import RelaySnapshot
+from oniontip.util import CountryFilter, ExitFilter, GuardFilter, RunningFilter
+
+COUNTRIES = ['de', 'us', 'fr', 'nl', 'ru', 'se', 'gb', 'ca', 'ch', 'ua']
+FLAGS = ['Exit', 'Fast', 'Guard', 'Running', 'Stable', 'Valid']
+
+
+def synthetic_snapshot(count, seed=0):
+    rng = random.Random(seed)
+    relays = []
+    for i in xrange(count):
+        relays.append({
+            'fingerprint': '%040X' % i,
+            'nickname': 'relay%d' % i,
+            'running': rng.random() < 0.9,
+            'flags': [flag for flag in FLAGS if rng.random() < 0.5],
+            'country': rng.choice(COUNTRIES),
+            'or_addresses': ['10.%d.%d.%d:9001' % (i >> 16 & 255, i >> 8 & 255, i & 255)],
+            'as_number': 'AS%d' % rng.randint(1, 500),
+            'consensus_weight_fraction': rng.random() / count,
+            'guard_probability': rng.random() / count if rng.random() < 0.4 else 0.0,
+            'middle_probability': rng.random() / count,
+            'exit_probability': rng.random() / count if rng.random() < 0.2 else 0.0,
+        })
+    return RelaySnapshot.from_details({'relays_published': 'synthetic', 'relays': relays})
+
+
+def legacy_inverse(orig_filter, relays):
+    # The InverseFilter.load this replaced: a list membership test per relay
+    matching_relays = orig_filter.load(relays)
+    return [relay for relay in relays if relay not in matching_relays]
+
+
+def main(args):
+    countries = CountryFilter(['de', 'us'])
+    compound = (countries & ExitFilter()) | ~(GuardFilter() | ~RunningFilter())
+
+    print '{:>8} {:>14} {:>14} {:>14} {:>14} {:>14}'.format(
+        'relays', 'legacy NOT', 'NOT load()', 'NOT mask()', 'NOT rows()', 'compound rows')
+    for count in args.sizes:
+        snapshot = synthetic_snapshot(count)
+        relays = list(snapshot.relays)
+        inverse = ~countries
+
+        def best(fn):
+            return min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1000
+
+        if count <= args.legacy_max:
+            legacy = '{:>11.2f} ms'.format(best(lambda: legacy_inverse(countries, relays)))
+        else:
+            legacy = '{:>14}'.format('skipped')
+        print '{:>8} {} {:>11.2f} ms {:>11.2f} ms {:>11.2f} ms {:>11.2f} ms'.format(
+            count, legacy,
+            best(lambda: inverse.load(relays)),
+            best(lambda: inverse.mask(snapshot)),
+            best(lambda: inverse.rows(snapshot)),
+            best(lambda: compound.rows(snapshot)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-s', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000], dest='sizes',
+        help='Synthetic snapshot sizes (default: 1000 10000 100000)')
+    parser.add_argument('-l', '--legacy-max', type=int, default=10000, dest='legacy_max',
+        help='Largest size to time the quadratic legacy InverseFilter on (default: 10000)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, dest='repeat',
+        help='Number of timing runs (default: 3)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the memory used by a relay selection and the time taken to encode
+it as JSON for the __slots__ Result class and the dict-backed class it
+replaced. The __slots__ results are encoded once as they are built and once
+with the relay fragments a snapshot keeps after the first selection.
+'''
+
+import json
+import os
+import random
+import sys
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from oniontip.util import Result, encode_relays, relay_fragments
+
+
+class LegacyResult():
+    # The old-style class Result replaced, attributes live in __dict__
+    def __init__(self):
+        for field in Result.FIELDS:
+            setattr(self, field, None)
+
+
+class LegacyResultEncoder(json.JSONEncoder):
+    def default(self, obj):
+        if isinstance(obj, LegacyResult):
+            return obj.__dict__
+        return json.JSONEncoder.default(self, obj)
+
+
+def synthetic_selection(result_class, count, seed=0):
+    rng = random.Random(seed)
+    results = []
+    for i in xrange(count):
+        result = result_class()
+        for field in Result.FIELDS:
+            setattr(result, field, None)
+        result.index = i + 1
+        result.donation_share = rng.random()
+        for weight in ('cw', 'adv_bw', 'p_guard', 'p_exit', 'p_middle'):
+            setattr(result, weight, rng.random())
+        result.nick = 'relay%d' % i
+        result.fp = '%040X' % i
+        result.link = True
+        result.exit = rng.random() < 0.2
+        result.guard = rng.random() < 0.4
+        result.cc = rng.choice(['de', 'us', 'fr', 'nl'])
+        result.primary_ip = '10.0.%d.%d' % (i >> 8 & 255, i & 255)
+        result.as_no = 'AS%d' % rng.randint(1, 500)
+        result.as_name = 'Example AS'
+        result.as_info = '%s %s' % (result.as_no, result.as_name)
+        result.bitcoin_address = '1BitcoinEaterAddressDontSendf59kuE'
+        results.append(result)
+    return {'results': results, 'excluded': None, 'total': None, 'relays_published': 'synthetic'}
+
+
+def instance_size(result):
+    size = sys.getsizeof(result)
+    if hasattr(result, '__dict__'):
+        size += sys.getsizeof(result.__dict__)
+    return size
+
+
+def main(args):
+    legacy = synthetic_selection(LegacyResult, args.count)
+    compact = synthetic_selection(Result, args.count)
+    cached = synthetic_selection(Result, args.count)
+    for result, fragment in zip(cached['results'], relay_fragments(cached['results'])):
+        result.fragment = fragment
+    expected = json.loads(json.dumps(legacy, cls=LegacyResultEncoder))
+    assert expected == json.loads(encode_relays(compact)) == json.loads(encode_relays(cached))
+
+    def best(fn):
+        return min(timeit.repeat(fn, number=1, repeat=args.repeat)) * 1000
+
+    print 'Selection of {} relays, best of {} runs'.format(args.count, args.repeat)
+    print '  {:<28} {:>12} {:>12}'.format('', 'memory', 'encode')
+    print '  {:<28} {:>10} kB {:>9.2f} ms'.format(
+        'dict Result + ResultEncoder',
+        sum(instance_size(result) for result in legacy['results']) // 1024,
+        best(lambda: json.dumps(legacy, cls=LegacyResultEncoder)))
+    print '  {:<28} {:>10} kB {:>9.2f} ms'.format(
+        '__slots__ Result',
+        sum(instance_size(result) for result in compact['results']) // 1024,
+        best(lambda: encode_relays(compact)))
+    print '  {:<28} {:>10} kB {:>9.2f} ms'.format(
+        '__slots__ Result + fragments',
+        sum(instance_size(result) + sys.getsizeof(result.fragment) for result in cached['results']) // 1024,
+        best(lambda: encode_relays(cached)))
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-n', '--count', type=int, default=7000, dest='count',
+        help='Number of relays in the selection (default: 7000)')
+    parser.add_argument('-r', '--repeat', type=int, default=5, dest='repeat',
+        help='Number of timing runs (default: 5)')
+    args = parser.parse_args()
+    main(args)
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compare the time taken to load the OnionTip relay snapshot from details.json
+and from its memory-mapped binary form.
+'''
+
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from argparse import ArgumentParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from oniontip.snapshot import RelaySnapshot
+
+DEFAULT_DETAILS_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'oniontip', 'details.json')
+
+
+def main(args):
+    snapshot = RelaySnapshot.from_file(args.details_file)
+    temp_dir = tempfile.mkdtemp()
+    binary_file = os.path.join(temp_dir, 'details.snapshot')
+    try:
+        snapshot.write_binary(binary_file)
+
+        loaders = [
+            ('JSON', lambda: RelaySnapshot.from_file(args.details_file)),
+            ('binary', lambda: RelaySnapshot.from_binary(binary_file)),
+            ('binary, all records', lambda: list(RelaySnapshot.from_binary(binary_file).relays)),
+        ]
+
+        print 'Loading {} relays, best of {} x {} loads'.format(len(snapshot), args.repeat, args.number)
+        print '  {:<22} {:>10} bytes'.format('details.json', os.path.getsize(args.details_file))
+        print '  {:<22} {:>10} bytes\n'.format('details.snapshot', os.path.getsize(binary_file))
+        for name, loader in loaders:
+            best = min(timeit.repeat(loader, number=args.number, repeat=args.repeat)) / args.number
+            print '  {:<22} {:>10.3f} ms'.format(name, best * 1000)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description=__doc__)
+    parser.add_argument('-f', '--details-file', default=DEFAULT_DETAILS_FILE, dest='details_file',
+        help='details.json file to load (default: oniontip/details.json)')
+    parser.add_argument('-n', '--number', type=int, default=10, dest='number',
+        help='Number of loads per timing run (default: 10)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, dest='repeat',
+        help='Number of timing runs (default: 3)')
+    args = parser.parse_args()
+    main(args)
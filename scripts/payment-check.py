@@ -5,12 +5,141 @@ Retrieve the transaction history for bitcoin addresses generated by
 OnionTip.com.
 '''
 
+import csv
+import json
 import logging
+import multiprocessing
+import os
+import sys
+import time
 from argparse import ArgumentParser
+from multiprocessing.pool import ThreadPool
 import bitcoin
 
+# Import blockchain.py on its own, importing the oniontip package would set up
+# the whole web application
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'oniontip'))
+from blockchain import BlockchainInfo
+
 ONIONTIP_BITCOIN_PUBLIC_SEED = '2942a7aed0919e5a7150b9275a41c7c9802c8241598fac61e121d7cf0e947293d620747a40f1f407aa336159cf2470f82c5179f374d62f9407665b7e6ad62443'
 
+OUTPUT_FIELDS = ['key_increment', 'address', 'outputs', 'spent', 'unspent']
+
+
+def derive_address(job):
+    # Runs in a worker process, electrum_address is a pure Python EC multiplication
+    public_seed, key_increment = job
+    return key_increment, bitcoin.electrum_address(public_seed, key_increment)
+
+
+def derive_addresses(pool, public_seed, key_increments):
+    '''
+    Yield (key_increment, address) in order, deriving the addresses across
+    the worker processes in pool.
+    '''
+    jobs = ((public_seed, key_increment) for key_increment in key_increments)
+    return pool.imap(derive_address, jobs, chunksize=50)
+
+
+def batches(items, size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def fetch_batch(backend, batch, retries):
+    '''
+    Return (batch, histories), retrying failed lookups with exponential
+    backoff. histories is None if every attempt failed.
+    '''
+    addresses = [address for _, address in batch]
+    for attempt in range(retries + 1):
+        try:
+            return batch, backend.history_many(addresses)
+        except Exception, err:
+            logging.debug('Attempt {} to retrieve addresses n={} to n={} failed: {}'.format(
+                attempt + 1, batch[0][0], batch[-1][0], err))
+            if attempt < retries:
+                time.sleep(2 ** attempt)
+    return batch, None
+
+
+class Checkpoint(object):
+    '''
+    Progress of a scan saved as JSON after each batch: the next address to
+    check, addresses which couldn't be retrieved and the running totals.
+    '''
+    def __init__(self, path, public_seed, next_increment):
+        self.path = path
+        self.public_seed = public_seed
+        self.next_increment = next_increment
+        self.failed = set()
+        self.totals = {'spent': 0, 'unspent': 0, 'checked': 0}
+
+    @classmethod
+    def load(cls, path, public_seed, next_increment):
+        checkpoint = cls(path, public_seed, next_increment)
+        if path and os.path.exists(path):
+            with open(path) as f:
+                saved = json.load(f)
+            if saved['public_seed'] != public_seed:
+                raise ValueError('Checkpoint {} is for a different public seed'.format(path))
+            checkpoint.next_increment = saved['next_increment']
+            checkpoint.failed = set(saved['failed'])
+            checkpoint.totals = saved['totals']
+        return checkpoint
+
+    def save(self):
+        if not self.path:
+            return
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({
+                'public_seed': self.public_seed,
+                'next_increment': self.next_increment,
+                'failed': sorted(self.failed),
+                'totals': self.totals,
+            }, f)
+        os.rename(temp_path, self.path)
+
+
+class ResultWriter(object):
+    '''
+    Append per-address totals to a CSV file or a JSON file with one object
+    per line, so a resumed scan adds to the output of the previous one.
+    '''
+    def __init__(self, path, output_format):
+        self.output_format = output_format
+        self.file = None
+        if path:
+            write_header = not os.path.exists(path) or not os.path.getsize(path)
+            self.file = open(path, 'ab')
+            if output_format == 'csv':
+                self.writer = csv.DictWriter(self.file, OUTPUT_FIELDS)
+                if write_header:
+                    self.writer.writeheader()
+
+    def write(self, row):
+        if not self.file:
+            return
+        if self.output_format == 'csv':
+            self.writer.writerow(row)
+        else:
+            self.file.write(json.dumps(row, sort_keys=True) + '\n')
+
+    def flush(self):
+        if self.file:
+            self.file.flush()
+
+    def close(self):
+        if self.file:
+            self.file.close()
+
 
 def main(args):
     '''
@@ -18,45 +147,71 @@ def main(args):
     a key is generated from a seed appended with an increasing integer
     '''
     logging.basicConfig(level=args.loglevel or logging.INFO, format='%(message)s')
-    total_spent = 0
-    total_unspent = 0
+
+    stop = args.offset + args.limit
+    checkpoint = Checkpoint.load(args.checkpoint, args.public_seed, args.offset)
+    # Addresses which failed in a previous run are checked again first
+    key_increments = sorted(checkpoint.failed) + range(checkpoint.next_increment, stop)
 
     logging.info(__doc__)
     logging.info('Starting to check {} addreses beginning from address offset {}\n'.format(
-        args.limit,args.offset)
+        len(key_increments), checkpoint.next_increment)
     )
 
-    for key_increment in range(args.offset, (args.offset + args.limit)):
-        address = bitcoin.electrum_address(args.public_seed, key_increment)
-
-        try:
-            history = bitcoin.history(address)
-        except:
-            logging.info('Network error when retreiving the transaction history for address {} (n={})'.format(
-                address, key_increment
-            ))
-            break
-
-        if not history:
-            logging.debug('No transactions were found for address {} (n={})'.format(address, key_increment))
-        else:
-            spent = sum(output.get('value', 0) for output in history if 'spend' in output)
-            unspent = sum(output.get('value', 0) for output in history if not 'spend' in output)
-            total_spent += spent
-            total_unspent += unspent
-
-            if unspent:
-                logging.info('The address {} has unforwarded donations totaling {} satoshi! (n={})'.format(
-                    address, unspent, key_increment)
-                )
+    backend = BlockchainInfo(rate=args.rate)
+    writer = ResultWriter(args.output, args.output_format)
+    processes = multiprocessing.Pool(args.processes)
+    threads = ThreadPool(args.workers)
+    try:
+        # Derived addresses are batched and looked up concurrently as they arrive
+        addresses = derive_addresses(processes, args.public_seed, key_increments)
+        lookups = threads.imap(lambda batch: fetch_batch(backend, batch, args.retries),
+                               batches(addresses, backend.batch_size))
+        for batch, histories in lookups:
+            if histories is None:
+                logging.info('Network error when retreiving the transaction history for addresses n={} to n={}'.format(
+                    batch[0][0], batch[-1][0]
+                ))
+                checkpoint.failed.update(key_increment for key_increment, _ in batch)
             else:
-                logging.info('All donations to {} totaling {} satoshi have been forwarded! (n={})'.format(
-                    address, spent, key_increment)
-                )
+                for key_increment, address in batch:
+                    checkpoint.failed.discard(key_increment)
+                    writer.write(check_history(address, histories[address], key_increment, checkpoint.totals))
+            checkpoint.next_increment = max(checkpoint.next_increment, batch[-1][0] + 1)
+            writer.flush()
+            checkpoint.save()
+    finally:
+        threads.close()
+        processes.close()
+        writer.close()
 
     logging.info('\nComplete! {} addresses were checked. {} satoshi were successfully forwarded and {} satoshi were unforwarded.'.format(
-                    args.limit, total_spent, total_unspent
+                    checkpoint.totals['checked'], checkpoint.totals['spent'], checkpoint.totals['unspent']
     ))
+    if checkpoint.failed:
+        logging.info('{} addresses could not be retrieved, run again with the same --checkpoint to retry them.'.format(
+            len(checkpoint.failed)))
+
+
+def check_history(address, history, key_increment, totals):
+    spent = sum(output.get('value', 0) for output in history if 'spend' in output)
+    unspent = sum(output.get('value', 0) for output in history if not 'spend' in output)
+    totals['spent'] += spent
+    totals['unspent'] += unspent
+    totals['checked'] += 1
+
+    if not history:
+        logging.debug('No transactions were found for address {} (n={})'.format(address, key_increment))
+    elif unspent:
+        logging.info('The address {} has unforwarded donations totaling {} satoshi! (n={})'.format(
+            address, unspent, key_increment)
+        )
+    else:
+        logging.info('All donations to {} totaling {} satoshi have been forwarded! (n={})'.format(
+            address, spent, key_increment)
+        )
+    return {'key_increment': key_increment, 'address': address, 'outputs': len(history),
+            'spent': spent, 'unspent': unspent}
 
 
 if __name__ == '__main__':
@@ -71,5 +226,19 @@ if __name__ == '__main__':
         help='Limit the number of addresses to check (default: 200)')
     parser.add_argument('-o', '--offset', type=int, default=0, dest='offset',
         help='Specify an offset to skip before checking addresses. (default: 0)')
+    parser.add_argument('-r', '--rate', type=float, default=5, dest='rate',
+        help='Maximum requests per second to blockchain.info (default: 5)')
+    parser.add_argument('-j', '--processes', type=int, default=multiprocessing.cpu_count(), dest='processes',
+        help='Number of processes deriving addresses (default: number of CPUs)')
+    parser.add_argument('-w', '--workers', type=int, default=4, dest='workers',
+        help='Number of concurrent history lookups (default: 4)')
+    parser.add_argument('--retries', type=int, default=3, dest='retries',
+        help='Retries for a failed history lookup before skipping it (default: 3)')
+    parser.add_argument('-c', '--checkpoint', dest='checkpoint',
+        help='Save progress to this file and resume from it if it exists')
+    parser.add_argument('--output', dest='output',
+        help='Append per-address spent/unspent totals to this file')
+    parser.add_argument('--format', choices=['csv', 'json'], default='csv', dest='output_format',
+        help='Format of --output, CSV or one JSON object per line (default: csv)')
     args = parser.parse_args()
     main(args)
@@ -0,0 +1,206 @@
+import json
+import unittest
+import urlparse
+
+import bitcoin
+
+from oniontip import blockchain
+from oniontip.blockchain import (BlockchainError, BlockchainInfo, ChainBackend, RateLimiter,
+                                 StubBlockchain, TTLCache, histories_from_txs)
+
+
+class FakeClock(object):
+    """Stands in for the time module, sleeping only advances the clock"""
+    def __init__(self):
+        self.now = 1000.0
+        self.sleeps = []
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakePool(object):
+    """Answers multiaddr requests from a list of blockchain.info transactions"""
+    def __init__(self, txs, page_size):
+        self.txs = txs
+        self.page_size = page_size
+        self.requests = []
+
+    def request(self, path):
+        query = urlparse.parse_qs(urlparse.urlparse(path).query)
+        active = set(query['active'][0].split('|'))
+        offset = int(query['offset'][0])
+        self.requests.append((sorted(active), offset))
+        txs = [tx for tx in self.txs
+               if active & set(out['addr'] for out in tx['out'])]
+        return json.dumps({'txs': txs[offset:offset + self.page_size]})
+
+
+def payment(tx_index, addresses, spends=()):
+    """blockchain.info transaction paying 1000 satoshi to each of addresses"""
+    return {
+        'hash': 'tx%d' % tx_index,
+        'tx_index': tx_index,
+        'block_height': 300000 + tx_index,
+        'out': [{'addr': address, 'n': n, 'value': 1000} for n, address in enumerate(addresses)],
+        'inputs': [{'prev_out': {'addr': address, 'tx_index': spent_index, 'n': n}}
+                   for address, spent_index, n in spends],
+    }
+
+
+class ClockTestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time = blockchain.time
+        blockchain.time = self.clock
+
+    def tearDown(self):
+        blockchain.time = self.time
+
+
+class RateLimiterTest(ClockTestCase):
+    def test_calls_are_spaced(self):
+        limiter = RateLimiter(4)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(self.clock.sleeps, [0.25, 0.25])
+
+    def test_no_wait_after_an_idle_interval(self):
+        limiter = RateLimiter(4)
+        limiter.wait()
+        self.clock.now += 1
+        limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+
+    def test_unlimited(self):
+        limiter = RateLimiter(None)
+        for _ in range(3):
+            limiter.wait()
+        self.assertEqual(self.clock.sleeps, [])
+
+
+class TTLCacheTest(ClockTestCase):
+    def test_expiry(self):
+        cache = TTLCache(10)
+        cache.put('a', 1)
+        self.clock.now += 10
+        self.assertEqual(cache.get('a'), 1)
+        self.clock.now += 0.1
+        self.assertIsNone(cache.get('a'))
+
+    def test_zero_ttl_keeps_nothing(self):
+        cache = TTLCache(0)
+        cache.put('a', 1)
+        self.assertIsNone(cache.get('a'))
+
+
+class BlockchainInfoTest(ClockTestCase):
+    def backend(self, txs, page_size=100):
+        backend = BlockchainInfo(rate=None, cache_ttl=10, push_strategies=[])
+        backend.page_size = page_size
+        backend.pool = FakePool(txs, page_size)
+        return backend
+
+    def test_multiaddr_batches(self):
+        addresses = ['addr%03d' % i for i in range(120)]
+        backend = self.backend([payment(i, [address]) for i, address in enumerate(addresses)])
+        histories = backend.history_many(addresses)
+        self.assertEqual([len(active) for active, _ in backend.pool.requests], [50, 50, 20])
+        self.assertEqual(backend.requests, 3)
+        self.assertEqual(sorted(histories), addresses)
+        self.assertEqual(histories['addr007'][0]['output'], 'tx7:0')
+
+    def test_pages(self):
+        backend = self.backend([payment(i, ['a']) for i in range(5)], page_size=2)
+        self.assertEqual(len(backend.history('a')), 5)
+        self.assertEqual([offset for _, offset in backend.pool.requests], [0, 2, 4])
+
+    def test_cached_histories(self):
+        backend = self.backend([payment(1, ['a', 'b'])])
+        backend.history('a')
+        histories = backend.history_many(['a', 'b'])
+        self.assertEqual(backend.pool.requests, [(['a'], 0), (['b'], 0)])
+        self.assertEqual(len(histories['a']), 1)
+        self.clock.now += 11
+        backend.history('a')
+        self.assertEqual(len(backend.pool.requests), 3)
+
+
+class PushTest(unittest.TestCase):
+    def test_fallback_order(self):
+        calls = []
+
+        def strategy(name, error=None):
+            def push(tx):
+                calls.append(name)
+                if error:
+                    raise error
+                return name
+            return push
+
+        backend = ChainBackend(push_strategies=[strategy('first', BlockchainError('down')),
+                                                strategy('second'), strategy('third')])
+        backend.cache.put('a', [])
+        self.assertEqual(backend.pushtx('00'), 'second')
+        self.assertEqual(calls, ['first', 'second'])
+        self.assertIsNone(backend.cache.get('a'))
+
+    def test_last_error_is_raised(self):
+        def fail(error):
+            def push(tx):
+                raise error
+            return push
+
+        last = ValueError('last')
+        backend = ChainBackend(push_strategies=[fail(BlockchainError('first')), fail(last)])
+        backend.cache.put('a', [])
+        with self.assertRaises(ValueError) as raised:
+            backend.pushtx('00')
+        self.assertIs(raised.exception, last)
+        self.assertEqual(backend.cache.get('a'), [])
+
+    def test_no_strategies(self):
+        self.assertRaises(BlockchainError, ChainBackend().pushtx, '00')
+
+
+class HistoriesFromTxsTest(unittest.TestCase):
+    def test_spent_outputs(self):
+        txs = [
+            payment(1, ['a', 'b', 'other']),
+            payment(2, ['other'], spends=[('a', 1, 0)]),
+            payment(3, ['a']),
+        ]
+        histories = histories_from_txs(txs, ['a', 'b', 'c'])
+        a = sorted(histories['a'], key=lambda out: out['output'])
+        self.assertEqual([(out['output'], out.get('spend')) for out in a],
+                         [('tx1:0', 'tx2:0'), ('tx3:0', None)])
+        self.assertEqual(histories['b'], [{'address': 'b', 'value': 1000, 'output': 'tx1:1',
+                                           'block_height': 300001}])
+        self.assertEqual(histories['c'], [])
+        self.assertNotIn('other', histories)
+
+
+class StubBlockchainTest(unittest.TestCase):
+    def test_unicode_address(self):
+        backend = StubBlockchain()
+        outpoint = backend.add_output(u'1BitcoinEaterAddressDontSendf59kuE', 5000)
+        backend.add_output(u'1BitcoinEaterAddressDontSendf59kuE', 5000)
+        history = backend.history(u'1BitcoinEaterAddressDontSendf59kuE')
+        self.assertEqual(history[0]['output'], outpoint)
+        self.assertEqual(len(set(output['output'] for output in history)), 2)
+
+    def test_push_spends_outputs(self):
+        private_key = bitcoin.sha256('stub blockchain test')
+        address = bitcoin.pubtoaddr(bitcoin.privtopub(private_key))
+        backend = StubBlockchain()
+        backend.add_output(address, 100000)
+        tx = bitcoin.signall(bitcoin.mktx(backend.unspent(address), [{'address': address, 'value': 90000}]),
+                             private_key)
+        self.assertEqual(backend.pushtx(tx), 'Transaction Submitted')
+        self.assertEqual(backend.pushed, [tx])
+        self.assertEqual(backend.unspent(address), [])
+        self.assertEqual(backend.history(address)[0]['spend'], '%s:0' % bitcoin.txhash(tx))
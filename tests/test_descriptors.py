@@ -0,0 +1,84 @@
+import os
+import re
+import shutil
+import tempfile
+import unittest
+
+import stem.descriptor
+
+from oniontip import util
+
+DESCRIPTORS_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'cached-descriptors')
+
+
+def serial_addresses(path):
+    """
+    The X-bitcoin addresses found by parsing one descriptor at a time with
+    stem, as check_and_update_bitcoin_fields did before using a pool.
+    """
+    addresses = {}
+    for descriptor in stem.descriptor.parse_file(path, 'server-descriptor 1.0', validate=False):
+        x_bitcoin_field = re.search('^X-bitcoin (.*)', str(descriptor), re.MULTILINE)
+        if x_bitcoin_field and util.extract_bitcoin_address(x_bitcoin_field.group()):
+            addresses[descriptor.fingerprint] = util.extract_bitcoin_address(x_bitcoin_field.group())
+    return addresses
+
+
+class ExtractXBitcoinTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_path = os.path.join(self.directory, 'address_cache.json')
+        self.raw_descriptors = util.download_server_descriptors(DESCRIPTORS_FIXTURE)
+        self.expected = serial_addresses(DESCRIPTORS_FIXTURE)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_fixture(self):
+        self.assertEqual(len(self.expected), 4)
+
+    def test_cold_and_warm_cache(self):
+        address_cache = util.AddressCache(self.cache_path)
+        addresses, count = util.extract_x_bitcoin_addresses(self.raw_descriptors, address_cache, processes=2)
+        self.assertEqual(addresses, self.expected)
+        self.assertEqual(count, 6)
+        self.assertEqual((address_cache.hits, address_cache.misses), (0, 5))
+        address_cache.save()
+
+        address_cache = util.AddressCache(self.cache_path)
+        addresses, count = util.extract_x_bitcoin_addresses(self.raw_descriptors, address_cache, processes=2)
+        self.assertEqual(addresses, self.expected)
+        self.assertEqual(count, 6)
+        self.assertEqual((address_cache.hits, address_cache.misses), (5, 0))
+
+    def test_changed_field_misses_warm_cache(self):
+        address_cache = util.AddressCache(self.cache_path)
+        util.extract_x_bitcoin_addresses(self.raw_descriptors, address_cache, processes=2)
+        address_cache.save()
+
+        raw_descriptors = self.raw_descriptors.replace('X-bitcoin 1EeBKGYf9fFbCyyb1wfemuk3pQcpaSKVou',
+                                                       'X-bitcoin 1JUD1F5JkoKdzgAbTUrZ1kreyV8FHBTrw')
+        address_cache = util.AddressCache(self.cache_path)
+        addresses, _ = util.extract_x_bitcoin_addresses(raw_descriptors, address_cache, processes=2)
+        expected = dict(self.expected)
+        expected['A000A000A000A000A000A000A000A000A0000001'] = '1JUD1F5JkoKdzgAbTUrZ1kreyV8FHBTrw'
+        self.assertEqual(addresses, expected)
+        self.assertEqual((address_cache.hits, address_cache.misses), (4, 1))
+
+    def test_chunks(self):
+        for chunk_size in (1, 100, 400, len(self.raw_descriptors)):
+            addresses = {}
+            count = 0
+            chunks = util.split_descriptors(self.raw_descriptors, chunk_size)
+            self.assertEqual(''.join(self.raw_descriptors[start:end] for start, end in chunks), self.raw_descriptors)
+            for start, end in chunks:
+                chunk_count, results = util.extract_chunk_addresses(self.raw_descriptors[start:end],
+                                                                    util.AddressCache())
+                count += chunk_count
+                addresses.update((fingerprint, address) for fingerprint, _, address, _ in results if address)
+            self.assertEqual(addresses, self.expected, chunk_size)
+            self.assertEqual(count, 6, chunk_size)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from oniontip import util
+from oniontip.snapshot import RelaySnapshot
+
+DETAILS_FIXTURE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'details.json')
+
+
+def load_details(path):
+    """
+    Build the details document the way check_and_update_bitcoin_fields did
+    before it streamed: json.load the whole document and keep the relays
+    with a bitcoin address in their contact field.
+    """
+    with open(path) as details_file:
+        data = json.load(details_file)
+    for relay in data['relays']:
+        if relay.get('contact') is not None and util.extract_bitcoin_address(relay['contact']):
+            relay['bitcoin_address'] = util.extract_bitcoin_address(relay['contact'])
+    data['relays'][:] = [relay for relay in data['relays'] if relay.get('bitcoin_address')]
+    return data
+
+
+class IterDetailsTest(unittest.TestCase):
+    def test_relays_and_header(self):
+        header = {}
+        with open(DETAILS_FIXTURE, 'rb') as details_file:
+            relays = list(util.iter_details(details_file, header))
+        with open(DETAILS_FIXTURE) as details_file:
+            data = json.load(details_file)
+        self.assertEqual(header, dict((key, value) for key, value in data.iteritems()
+                                      if key not in ('relays', 'bridges')))
+        self.assertEqual([relay['fingerprint'] for relay in relays],
+                         [relay['fingerprint'] for relay in data['relays']])
+        self.assertEqual(relays[1]['contact'], data['relays'][1]['contact'])
+        self.assertEqual(relays[0]['exit_policy_summary'], data['relays'][0]['exit_policy_summary'])
+
+
+class StreamedDetailsTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.details_file = util.DETAILS_FILE
+        self.address_cache_file = util.ADDRESS_CACHE_FILE
+        util.DETAILS_FILE = os.path.join(self.directory, 'details.json')
+        util.ADDRESS_CACHE_FILE = os.path.join(self.directory, 'address_cache.json')
+        self.descriptors = os.path.join(self.directory, 'cached-descriptors')
+        open(self.descriptors, 'w').close()
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        util.DETAILS_FILE = self.details_file
+        util.ADDRESS_CACHE_FILE = self.address_cache_file
+        shutil.rmtree(self.directory)
+
+    def test_same_snapshot_as_json_load(self):
+        relay_count = util.check_and_update_bitcoin_fields(DETAILS_FIXTURE, self.descriptors)
+        expected = RelaySnapshot.from_details(load_details(DETAILS_FIXTURE))
+        snapshot = RelaySnapshot.from_file(util.DETAILS_FILE)
+
+        self.assertEqual(relay_count, 4)
+        self.assertEqual(snapshot.relays_published, expected.relays_published)
+        self.assertEqual(snapshot.to_details(), expected.to_details())
+        self.assertEqual(snapshot.relays[2].nickname, u'r\xe9seauLibre')
+
+        # Only the fields the web app uses are kept
+        with open(util.DETAILS_FILE) as details_file:
+            written = json.load(details_file)
+        self.assertEqual(written['bridges_published'], '2014-09-01 11:37:00')
+        for relay in written['relays']:
+            self.assertLessEqual(set(relay), set(util.RETAINED_FIELDS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+import unittest
+
+from oniontip.snapshot import RelaySnapshot
+from oniontip.util import (ASFilter, CountryFilter, ExitFilter, FamilyFilter, RunningFilter,
+                           AndFilter)
+
+
+def relay(i, country, as_number, exit=False, family=()):
+    return {
+        'fingerprint': '%040X' % i,
+        'nickname': 'relay%d' % i,
+        'running': True,
+        'flags': ['Running', 'Valid'],
+        'country': country,
+        'or_addresses': ['10.0.0.%d:9001' % i],
+        'as_number': as_number,
+        'family': list(family),
+        'consensus_weight_fraction': 0.1,
+        'guard_probability': 0.0,
+        'middle_probability': 0.1,
+        'exit_probability': 0.1 if exit else 0.0,
+    }
+
+
+class FilterTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = RelaySnapshot.from_details({'relays_published': 'test', 'relays': [
+            relay(1, 'de', 'AS1', exit=True, family=['$%040X' % 2]),
+            relay(2, 'de', 'AS2', family=['$%040X' % 1]),
+            relay(3, 'us', 'AS1', exit=True),
+            relay(4, 'fr', 'AS3'),
+        ]})
+
+    def assertRows(self, relay_filter, rows):
+        self.assertEqual(list(relay_filter.rows(self.snapshot)), rows)
+        self.assertEqual(list(relay_filter.mask(self.snapshot).nonzero()[0]), rows)
+        self.assertEqual([self.snapshot.relays.index(r) for r in relay_filter.load(list(self.snapshot.relays))],
+                         rows)
+
+    def test_duplicate_and_mixed_case_countries(self):
+        self.assertRows(CountryFilter(['de', 'DE', 'de']), [0, 1])
+        self.assertRows(AndFilter([CountryFilter(['de', 'DE']), ExitFilter()]), [0])
+
+    def test_duplicate_ases(self):
+        self.assertRows(ASFilter(['AS1', 'AS1', '1']), [0, 2])
+        self.assertRows(AndFilter([ASFilter(['AS1', 'as1']), RunningFilter()]), [0, 2])
+
+    def test_family_accept(self):
+        family = FamilyFilter('$%040X' % 1)
+        self.assertRows(family, [0, 1])
+        self.assertRows(~family, [2, 3])
+        self.assertRows(family | CountryFilter(['fr']), [0, 1, 3])
+
+
+if __name__ == '__main__':
+    unittest.main()
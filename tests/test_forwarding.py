@@ -0,0 +1,225 @@
+import datetime
+import threading
+import time
+
+import bitcoin
+
+from oniontip import app, db, util, views
+from oniontip.blockchain import StubBlockchain
+from oniontip.models import DataStore, ForwardAddress, ForwardTransaction
+from support import DatabaseTestCase, keypair
+
+
+class ForwardingTestCase(DatabaseTestCase):
+    """
+    Forwards donations through views.check_and_send against a StubBlockchain.
+    """
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.backend = StubBlockchain()
+        self.backend.push_strategies = [self.push]
+        self.leases = []
+        self.blockchain_backend = views.blockchain_backend
+        views.blockchain_backend = self.backend
+        self.relays = [keypair('relay %d' % i)[1] for i in range(2)]
+
+    def tearDown(self):
+        views.blockchain_backend = self.blockchain_backend
+        DatabaseTestCase.tearDown(self)
+
+    def push(self, tx):
+        # Record who held the lease on the address being forwarded from
+        address = ForwardTransaction.query.filter_by(tx_hash=bitcoin.txhash(tx)).one().address
+        self.leases.append(db.session.query(ForwardAddress.lease_owner).filter_by(address=address).scalar())
+        return self.backend._push(tx)
+
+    def create_address(self, seed):
+        private_key, address = keypair(seed)
+        db.session.add(ForwardAddress(private_key=private_key,
+                                      outputs={self.relays[0]: 60.0, self.relays[1]: 40.0}))
+        db.session.commit()
+        return address
+
+    def lease_owner(self, address):
+        return db.session.query(ForwardAddress.lease_owner).filter_by(address=address).scalar()
+
+    def total_donated(self):
+        total = DataStore.query.filter_by(key='total_donated').first()
+        return int(total.value) if total else 0
+
+
+class CheckAndSendTest(ForwardingTestCase):
+    def sign(self, address):
+        """Sign a forwarding transaction for the unspent outputs of address"""
+        unspent = self.backend.unspent(address)
+        private_key = ForwardAddress.query.filter_by(address=address).one().private_key
+        tx = bitcoin.signall(bitcoin.mktx(unspent, [{'address': self.relays[0], 'value': 90000}]),
+                             str(private_key))
+        return ForwardTransaction.outpoints_key(unspent), tx
+
+    def test_forward(self):
+        address = self.create_address('donation')
+        self.backend.add_output(address, 200000)
+
+        response = views.check_and_send(address)
+        self.assertEqual(response['status'], 'success')
+        tx_hash = response['data']['tx_hash']
+        self.assertEqual(len(self.backend.pushed), 1)
+        # Newer pybitcointools only parse str as hex, not unicode read from the database
+        self.assertIsInstance(self.backend.pushed[0], str)
+        self.assertEqual(bitcoin.txhash(self.backend.pushed[0]), tx_hash)
+        self.assertIsNotNone(self.leases[0])
+        self.assertIsNone(self.lease_owner(address))
+
+        # 200000 satoshi less the fee for one input and two outputs
+        fee = util.calculate_fee(1, 2, views.TX_FEE_PER_KB)
+        forward_address = ForwardAddress.query.filter_by(address=address).one()
+        self.assertTrue(forward_address.spent)
+        self.assertEqual(forward_address.spending_tx, tx_hash)
+        self.assertEqual(forward_address.donation_amount, 200000 - fee)
+        self.assertEqual(sorted(output.value for output in forward_address.forward_outputs),
+                         [(200000 - fee) * 40 / 100, (200000 - fee) * 60 / 100])
+        self.assertEqual(self.total_donated(), 200000 - fee)
+
+        # Nothing is left to forward
+        response = views.check_and_send(address)
+        self.assertEqual(response['status'], 'fail')
+        self.assertEqual(len(self.backend.pushed), 1)
+        self.assertEqual(self.total_donated(), 200000 - fee)
+
+    def test_totals_accumulate(self):
+        for seed, value in (('first', 100000), ('second', 300000)):
+            address = self.create_address(seed)
+            self.backend.add_output(address, value)
+            self.assertEqual(views.check_and_send(address)['status'], 'success')
+        fee = util.calculate_fee(1, 2, views.TX_FEE_PER_KB)
+        self.assertEqual(self.total_donated(), 400000 - 2 * fee)
+
+    def test_pushed_outpoints_are_not_pushed_again(self):
+        address = self.create_address('donation')
+        self.backend.add_output(address, 200000)
+        outpoints, tx = self.sign(address)
+        forward_tx = ForwardTransaction.record(outpoints, address, tx, 90000)
+        forward_tx.pushed = True
+        db.session.commit()
+
+        # The backend doesn't show the outputs as spent yet
+        response = views.check_and_send(address)
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(response['data']['tx_hash'], bitcoin.txhash(tx))
+        self.assertEqual(self.backend.pushed, [])
+        self.assertEqual(self.total_donated(), 0)
+        self.assertIsNone(self.lease_owner(address))
+
+    def test_recorded_transaction_is_retried(self):
+        address = self.create_address('donation')
+        self.backend.add_output(address, 200000)
+        outpoints, tx = self.sign(address)
+        ForwardTransaction.record(outpoints, address, tx, 90000)
+
+        response = views.check_and_send(address)
+        self.assertEqual(response['status'], 'success')
+        self.assertEqual(self.backend.pushed, [tx])
+        self.assertIsInstance(self.backend.pushed[0], str)
+        self.assertEqual(self.total_donated(), 90000)
+        self.assertTrue(ForwardTransaction.query.filter_by(outpoints=outpoints).one().pushed)
+
+    def test_leased_address_is_skipped(self):
+        address = self.create_address('donation')
+        self.backend.add_output(address, 200000)
+        owner = ForwardAddress.acquire_lease(address, 120)
+
+        response = views.check_and_send(address)
+        self.assertEqual(response['data']['code'], 409)
+        self.assertEqual(self.backend.pushed, [])
+        self.assertEqual(self.lease_owner(address), owner)
+
+
+class OverlapBlockchain(StubBlockchain):
+    """StubBlockchain which records how many batch lookups ran at once"""
+    def __init__(self, **kwargs):
+        StubBlockchain.__init__(self, **kwargs)
+        self.active = 0
+        self.max_active = 0
+        self.threads = set()
+
+    def _fetch_histories(self, addresses):
+        with self._lock:
+            self.active += 1
+            self.max_active = max(self.max_active, self.active)
+            self.threads.add(threading.current_thread().name)
+        try:
+            return StubBlockchain._fetch_histories(self, addresses)
+        finally:
+            with self._lock:
+                self.active -= 1
+
+
+class FindUnsentPaymentsTest(ForwardingTestCase):
+    def setUp(self):
+        ForwardingTestCase.setUp(self)
+        self.backend = OverlapBlockchain(delay=0.2)
+        self.backend.push_strategies = [self.push]
+        self.backend.batch_size = 1
+        views.blockchain_backend = self.backend
+        self.check_workers = app.config.get('CHECK_WORKERS')
+        app.config['CHECK_WORKERS'] = 4
+        self.check_and_send = views.check_and_send
+        views.check_and_send = self.record_check
+        self.checks = []
+
+    def tearDown(self):
+        views.check_and_send = self.check_and_send
+        app.config['CHECK_WORKERS'] = self.check_workers
+        ForwardingTestCase.tearDown(self)
+
+    def record_check(self, address, history=None):
+        self.checks.append((address, threading.current_thread().name))
+        return self.check_and_send(address, history)
+
+    def create_addresses(self, count):
+        addresses = [self.create_address('donation %d' % i) for i in range(count)]
+        for address in addresses:
+            self.backend.add_output(address, 100000)
+        return addresses
+
+    def test_histories_are_fetched_concurrently(self):
+        addresses = self.create_addresses(4)
+        started = time.time()
+        sent = views.find_unsent_payments()
+        # Four batches of one address each, fetched serially would take 0.8s
+        self.assertLess(time.time() - started, 0.6)
+        self.assertEqual(self.backend.max_active, 4)
+        self.assertNotIn(threading.current_thread().name, self.backend.threads)
+        self.assertEqual(sorted(tx['address'] for tx in sent), sorted(addresses))
+
+    def test_payments_are_sent_serially(self):
+        addresses = self.create_addresses(4)
+        views.find_unsent_payments()
+        # Forwarding happens in query order on the calling thread
+        self.assertEqual(self.checks, [(address, threading.current_thread().name) for address in addresses])
+        self.assertEqual(len(self.backend.pushed), 4)
+        fee = util.calculate_fee(1, 2, views.TX_FEE_PER_KB)
+        self.assertEqual(self.total_donated(), 4 * (100000 - fee))
+
+    def test_old_addresses_need_check_all(self):
+        recent, old = self.create_addresses(2)
+        forward_address = ForwardAddress.query.filter_by(address=old).one()
+        forward_address.created = datetime.datetime.utcnow() - datetime.timedelta(hours=3, minutes=1)
+        db.session.commit()
+
+        self.assertEqual([tx['address'] for tx in views.find_unsent_payments()], [recent])
+        self.assertEqual([address for address, _ in self.checks], [recent])
+
+        self.assertEqual([tx['address'] for tx in views.find_unsent_payments(check_all=True)], [old])
+        self.assertEqual(len(self.backend.pushed), 2)
+
+    def test_spent_addresses_are_skipped(self):
+        address, = self.create_addresses(1)
+        views.find_unsent_payments()
+        self.assertEqual(views.find_unsent_payments(check_all=True), [])
+        self.assertEqual([checked for checked, _ in self.checks], [address])
+
+    def test_nothing_to_check(self):
+        self.assertEqual(views.find_unsent_payments(), [])
+        self.assertEqual(self.backend.max_active, 0)
@@ -0,0 +1,140 @@
+import datetime
+import json
+import threading
+import time
+
+from oniontip import app, db, views
+from oniontip.jobs import ForwardWorkers
+from oniontip.models import ForwardAddress, ForwardJob
+from support import DatabaseTestCase, keypair
+
+
+class ForwardJobTest(DatabaseTestCase):
+    def test_enqueue_twice(self):
+        job = ForwardJob.enqueue('address')
+        self.assertEqual(ForwardJob.enqueue('address').id, job.id)
+        self.assertNotEqual(ForwardJob.enqueue('other').id, job.id)
+
+        ForwardJob.claim()
+        self.assertEqual(ForwardJob.enqueue('address').id, job.id)
+        job.finish(json.dumps({'status': 'success'}))
+        self.assertNotEqual(ForwardJob.enqueue('address').id, job.id)
+
+    def test_claim_oldest(self):
+        first = ForwardJob.enqueue('first')
+        ForwardJob.enqueue('second')
+        self.assertEqual(ForwardJob.claim().id, first.id)
+        self.assertEqual(ForwardJob.query.get(first.id).state, ForwardJob.RUNNING)
+
+    def test_expire_stale(self):
+        stale = ForwardJob.enqueue('stale')
+        running = ForwardJob.enqueue('running')
+        ForwardJob.claim()
+        ForwardJob.claim()
+        ForwardJob.query.filter_by(id=stale.id).update(
+            {'updated': datetime.datetime.utcnow() - datetime.timedelta(seconds=301)})
+        db.session.commit()
+
+        self.assertEqual(ForwardJob.expire_stale(300, 'expired'), 1)
+        db.session.expire_all()
+        self.assertEqual((stale.state, stale.active_address, stale.result), (ForwardJob.DONE, None, 'expired'))
+        self.assertEqual(running.state, ForwardJob.RUNNING)
+        # The address can be queued again
+        self.assertNotEqual(ForwardJob.enqueue('stale').id, stale.id)
+        self.assertEqual(ForwardJob.enqueue('running').id, running.id)
+
+
+class ForwardWorkersTest(DatabaseTestCase):
+    """
+    Runs ForwardWorkers._process_one on a thread of the test, in place of
+    the worker threads views.forward_workers starts on the first request.
+    """
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.forwarded = []
+        self.workers = ForwardWorkers(self.forward, job_timeout=300)
+        self.forward_workers = views.forward_workers
+        views.forward_workers = self.workers
+        self.before_first_request_funcs = app.before_first_request_funcs
+        app.before_first_request_funcs = []
+        self.client = app.test_client()
+
+        private_key, self.address = keypair('forward job')
+        db.session.add(ForwardAddress(private_key=private_key, outputs={}))
+        db.session.commit()
+
+    def tearDown(self):
+        app.before_first_request_funcs = self.before_first_request_funcs
+        views.forward_workers = self.forward_workers
+        DatabaseTestCase.tearDown(self)
+
+    def forward(self, address):
+        self.forwarded.append(address)
+        return {'status': 'success', 'data': {'tx_hash': 'tx of %s' % address}}
+
+    def process_one(self, delay=0):
+        time.sleep(delay)
+        try:
+            with app.app_context():
+                self.workers._process_one()
+        finally:
+            db.session.remove()
+
+    def get_json(self, url):
+        response = self.client.get(url)
+        return response.status_code, json.loads(response.data)
+
+    def test_enqueue_same_address(self):
+        code, queued = self.get_json('/forward/%s' % self.address)
+        self.assertEqual((code, queued['status']), (202, ForwardJob.QUEUED))
+        code, again = self.get_json('/forward/%s' % self.address)
+        self.assertEqual(again['data']['job_id'], queued['data']['job_id'])
+        self.assertEqual(self.workers.enqueue(self.address).id, queued['data']['job_id'])
+
+        self.process_one()
+        self.assertEqual(self.forwarded, [self.address])
+        self.assertNotEqual(self.workers.enqueue(self.address).id, queued['data']['job_id'])
+
+    def test_stale_job_is_expired(self):
+        job_id = self.workers.enqueue(self.address).id
+        ForwardJob.claim()
+        ForwardJob.query.filter_by(id=job_id).update(
+            {'updated': datetime.datetime.utcnow() - datetime.timedelta(seconds=600)})
+        db.session.commit()
+
+        # The worker which claimed the job died, the next one to look for
+        # work finishes it with an error
+        self.process_one()
+        self.assertEqual(self.forwarded, [])
+        code, result = self.get_json('/forward/job/%d' % job_id)
+        self.assertEqual(result['status'], 'error')
+        self.assertIn('took too long', result['message'])
+
+        code, queued = self.get_json('/forward/%s' % self.address)
+        self.assertNotEqual(queued['data']['job_id'], job_id)
+
+    def test_long_poll_returns_when_job_finishes(self):
+        code, queued = self.get_json('/forward/%s' % self.address)
+        worker = threading.Thread(target=self.process_one, args=(0.5,))
+        worker.start()
+        started = time.time()
+        code, result = self.get_json('/forward/job/%d?wait=10' % queued['data']['job_id'])
+        elapsed = time.time() - started
+        worker.join()
+
+        self.assertEqual(code, 200)
+        self.assertEqual(result, {'status': 'success', 'data': {'tx_hash': 'tx of %s' % self.address}})
+        self.assertGreaterEqual(elapsed, 0.4)
+        # Woken by the worker rather than waiting out the timeout
+        self.assertLess(elapsed, 2)
+
+    def test_long_poll_timeout(self):
+        code, queued = self.get_json('/forward/%s' % self.address)
+        started = time.time()
+        code, status = self.get_json('/forward/job/%d?wait=0.3' % queued['data']['job_id'])
+        self.assertGreaterEqual(time.time() - started, 0.3)
+        self.assertEqual((code, status['status']), (202, ForwardJob.QUEUED))
+
+    def test_unknown_job(self):
+        code, result = self.get_json('/forward/job/12345?wait=0.1')
+        self.assertEqual((code, result['data']['code']), (404, 404))
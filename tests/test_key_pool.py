@@ -0,0 +1,56 @@
+import threading
+
+import bitcoin
+
+from oniontip import app, db
+from oniontip.models import ForwardAddress, KeySlot
+from oniontip.util import KeyPoolFiller
+from support import DatabaseTestCase
+
+
+class KeyPoolTest(DatabaseTestCase):
+    def setUp(self):
+        DatabaseTestCase.setUp(self)
+        self.seed = app.config.get('BITCOIN_KEY_SEED')
+        app.config['BITCOIN_KEY_SEED'] = bitcoin.sha256('key pool test')
+
+    def tearDown(self):
+        app.config['BITCOIN_KEY_SEED'] = self.seed
+        DatabaseTestCase.tearDown(self)
+
+    def test_fill(self):
+        pool = KeyPoolFiller(size=5, batch=2)
+        pool.fill()
+        self.assertEqual(KeySlot.available(), 6)
+        self.assertEqual(sorted(slot.key_index for slot in KeySlot.query), range(1, 7))
+
+    def test_concurrent_claims_on_empty_pool(self):
+        pool = KeyPoolFiller()
+        start = threading.Event()
+        claimed = []
+        errors = []
+
+        def create_address():
+            start.wait()
+            try:
+                # As /payment.json does
+                forward_address = ForwardAddress(outputs={}, key_slot=pool.claim())
+                db.session.add(forward_address)
+                db.session.commit()
+                claimed.append(forward_address.key_index)
+            except Exception, err:
+                errors.append(err)
+            finally:
+                db.session.remove()
+
+        threads = [threading.Thread(target=create_address) for _ in range(12)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.assertEqual(len(set(claimed)), 12)
+        self.assertEqual(KeySlot.query.filter_by(claimed=True).count(), 12)
+        self.assertGreater(pool.inline_fills, 0)
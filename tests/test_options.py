@@ -0,0 +1,20 @@
+import unittest
+
+from oniontip.util import Opt
+
+
+class CacheKeyTest(unittest.TestCase):
+    def test_country_order_and_case(self):
+        self.assertEqual(Opt({'country': '["DE", "us", "de"]'}).cache_key(),
+                         Opt({'country': '["us", "de"]'}).cache_key())
+
+    def test_list_options_are_hashable(self):
+        key = Opt({'ases': 'AS2,AS1', 'country': '["de"]'}).cache_key()
+        self.assertIn(('ases', ('AS1', 'AS2')), key)
+        hash(key)
+
+    def test_json_object_country_has_no_key(self):
+        self.assertIsNone(Opt({'country': '{"de": 1}'}).cache_key())
+
+    def test_non_string_country_has_no_key(self):
+        self.assertIsNone(Opt({'country': '[1, ["de"]]'}).cache_key())
@@ -0,0 +1,156 @@
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+
+from oniontip import app
+from oniontip.snapshot import (Relay, RelaySnapshot, apply_deltas, binary_path, load_latest_snapshot,
+                               logger, write_delta)
+from oniontip.util import Opt, RelayStats, encode_relays
+
+
+def relay(i, nickname=None, country='de'):
+    return {
+        'fingerprint': '%040X' % i,
+        'nickname': nickname or 'relay%d' % i,
+        'running': True,
+        'flags': ['Fast', 'Running', 'Valid'],
+        'country': country,
+        'or_addresses': ['10.0.0.%d:9001' % i],
+        'as_number': 'AS%d' % i,
+        'as_name': 'AS %d' % i,
+        'family': [],
+        'bitcoin_address': '1Relay%d' % i,
+        'consensus_weight_fraction': 0.01 * i,
+        'advertised_bandwidth_fraction': 0.01,
+        'guard_probability': 0.0,
+        'middle_probability': 0.01 * i,
+        'exit_probability': 0.0,
+    }
+
+
+class RecordingHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+class SnapshotTestCase(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.details_path = os.path.join(self.directory, 'details.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_details(self, details):
+        with open(self.details_path, 'w') as details_file:
+            json.dump(details, details_file)
+        return RelaySnapshot.from_file(self.details_path)
+
+    def assertSameSnapshot(self, snapshot, expected):
+        self.assertEqual(snapshot.version, expected.version)
+        self.assertEqual(snapshot.to_details(), expected.to_details())
+
+
+class DeltaTest(SnapshotTestCase):
+    def setUp(self):
+        SnapshotTestCase.setUp(self)
+        self.base = self.write_details({'relays_published': 'v0', 'relays': [relay(i) for i in range(1, 5)]})
+        # Relay 1 leaves, 2 changes and 5 joins, then 3 leaves and 6 joins at the front
+        self.first = RelaySnapshot.from_details({'relays_published': 'v1', 'relays': [
+            relay(2, country='us'), relay(3), relay(4), relay(5)]}, 1.0)
+        self.second = RelaySnapshot.from_details({'relays_published': 'v2', 'relays': [
+            relay(6), relay(2, country='us'), relay(4, nickname=u'r\xe9lais'), relay(5)]}, 2.0)
+        self.names = [write_delta(self.details_path, self.first.diff(self.base)),
+                      write_delta(self.details_path, self.second.diff(self.first))]
+        self.handler = RecordingHandler()
+        logger.addHandler(self.handler)
+
+    def tearDown(self):
+        logger.removeHandler(self.handler)
+        SnapshotTestCase.tearDown(self)
+
+    def test_apply_deltas(self):
+        snapshot, after = apply_deltas(self.base, self.details_path)
+        self.assertSameSnapshot(snapshot, self.second)
+        self.assertEqual(after, self.names[-1])
+        self.assertSameSnapshot(load_latest_snapshot(self.details_path), self.second)
+
+    def test_apply_newer_deltas(self):
+        snapshot, after = apply_deltas(self.first, self.details_path, self.names[0])
+        self.assertSameSnapshot(snapshot, self.second)
+        self.assertEqual(after, self.names[-1])
+        self.assertIs(apply_deltas(snapshot, self.details_path, after)[0], snapshot)
+        self.assertEqual(self.handler.messages, [])
+
+    def test_mismatched_delta_reloads(self):
+        # The first delta isn't based on the snapshot it would be applied to
+        snapshot, after = apply_deltas(self.first, self.details_path)
+        self.assertSameSnapshot(snapshot, self.second)
+        self.assertEqual(after, self.names[-1])
+        self.assertEqual(len(self.handler.messages), 1)
+        self.assertIn(self.base.version, self.handler.messages[0])
+
+    def test_broken_delta_chain(self):
+        other = RelaySnapshot.from_details({'relays_published': 'other', 'relays': [relay(7)]}, 3.0)
+        write_delta(self.details_path, other.diff(self.first))
+        self.assertRaises(ValueError, load_latest_snapshot, self.details_path)
+        self.assertRaises(ValueError, apply_deltas, self.second, self.details_path, self.names[-1])
+        self.assertEqual(len(self.handler.messages), 1)
+
+
+class BinarySnapshotTest(SnapshotTestCase):
+    def setUp(self):
+        SnapshotTestCase.setUp(self)
+        relays = [relay(i) for i in range(1, 7)]
+        relays[0].update(nickname=u'K\xf6nig', as_name=u'Soci\xe9t\xe9 \u0422\u0435\u0441\u0442')
+        relays[1].update(nickname=u'\u4e2d\u7ee7', family=['$%040X' % 3, 'relay4'])
+        relays[2].update(country='us', family=['$%040X' % 2], flags=['Exit', 'Running', 'Valid'],
+                         exit_probability=0.2)
+        relays[3].update(as_name='', country='fr')
+        del relays[4]['family']
+        relays[5].update(running=False, flags=[])
+        self.snapshot = self.write_details({'relays_published': '2014-09-01 12:00:00', 'relays': relays})
+        self.snapshot.write_binary(binary_path(self.details_path), self.snapshot.mtime)
+        self.binary = RelaySnapshot.from_binary(binary_path(self.details_path))
+        self.relay_snapshot = getattr(app, 'relay_snapshot', None)
+
+    def tearDown(self):
+        app.relay_snapshot = self.relay_snapshot
+        SnapshotTestCase.tearDown(self)
+
+    def encoded(self, snapshot, request):
+        app.relay_snapshot = snapshot
+        options = Opt(request)
+        stats = RelayStats(options)
+        return encode_relays(stats.sort_and_reduce(stats.relays, options))
+
+    def test_same_relays(self):
+        self.assertEqual(len(self.binary), len(self.snapshot))
+        self.assertEqual(self.binary.version, self.snapshot.version)
+        self.assertEqual(self.binary.relays_published, self.snapshot.relays_published)
+        # Rows accessed one at a time and selected together
+        for row, expected in enumerate(self.snapshot.relays):
+            relay = self.binary.relays[row]
+            for field in Relay.__slots__:
+                self.assertEqual(getattr(relay, field), getattr(expected, field), field)
+        self.assertEqual(RelaySnapshot.from_binary(binary_path(self.details_path)).to_details(),
+                         self.snapshot.to_details())
+        self.assertEqual(self.binary.relays[1].family, ('$%040X' % 3, 'relay4'))
+        self.assertEqual(self.binary.relays[0].family, ())
+
+    def test_same_encoded_json(self):
+        for request in ({}, {'sort': 'nick', 'sort_reverse': 'false'}, {'top': '2'},
+                        {'by_country': 'true'}, {'by_as': 'true', 'sort': 'cc'},
+                        {'country': '["de"]', 'inactive': 'true'}):
+            self.assertEqual(self.encoded(self.binary, request), self.encoded(self.snapshot, request), request)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+import unittest
+
+import numpy
+
+from oniontip.snapshot import RelaySnapshot
+from oniontip.util import Opt, RelayGroups, RelayRows, RelayStats
+
+# Sort options offered by the relay table
+SORT_OPTIONS = RelayStats.SORT_COLUMNS + ['nick', 'fp', 'exit', 'guard', 'cc', 'as_no']
+
+# Few distinct values, so most relays share their sort key with others
+WEIGHTS = [0.0, 0.01, 0.02, 0.02, 0.04]
+
+
+def relay(i):
+    return {
+        'fingerprint': '%040X' % (i * 7919 % 101),
+        'nickname': 'relay%d' % (i % 6),
+        'running': True,
+        'flags': ['Running', 'Valid'] + (['Exit'] if i % 3 == 0 else []) + (['Guard'] if i % 4 == 0 else []),
+        'country': ['de', 'us', 'fr'][i % 3],
+        'or_addresses': ['10.%d.0.%d:9001' % (i % 2, i)],
+        'as_number': 'AS%d' % (i % 4),
+        'as_name': 'AS %d' % (i % 4),
+        'consensus_weight_fraction': WEIGHTS[i % 5],
+        'advertised_bandwidth_fraction': WEIGHTS[i * 3 % 5],
+        'guard_probability': WEIGHTS[i % 2],
+        'middle_probability': WEIGHTS[i * 2 % 5],
+        'exit_probability': WEIGHTS[i % 3],
+    }
+
+
+class SortOrderTest(unittest.TestCase):
+    def setUp(self):
+        self.snapshot = RelaySnapshot.from_details({'relays_published': 'test',
+                                                    'relays': [relay(i) for i in range(40)]})
+        self.stats = RelayStats(Opt({}))
+
+    def options(self, sort, sort_reverse, **kwargs):
+        options = Opt(kwargs)
+        options.sort = sort
+        options.sort_reverse = sort_reverse
+        return options
+
+    def assertSortOrder(self, lines, options, top):
+        results = lines.results(numpy.arange(len(lines)))
+        # A full stable sort of the Result lines truncated to top
+        expected = sorted(range(len(results)), key=lambda i: getattr(results[i], options.sort),
+                          reverse=options.sort_reverse)[:max(top, 0)]
+        order = self.stats._sort_order(lines, options, top)
+        self.assertEqual(list(order), expected, '%s reverse=%s top=%d' % (options.sort, options.sort_reverse, top))
+
+    def test_relays(self):
+        rows = numpy.arange(len(self.snapshot))
+        for sort in SORT_OPTIONS:
+            for sort_reverse in (True, False):
+                options = self.options(sort, sort_reverse)
+                lines = RelayRows(self.snapshot, rows, options)
+                for top in (0, 1, 3, 7, 8, 20, 39, 40, 41, 100):
+                    self.assertSortOrder(lines, options, top)
+
+    def test_filtered_relays(self):
+        rows = numpy.arange(3, len(self.snapshot), 2)
+        options = self.options('cw', True)
+        for top in (0, 5, len(rows), len(rows) + 1):
+            self.assertSortOrder(RelayRows(self.snapshot, rows, options), options, top)
+
+    def test_groups(self):
+        rows = numpy.arange(len(self.snapshot))
+        for sort in RelayStats.SORT_COLUMNS + ['cc']:
+            for sort_reverse in (True, False):
+                options = self.options(sort, sort_reverse, by_country='true', by_as='true')
+                lines = RelayGroups(self.snapshot, rows, options)
+                for top in (0, 1, 4, len(lines), len(lines) + 5):
+                    self.assertSortOrder(lines, options, top)
+
+
+if __name__ == '__main__':
+    unittest.main()